@@ -1,23 +1,212 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import os
+import re
+import hashlib
+import shutil
 import logging
-from typing import Optional, List, AsyncGenerator
+from typing import Optional, List, AsyncGenerator, Dict, Any
 import uvicorn
 import json
 import asyncio
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
 
 # 导入我们的 FFmpeg MCP 客户端
-from ffmpeg_mcp_demo import FFmpegMCPClient
+from ffmpeg_mcp_demo import FFmpegMCPClient, ToolCallError, tool_runner
+from upload_storage import stream_upload_to_temp, get_max_upload_size, UploadTooLargeError
+from blob_store import BlobStore
+from tool_cache import CACHEABLE_TOOLS, ToolResultCache
+from plan_cache import PlanCache
+from llm_scheduler import LLMScheduler
+import metrics
+from resumable_upload import ResumableUploadManager, ResumableUploadError
+from media_index import MediaIndex, InvalidCursorError, media_kind, probe
+from job_queue import JobScheduler, JobCancelledError
+from job_store import JobStore
+from media_response import FileInfoCache, MediaFileResponse
+from hls_preview import HlsPreviewCache, PreviewError
+from thumbnails import ThumbnailCache
+from batch import BatchError, plan_batch, run_batch
+from pipeline import PipelineError, compile_pipeline, run_pipeline
+from encode_planner import EncodePlanner, ENCODER_PROFILES, STRATEGIES
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="FFmpeg MCP 智能视频处理助手", version="1.0.0")
+# 加载 .env 中的配置
+load_dotenv()
+
+# 创建上传目录
+os.makedirs("uploads", exist_ok=True)
+os.makedirs("outputs", exist_ok=True)
+
+# 内容寻址存储，uploads/ 和 outputs/ 中的文件都链接到其中的 blob
+blob_store = BlobStore("storage")
+
+# 断点续传上传会话
+resumable_uploads = ResumableUploadManager(os.path.join("storage", "resumable"))
+
+# 确定性工具调用的结果缓存
+tool_cache = ToolResultCache(
+    blob_store,
+    os.path.join("storage", "tool_cache.sqlite3"),
+    max_bytes=int(os.getenv("TOOL_CACHE_MAX_MB", "10240")) * 1024 * 1024
+)
+
+# 相同请求的工具调用计划缓存，PLAN_CACHE_ENABLED=0 时关闭
+plan_cache = PlanCache(
+    os.path.join("storage", "plan_cache.sqlite3"),
+    roots=("uploads", "outputs"),
+    ttl=float(os.getenv("PLAN_CACHE_TTL", "86400")),
+    max_entries=int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "1000"))
+) if os.getenv("PLAN_CACHE_ENABLED", "1") != "0" else None
+
+# 封面图和进度条预览雪碧图缓存
+thumbnails = ThumbnailCache(
+    os.path.join("storage", "thumbnails"),
+    max_bytes=int(os.getenv("THUMBNAIL_CACHE_MAX_MB", "1024")) * 1024 * 1024
+)
+
+# uploads/ 和 outputs/ 的元数据索引，文件列表直接从索引分页查询；
+# 新文件在后台探测时一并生成缩略图
+media_index = MediaIndex(
+    os.path.join("storage", "media.sqlite3"),
+    {"upload": "uploads", "output": "outputs"},
+    blob_store=blob_store,
+    thumbnails=thumbnails
+)
+
+# 媒体预览请求复用的文件元数据（stat 和 MIME 类型）
+media_files = FileInfoCache()
+
+# 大文件和浏览器无法直接播放的视频按需切片为 HLS 预览
+hls_previews = HlsPreviewCache(
+    os.path.join("storage", "previews"),
+    max_bytes=int(os.getenv("PREVIEW_CACHE_MAX_MB", "5120")) * 1024 * 1024,
+    blob_store=blob_store,
+    media_index=media_index
+)
+
+# LLM 请求的并发、速率、超时、重试和对冲策略
+llm_scheduler = LLMScheduler(
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    rate=float(os.getenv("LLM_RATE_LIMIT", "0")),
+    timeout=float(os.getenv("LLM_REQUEST_TIMEOUT", "120")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+)
+
+# 剪切、合并、缩放的处理策略规划（流复制、智能剪切、编码预设），ENCODE_PLANNER_ENABLED=0 时全部交给 MCP 工具
+encode_planner = EncodePlanner(
+    profile=os.getenv("ENCODE_PROFILE", "balanced"),
+    encoder=os.getenv("ENCODE_VIDEO_ENCODER", "libx264"),
+    threads=int(os.getenv("ENCODE_THREADS", "0"))
+) if os.getenv("ENCODE_PLANNER_ENABLED", "1") != "0" else None
+
+# 初始化 FFmpeg MCP 客户端
+ffmpeg_client = FFmpegMCPClient(
+    tool_cache=tool_cache, plan_cache=plan_cache, llm_scheduler=llm_scheduler, encode_planner=encode_planner
+)
+
+# 任务状态和进度事件的共享存储：多 worker 部署时任何一个 worker 都能查询、订阅和取消任务，
+# JOB_STORE_ENABLED=0 时任务只在提交它的进程内可见
+job_store = JobStore(
+    os.path.join("storage", "jobs.sqlite3"),
+    max_events=int(os.getenv("JOB_EVENT_BUFFER", "1000"))
+) if os.getenv("JOB_STORE_ENABLED", "1") != "0" else None
+
+# 视频处理任务调度器，worker 数默认等于 CPU 核数
+job_scheduler = JobScheduler(
+    workers=int(os.getenv("JOB_WORKERS", "0")) or None,
+    max_events=int(os.getenv("JOB_EVENT_BUFFER", "1000")),
+    store=job_store
+)
+
+
+def _scheduler_metrics():
+    stats = job_scheduler.stats()
+    # 多 worker 部署时按所有 worker 的任务统计
+    jobs = stats.get("cluster", stats)
+    statuses = ("queued", "running")
+    return [
+        ("mcp_jobs", "任务队列中各状态的任务数（queued 即队列深度）", "gauge",
+         {(status,): jobs.get(status, 0) for status in statuses}, ["status"]),
+        ("mcp_job_workers", "任务队列的 worker 数", "gauge", {(): stats["workers"]}, []),
+    ]
+
+def _cache_metrics():
+    return [
+        ("mcp_cache_hits", "缓存命中次数", "counter",
+         {("tool",): tool_cache.hits, **({("plan",): plan_cache.hits} if plan_cache else {})}, ["cache"]),
+        ("mcp_cache_misses", "缓存未命中次数", "counter",
+         {("tool",): tool_cache.misses, **({("plan",): plan_cache.misses} if plan_cache else {})}, ["cache"]),
+    ]
+
+def _encode_metrics():
+    if encode_planner is None:
+        return []
+    return [
+        ("mcp_encode_plans", "剪切、合并、缩放按策略统计的执行次数（mcp 为交给 MCP 工具）", "counter",
+         encode_planner.stats(), ["tool", "strategy"]),
+    ]
+
+def _llm_metrics():
+    usage = ffmpeg_client.usage.snapshot()
+    stats = llm_scheduler.stats()
+    return [
+        ("mcp_llm_tokens", "LLM token 用量", "counter",
+         {("prompt",): usage["prompt_tokens"], ("completion",): usage["completion_tokens"],
+          ("cached",): usage["cached_tokens"]}, ["kind"]),
+        ("mcp_llm_requests", "LLM 补全请求的结果", "counter",
+         {(kind,): stats[kind] for kind in ("requests", "retries", "hedges", "hedge_wins", "timeouts", "failures")},
+         ["kind"]),
+        ("mcp_llm_in_flight", "正在进行的 LLM 请求数", "gauge", {(): stats["in_flight"]}, []),
+        ("mcp_llm_waiting", "等待并发名额的 LLM 请求数", "gauge", {(): stats["waiting"]}, []),
+    ]
+
+def _pool_metrics():
+    pool = ffmpeg_client.pool
+    if pool is None:
+        return []
+    return [
+        ("mcp_bridge_sessions", "桥接会话池中的会话数", "gauge",
+         {("total",): pool.size, ("idle",): pool.idle}, ["state"]),
+    ]
+
+metrics.register_sources(_scheduler_metrics, _cache_metrics, _encode_metrics, _llm_metrics, _pool_metrics)
+metrics.install_log_context()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动和关闭常驻桥接会话池"""
+    # 后台收录存储启用前已存在的文件
+    for directory in ("uploads", "outputs"):
+        _schedule_adoption(directory)
+    await job_scheduler.start()
+    await ffmpeg_client.start_pool(
+        min_size=int(os.getenv("BRIDGE_POOL_MIN_SIZE", "1")),
+        max_size=int(os.getenv("BRIDGE_POOL_MAX_SIZE", "4")),
+        max_requests=int(os.getenv("BRIDGE_POOL_MAX_REQUESTS", "100")),
+        health_check_interval=float(os.getenv("BRIDGE_POOL_HEALTH_CHECK_INTERVAL", "30"))
+    )
+    try:
+        yield
+    finally:
+        # 平滑退出：等待已接收的任务执行完毕，超时后再取消
+        await job_scheduler.drain(float(os.getenv("JOB_DRAIN_TIMEOUT", "30")))
+        await job_scheduler.close()
+        await hls_previews.close()
+        await ffmpeg_client.close()
+        metrics.mark_process_dead()
+
+
+app = FastAPI(title="FFmpeg MCP 智能视频处理助手", version="1.0.0", lifespan=lifespan)
 
 # 添加 CORS 中间件
 app.add_middleware(
@@ -27,40 +216,179 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 请求 ID 和请求级指标，放在最外层以覆盖整个请求
+app.add_middleware(metrics.RequestMetricsMiddleware)
+
+# 上传大小限制（字节），0 表示不限制
+MAX_UPLOAD_SIZE = get_max_upload_size()
+
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """在读取请求体之前根据 Content-Length 拒绝超限的上传"""
+    if MAX_UPLOAD_SIZE and request.url.path.startswith("/api/upload"):
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": str(UploadTooLargeError(MAX_UPLOAD_SIZE))}
+            )
+    return await call_next(request)
 
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# 创建上传目录
-os.makedirs("uploads", exist_ok=True)
-os.makedirs("outputs", exist_ok=True)
+# 正在进行的后台任务，保留引用避免被回收
+_background_tasks = set()
+_probe_task = None
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _adopt_and_index(directory):
+    blob_store.adopt_dir(directory)
+    media_index.rescan(force=True)
+
+
+async def _adopt_dir(directory):
+    await asyncio.to_thread(_adopt_and_index, directory)
+    _schedule_probe()
 
-# 初始化 FFmpeg MCP 客户端
-ffmpeg_client = FFmpegMCPClient()
+
+def _schedule_adoption(directory):
+    """在后台把目录中的新文件（如 FFmpeg 输出）收录进内容寻址存储并更新元数据索引"""
+    _spawn(_adopt_dir(directory))
+
+
+async def _probe_pending():
+    while await asyncio.to_thread(media_index.probe_pending):
+        pass
+
+
+def _schedule_probe():
+    """在后台为新文件读取媒体信息、生成缩略图，同一时间只运行一个"""
+    global _probe_task
+    if _probe_task is None or _probe_task.done():
+        _probe_task = _spawn(_probe_pending())
+
+
+async def _index_file(path, sha256=None):
+    """上传完成后立即登记到元数据索引"""
+    media_files.invalidate(path)
+    await asyncio.to_thread(media_index.refresh, path, sha256)
+    _schedule_probe()
+
+
+def _user_file_path(file_type, filename):
+    """根据文件类型得到用户文件路径，只允许访问 uploads/ 和 outputs/ 下的文件"""
+    if file_type == "upload":
+        directory = "uploads"
+    elif file_type == "output":
+        directory = "outputs"
+    else:
+        raise HTTPException(status_code=400, detail="无效的文件类型")
+    if not filename or os.path.basename(filename) != filename or filename.startswith("."):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    return os.path.join(directory, filename)
+
+# 支持上传的视频格式
+ALLOWED_VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm']
 
 # 请求模型
 class VideoRequest(BaseModel):
     message: str
     video_path: Optional[str] = None
+    # 为 False 时不使用计划缓存，始终由 LLM 规划
+    use_plan_cache: bool = True
+
+class JobRequest(VideoRequest):
+    priority: int = Field(default=0, ge=-10, le=10)
+
+class BatchSelection(BaseModel):
+    type: str = "upload"
+    q: Optional[str] = None
+    kind: Optional[str] = None
+    since: Optional[float] = None
+    until: Optional[float] = None
+
+class BatchRequest(BaseModel):
+    tool: str
+    parameters: Dict[str, Any] = {}
+    files: List[str] = []
+    selection: Optional[BatchSelection] = None
+    concurrency: int = Field(default=4, ge=1, le=32)
+    priority: int = Field(default=0, ge=-10, le=10)
 
-class VideoClipRequest(BaseModel):
+class PipelineStep(BaseModel):
+    id: str
+    op: str
+    inputs: List[str]
+    params: Dict[str, Any] = {}
+
+class PipelineRequest(BaseModel):
+    inputs: Dict[str, str]
+    steps: List[PipelineStep]
+    outputs: Dict[str, str]
+    priority: int = Field(default=0, ge=-10, le=10)
+
+class ResumableUploadRequest(BaseModel):
+    filename: str
+    size: int
+    chunk_size: Optional[int] = None
+    sha256: Optional[str] = Field(default=None, pattern=r"^[0-9a-fA-F]{64}$")
+
+class EncodeOptions(BaseModel):
+    # 编码预设 draft / fast / balanced / quality，为空时使用 ENCODE_PROFILE
+    profile: Optional[str] = None
+    # 处理策略 auto / copy / smart / encode，为空时自动选择
+    strategy: Optional[str] = None
+
+class VideoClipRequest(EncodeOptions):
     video_path: str
     start: Optional[str] = None
     end: Optional[str] = None
     duration: Optional[str] = None
     output_path: Optional[str] = None
 
-class VideoConcatRequest(BaseModel):
+class VideoConcatRequest(EncodeOptions):
     input_files: List[str]
     output_path: Optional[str] = None
+    # 为 False 时不做流复制，始终重新编码
     fast: bool = True
 
-class VideoScaleRequest(BaseModel):
+class VideoScaleRequest(EncodeOptions):
     video_path: str
     width: str
     height: str
     output_path: Optional[str] = None
 
+class VideoInfoRequest(BaseModel):
+    video_path: str
+
+class VideoOverlayRequest(BaseModel):
+    background_video: str
+    overlay_video: str
+    position: Optional[str] = None
+    dx: Optional[int] = None
+    dy: Optional[int] = None
+    output_path: Optional[str] = None
+
+class AudioExtractRequest(BaseModel):
+    video_path: str
+    output_path: Optional[str] = None
+    audio_format: str = "mp3"
+
+class FrameExtractRequest(BaseModel):
+    video_path: str
+    fps: Optional[float] = None
+    output_folder: Optional[str] = None
+    format: Optional[str] = None
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
     """返回主页面"""
@@ -81,122 +409,318 @@ async def get_tools():
         logger.error(f"获取工具列表失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _resolve_media_path(path):
+    """把客户端传入的文件路径或文件名解析为 uploads/ 或 outputs/ 下的绝对路径"""
+    if os.path.isabs(path):
+        candidates = [path]
+    else:
+        candidates = [os.path.join("uploads", path), os.path.join("outputs", path), path]
+    roots = [os.path.realpath(d) + os.sep for d in ("uploads", "outputs")]
+    for candidate in candidates:
+        full_path = os.path.realpath(candidate)
+        if any(full_path.startswith(root) for root in roots) and os.path.isfile(full_path):
+            return full_path
+    raise HTTPException(status_code=404, detail=f"文件不存在: {path}")
+
+def _resolve_output_path(output_path, video_path, tag, extension=None):
+    """
+    确定输出位置：只取客户端指定的文件名，统一放到 outputs/ 下；
+    未指定时根据输入文件名和操作参数生成确定的名称，便于命中工具缓存
+    """
+    if output_path:
+        name = os.path.basename(output_path)
+        if not name or name.startswith("."):
+            raise HTTPException(status_code=400, detail="无效的输出文件名")
+    else:
+        stem, ext = os.path.splitext(os.path.basename(video_path))
+        tag = re.sub(r"[^\w.-]+", "-", tag).strip("-")
+        name = f"{stem}_{tag}{extension if extension is not None else ext}"
+    return os.path.abspath(os.path.join("outputs", name))
+
+def _user_id(request):
+    """任务调度时区分用户：优先使用 X-User-Id 请求头，否则使用客户端地址"""
+    user = request.headers.get("x-user-id")
+    if user:
+        return user[:64]
+    return request.client.host if request.client else "anonymous"
+
+async def _run_tool(tool_name, arguments, user="anonymous"):
+    """通过任务队列直接执行 MCP 工具并返回统一格式的结果"""
+    async def work(job):
+        return await ffmpeg_client.call_tool(tool_name, arguments, on_progress=job.publish)
+
+    job = job_scheduler.submit(work, user=user, kind="tool", description=tool_name)
+    try:
+        result = await job.wait()
+        _schedule_adoption("outputs")
+        return {"tool": tool_name, "arguments": arguments, "result": result, "success": True}
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except JobCancelledError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ToolCallError as e:
+        logger.error(f"工具 {tool_name} 执行失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        logger.error(f"工具 {tool_name} 调用失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _encode_options(request, arguments):
+    """把请求中的编码预设和处理策略加入工具参数，规划器未启用时忽略"""
+    arguments.pop("profile", None)
+    arguments.pop("strategy", None)
+    if encode_planner is None:
+        return arguments
+    if request.profile is not None:
+        if request.profile not in ENCODER_PROFILES:
+            raise HTTPException(status_code=400, detail=f"未知的编码预设: {request.profile}")
+        arguments["profile"] = request.profile
+    if request.strategy is not None:
+        if request.strategy not in STRATEGIES:
+            raise HTTPException(status_code=400, detail=f"未知的处理策略: {request.strategy}")
+        arguments["strategy"] = request.strategy
+    return arguments
+
+@app.post("/api/info")
+async def video_info(request: VideoInfoRequest, http_request: Request):
+    """直接获取视频信息"""
+    return await _run_tool("get_video_info", {
+        "video_path": _resolve_media_path(request.video_path)
+    }, _user_id(http_request))
+
+@app.post("/api/clip")
+async def clip_video(request: VideoClipRequest, http_request: Request):
+    """直接剪切视频，不经过 LLM"""
+    video_path = _resolve_media_path(request.video_path)
+    tag = f"clip_{request.start or 0}_{request.end or request.duration or 'end'}"
+    arguments = request.model_dump(exclude_none=True)
+    arguments["video_path"] = video_path
+    arguments["output_path"] = _resolve_output_path(request.output_path, video_path, tag)
+    return await _run_tool("clip_video", _encode_options(request, arguments), _user_id(http_request))
+
+@app.post("/api/concat")
+async def concat_videos(request: VideoConcatRequest, http_request: Request):
+    """直接合并多个视频，不经过 LLM"""
+    if len(request.input_files) < 2:
+        raise HTTPException(status_code=400, detail="至少需要两个视频文件")
+    input_files = [_resolve_media_path(path) for path in request.input_files]
+    return await _run_tool("concat_videos", _encode_options(request, {
+        "input_files": input_files,
+        "output_path": _resolve_output_path(request.output_path, input_files[0], "concat"),
+        "fast": request.fast
+    }), _user_id(http_request))
+
+@app.post("/api/scale")
+async def scale_video(request: VideoScaleRequest, http_request: Request):
+    """直接缩放视频，不经过 LLM"""
+    video_path = _resolve_media_path(request.video_path)
+    tag = f"{request.width}x{request.height}"
+    return await _run_tool("scale_video", _encode_options(request, {
+        "video_path": video_path,
+        "width": request.width,
+        "height": request.height,
+        "output_path": _resolve_output_path(request.output_path, video_path, tag)
+    }), _user_id(http_request))
+
+@app.post("/api/overlay")
+async def overlay_video(request: VideoOverlayRequest, http_request: Request):
+    """直接叠加视频（画中画），不经过 LLM"""
+    arguments = request.model_dump(exclude_none=True)
+    arguments["background_video"] = _resolve_media_path(request.background_video)
+    arguments["overlay_video"] = _resolve_media_path(request.overlay_video)
+    arguments["output_path"] = _resolve_output_path(
+        request.output_path, arguments["background_video"], "overlay"
+    )
+    return await _run_tool("overlay_video", arguments, _user_id(http_request))
+
+@app.post("/api/extract-audio")
+async def extract_audio(request: AudioExtractRequest, http_request: Request):
+    """直接提取音频，不经过 LLM"""
+    video_path = _resolve_media_path(request.video_path)
+    audio_format = request.audio_format.lstrip(".").lower()
+    return await _run_tool("extract_audio_from_video", {
+        "video_path": video_path,
+        "audio_format": audio_format,
+        "output_path": _resolve_output_path(
+            request.output_path, video_path, "audio", f".{audio_format}"
+        )
+    }, _user_id(http_request))
+
+@app.post("/api/extract-frames")
+async def extract_frames(request: FrameExtractRequest, http_request: Request):
+    """直接提取视频帧，不经过 LLM"""
+    arguments = request.model_dump(exclude_none=True)
+    arguments["video_path"] = _resolve_media_path(request.video_path)
+    arguments["output_folder"] = _resolve_output_path(
+        request.output_folder, arguments["video_path"], f"frames_{request.fps or 'default'}", ""
+    )
+    return await _run_tool("extract_frames_from_video", arguments, _user_id(http_request))
+
+@app.post("/api/tools/{tool_name}")
+async def call_tool(tool_name: str, arguments: Dict[str, Any], http_request: Request):
+    """
+    按名称直接调用工具
+
+    只开放输入输出参数已知的 FFmpeg 工具：输入文件限定在 uploads/ 和 outputs/ 下，
+    输出统一放到 outputs/，与各个专用接口一致。
+    """
+    spec = CACHEABLE_TOOLS.get(tool_name)
+    if spec is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"不支持直接调用的工具: {tool_name}，可用: {', '.join(CACHEABLE_TOOLS)}"
+        )
+    arguments = dict(arguments)
+    first_input = None
+    for name in spec["inputs"]:
+        value = arguments.get(name)
+        if isinstance(value, list) and value and all(isinstance(p, str) for p in value):
+            arguments[name] = [_resolve_media_path(p) for p in value]
+        elif isinstance(value, str) and value:
+            arguments[name] = _resolve_media_path(value)
+        else:
+            raise HTTPException(status_code=400, detail=f"缺少或无效的输入参数: {name}")
+        if first_input is None:
+            first_input = arguments[name][0] if isinstance(arguments[name], list) else arguments[name]
+    if spec["output"]:
+        output = arguments.get(spec["output"])
+        if output is not None and not isinstance(output, str):
+            raise HTTPException(status_code=400, detail=f"无效的输出参数: {spec['output']}")
+        arguments[spec["output"]] = _resolve_output_path(
+            output, first_input, tool_name, "" if spec["output"] == "output_folder" else None
+        )
+    return await _run_tool(tool_name, arguments, _user_id(http_request))
+
+@app.get("/api/encode/profiles")
+async def encode_profiles():
+    """可用的编码预设、处理策略、使用的视频编码器和各策略的执行次数"""
+    if encode_planner is None:
+        raise HTTPException(status_code=404, detail="处理策略规划未启用")
+    profiles = await asyncio.to_thread(encode_planner.profiles)
+    stats = [
+        {"tool": tool, "strategy": strategy, "count": count}
+        for (tool, strategy), count in encode_planner.stats().items()
+    ]
+    return {**profiles, "stats": stats}
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """工具结果缓存和计划缓存的命中统计"""
+    stats = {"tool_cache": await asyncio.to_thread(tool_cache.stats)}
+    stats["plan_cache"] = await asyncio.to_thread(plan_cache.stats) if plan_cache else None
+    return stats
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 指标，METRICS_ENABLED=0 时不可用"""
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="指标未启用")
+    content, content_type = await asyncio.to_thread(metrics.render)
+    return Response(content=content, media_type=content_type)
+
+@app.get("/api/llm/usage")
+async def llm_usage():
+    """LLM token 用量的累计统计和请求调度状态，用于对比提示词版本和前缀缓存的效果"""
+    return {
+        "prompt_variant": ffmpeg_client.prompt_variant,
+        **ffmpeg_client.usage.snapshot(),
+        "scheduler": llm_scheduler.stats(),
+    }
+
+def _submit_process_job(message, user, priority=0, use_plan_cache=True):
+    """
+    提交一个经过 LLM 的视频处理任务，模型输出和工具调用作为任务事件实时发布
+
+    与 LLM 的对话大部分时间在等待模型响应，不占用 worker；其中的每次工具调用
+    作为子任务提交到任务队列，与其他 FFmpeg 处理一起受 worker 数限制。
+    """
+    async def work(job):
+        async def run_tool(tool_name, call):
+            child = job_scheduler.submit(
+                lambda _: call(), user=job.user, priority=job.priority, kind="tool", description=tool_name
+            )
+            try:
+                return await child.wait()
+            finally:
+                # 处理任务被取消时一并取消排队或运行中的工具调用
+                job_scheduler.cancel(child.id)
+
+        tool_runner.set(run_tool)
+        with metrics.span("process_request"):
+            return await run(job)
+
+    async def run(job):
+        chunks = []
+        async for event in ffmpeg_client.stream_video_request(message, use_plan_cache=use_plan_cache):
+            if event["type"] == "response_chunk" and not chunks:
+                # 第一段回复到达：结束思考过程，创建结果区域
+                job.publish({"type": "thinking_end"})
+                job.publish({"type": "response_start"})
+            if event["type"] == "response_chunk":
+                chunks.append(event["content"])
+            job.publish(event)
+        if not chunks:
+            job.publish({"type": "thinking_end"})
+            job.publish({"type": "response_start"})
+        job.publish({"type": "response_end"})
+        _schedule_adoption("outputs")
+        return "".join(chunks).strip()
+
+    return job_scheduler.run_detached(work, user=user, priority=priority, kind="process", description=message)
+
+def _sse(data, event_id=None):
+    if event_id is None:
+        return f"data: {json.dumps(data)}\n\n"
+    return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+
 @app.post("/api/process")
-async def process_video_request(request: VideoRequest):
+async def process_video_request(request: VideoRequest, http_request: Request):
     """处理视频相关请求"""
     try:
-        response = await ffmpeg_client.process_video_request(request.message)
-        return {"response": response, "success": True}
+        job = _submit_process_job(request.message, _user_id(http_request), use_plan_cache=request.use_plan_cache)
+        response = await job.wait()
+        return {"response": response, "job_id": job.id, "success": True}
+    except JobCancelledError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         logger.error(f"处理请求失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/process-stream")
-async def process_video_request_stream(request: VideoRequest):
-    """流式处理视频相关请求"""
-    
-    # 创建一个队列来存储进度消息
-    progress_queue = asyncio.Queue()
-    thinking_content = []  # 存储思考过程内容
-    
-    async def progress_callback(message):
-        await progress_queue.put(message)
-        # 如果是思考过程，单独存储
-        if message.startswith("💭 AI思考过程："):
-            thinking_content.append(message[8:])  # 移除前缀
-    
-    async def generate_stream():
-        try:
+async def _stream_job(job, last_event_id=0):
+    """
+    把任务事件实时转换为 SSE 流，事件带有编号，断线后可通过 Last-Event-ID 续传
+
+    Args:
+        job: 任务
+        last_event_id: 客户端已收到的最后一条事件编号
+    """
+    try:
+        if not last_event_id:
             # 发送开始处理的消息
             start_msg = "🚀 开始处理您的请求..."
-            yield f"data: {json.dumps({'type': 'start', 'message': start_msg})}\n\n"
-            await asyncio.sleep(0.1)
-            
-            # 启动处理任务
-            process_task = asyncio.create_task(
-                ffmpeg_client.process_video_request_with_details(
-                    request.message, 
-                    progress_callback
-                )
-            )
-            
-            # 监听进度消息
-            while not process_task.done():
-                try:
-                    # 等待进度消息，设置超时避免阻塞
-                    message = await asyncio.wait_for(
-                        progress_queue.get(), 
-                        timeout=0.1
-                    )
-                    
-                    # 区分思考过程和普通进度消息
-                    if message.startswith("💭 AI思考过程："):
-                        # 发送思考过程消息
-                        thinking_data = {
-                            'type': 'thinking', 
-                            'message': message[8:]  # 移除前缀
-                        }
-                        yield f"data: {json.dumps(thinking_data)}\n\n"
-                    else:
-                        # 发送普通进度消息
-                        progress_data = {'type': 'progress', 'message': message}
-                        yield f"data: {json.dumps(progress_data)}\n\n"
-                        
-                except asyncio.TimeoutError:
-                    # 没有新的进度消息，继续等待
-                    continue
-            
-            # 获取最终结果
-            response = await process_task
-            
-            # 处理队列中剩余的消息
-            while not progress_queue.empty():
-                message = await progress_queue.get()
-                if message.startswith("💭 AI思考过程："):
-                    thinking_data = {
-                        'type': 'thinking', 
-                        'message': message[8:]
-                    }
-                    yield f"data: {json.dumps(thinking_data)}\n\n"
-                else:
-                    progress_data = {'type': 'progress', 'message': message}
-                    yield f"data: {json.dumps(progress_data)}\n\n"
-            
-            # 发送思考过程完成信号
-            yield f"data: {json.dumps({'type': 'thinking_end'})}\n\n"
-            
-            # 开始流式发送最终响应
-            yield f"data: {json.dumps({'type': 'response_start'})}\n\n"
-            
-            # 将响应按句子分割并逐步发送
-            sentences = response.split('。')
-            for i, sentence in enumerate(sentences):
-                if sentence.strip():
-                    # 添加句号（除了最后一句）
-                    if i < len(sentences) - 1:
-                        sentence += '。'
-                    
-                    stream_data = {
-                        'type': 'response_chunk', 
-                        'content': sentence
-                    }
-                    yield f"data: {json.dumps(stream_data)}\n\n"
-                    await asyncio.sleep(0.3)  # 控制显示速度
-            
-            # 发送完成消息
-            yield f"data: {json.dumps({'type': 'response_end'})}\n\n"
-            yield f"data: {json.dumps({'type': 'end'})}\n\n"
-            
-        except Exception as e:
-            logger.error(f"流式处理请求失败: {e}")
-            error_msg = f"处理失败: {str(e)}"
-            error_data = {'type': 'error', 'message': error_msg}
-            yield f"data: {json.dumps(error_data)}\n\n"
-            yield f"data: {json.dumps({'type': 'end'})}\n\n"
-    
+            yield _sse({'type': 'start', 'message': start_msg, 'job_id': job.id})
+
+            position = job_scheduler.queue_position(job)
+            if position:
+                yield _sse({'type': 'progress', 'message': f"⏳ 排队中，前面还有 {position} 个任务"})
+
+        async for event_id, event in job.subscribe(last_event_id):
+            yield _sse(event, event_id)
+
+        # 任务失败或被取消时抛出异常
+        await job.wait()
+        yield _sse({'type': 'end'})
+
+    except Exception as e:
+        logger.error(f"流式处理请求失败: {e}")
+        error_msg = f"处理失败: {str(e)}"
+        yield _sse({'type': 'error', 'message': error_msg})
+        yield _sse({'type': 'end'})
+
+def _event_stream_response(generator):
     return StreamingResponse(
-        generate_stream(),
+        generator,
         media_type="text/plain",
         headers={
             "Cache-Control": "no-cache",
@@ -205,170 +729,498 @@ async def process_video_request_stream(request: VideoRequest):
         }
     )
 
+@app.post("/api/process-stream")
+async def process_video_request_stream(request: VideoRequest, http_request: Request):
+    """流式处理视频相关请求：提交任务后订阅其进度，客户端断开不影响任务继续执行"""
+    job = _submit_process_job(request.message, _user_id(http_request), use_plan_cache=request.use_plan_cache)
+    return _event_stream_response(_stream_job(job))
+
+def _get_job(job_id):
+    job = job_scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(request: JobRequest, http_request: Request):
+    """提交视频处理任务，立即返回任务 ID"""
+    job = _submit_process_job(
+        request.message, _user_id(http_request), request.priority, request.use_plan_cache
+    )
+    return {**job.to_dict(), "queue_position": job_scheduler.queue_position(job)}
+
+@app.get("/api/jobs")
+async def list_jobs(http_request: Request):
+    """列出当前用户的任务和调度器状态"""
+    user = _user_id(http_request)
+    jobs = [job.to_dict() for job in job_scheduler.list_jobs(user)]
+    return {"jobs": jobs, "scheduler": job_scheduler.stats()}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询任务状态"""
+    job = _get_job(job_id)
+    return {**job.to_dict(), "queue_position": job_scheduler.queue_position(job)}
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """获取任务结果，任务未结束时返回 202"""
+    job = _get_job(job_id)
+    if not job.done:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    try:
+        response = await job.wait()
+    except JobCancelledError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"job_id": job.id, "response": response, "success": True}
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, http_request: Request, last_event_id: int = 0):
+    """订阅任务进度（SSE），可在任务执行中途或结束后订阅，支持 Last-Event-ID 续传"""
+    job = _get_job(job_id)
+    header = http_request.headers.get("last-event-id", "")
+    if header.isdigit():
+        last_event_id = int(header)
+    return _event_stream_response(_stream_job(job, last_event_id))
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """取消排队中或运行中的任务"""
+    job = _get_job(job_id)
+    if not job_scheduler.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"任务已结束: {job.status}")
+    return {"job_id": job_id, "success": True}
+
+def _select_files(selection):
+    """按文件列表的过滤条件从元数据索引中选出文件"""
+    if selection.type not in ("upload", "output"):
+        raise HTTPException(status_code=400, detail="无效的文件类型")
+    media_index.rescan()
+    paths = []
+    cursor = None
+    while True:
+        files, cursor = media_index.page(
+            selection.type, 1000, "name", "asc", selection.q, selection.kind,
+            selection.since, selection.until, cursor
+        )
+        paths.extend(f["path"] for f in files)
+        if not cursor:
+            return paths
+
+async def _submit_batch(request, user):
+    """规划批处理并提交协调任务，每个文件作为子任务进入任务队列"""
+    if request.tool not in ffmpeg_client.get_tool_names():
+        raise HTTPException(status_code=404, detail=f"未知的工具: {request.tool}")
+    inputs = list(request.files)
+    if request.selection is not None:
+        inputs.extend(await asyncio.to_thread(_select_files, request.selection))
+    try:
+        items = plan_batch(request.tool, request.parameters, inputs, _resolve_media_path)
+    except BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def work(job):
+        try:
+            return await run_batch(
+                job, request.tool, items, job_scheduler, ffmpeg_client.call_tool, request.concurrency
+            )
+        finally:
+            _schedule_adoption("outputs")
+
+    job = job_scheduler.run_detached(
+        work, user=user, priority=request.priority, kind="batch",
+        description=f"{request.tool} × {len(items)}"
+    )
+    return job, items
+
+@app.post("/api/batch", status_code=202)
+async def submit_batch(request: BatchRequest, http_request: Request):
+    """对多个文件批量执行同一个工具，立即返回任务 ID，进度通过 /api/jobs/{job_id}/events 订阅"""
+    job, items = await _submit_batch(request, _user_id(http_request))
+    return {**job.to_dict(), "total": len(items), "items": items}
+
+@app.post("/api/batch-stream")
+async def submit_batch_stream(request: BatchRequest, http_request: Request):
+    """批量执行工具并以 SSE 推送每个文件的进度和最终汇总"""
+    job, _ = await _submit_batch(request, _user_id(http_request))
+    return _event_stream_response(_stream_job(job))
+
+def _source_info(path):
+    """流水线输入的流和时长信息，优先使用元数据索引"""
+    info = media_index.get(path)
+    if not info or not (info.get("video_codec") or info.get("audio_codec")):
+        info = probe(path, shutil.which("ffprobe") or "ffprobe")
+    if not info:
+        raise HTTPException(status_code=400, detail=f"无法读取媒体信息: {os.path.basename(path)}")
+    return {
+        "has_video": bool(info.get("video_codec")),
+        "has_audio": bool(info.get("audio_codec")),
+        "duration": info.get("duration"),
+    }
+
+async def _submit_pipeline(request, user):
+    """把流水线编译为一条 FFmpeg 命令并作为任务提交，只有最终输出会写入 outputs 目录"""
+    inputs = {name: _resolve_media_path(path) for name, path in request.inputs.items()}
+    sources = {}
+    for name, path in inputs.items():
+        sources[name] = await asyncio.to_thread(_source_info, path)
+    spec = {
+        "inputs": inputs,
+        "steps": [step.model_dump() for step in request.steps],
+        "outputs": request.outputs,
+    }
+    try:
+        plan = compile_pipeline(spec, sources, "outputs", shutil.which("ffmpeg") or "ffmpeg")
+    except PipelineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def work(job):
+        try:
+            with metrics.ffmpeg_running("pipeline"), metrics.span("pipeline"):
+                outputs = await run_pipeline(plan, on_progress=job.publish)
+            names = [os.path.basename(p) for p in outputs]
+            job.publish({"type": "pipeline_outputs", "outputs": names})
+            return {"outputs": names}
+        finally:
+            _schedule_adoption("outputs")
+
+    job = job_scheduler.submit(
+        work, user=user, priority=request.priority, kind="pipeline",
+        description=f"pipeline: {len(request.steps)} 步 → {', '.join(request.outputs.values())}"
+    )
+    return job, plan
+
+@app.post("/api/pipeline", status_code=202)
+async def submit_pipeline(request: PipelineRequest, http_request: Request):
+    """提交多步骤流水线，所有步骤融合为一次 FFmpeg 调用，进度通过 /api/jobs/{job_id}/events 订阅"""
+    job, plan = await _submit_pipeline(request, _user_id(http_request))
+    return {
+        **job.to_dict(),
+        "outputs": {sid: os.path.basename(final) for sid, (_, final) in plan.outputs.items()},
+    }
+
+@app.post("/api/pipeline-stream")
+async def submit_pipeline_stream(request: PipelineRequest, http_request: Request):
+    """执行流水线并以 SSE 推送 FFmpeg 进度和输出文件"""
+    job, _ = await _submit_pipeline(request, _user_id(http_request))
+    return _event_stream_response(_stream_job(job))
+
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
     """上传视频文件"""
     try:
         # 检查文件类型
-        allowed_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm']
-        file_extension = os.path.splitext(file.filename)[1].lower()
+        filename = _validate_upload_filename(file.filename)
         
-        if file_extension not in allowed_extensions:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"不支持的文件格式。支持的格式: {', '.join(allowed_extensions)}"
-            )
+        if MAX_UPLOAD_SIZE and file.size and file.size > MAX_UPLOAD_SIZE:
+            raise UploadTooLargeError(MAX_UPLOAD_SIZE)
         
-        # 保存文件
-        file_path = os.path.join("uploads", file.filename)
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        # 分块流式写入临时文件，再按内容哈希存入 blob 存储
+        file_path = os.path.join("uploads", filename)
+        stored = await stream_upload_to_temp(file, blob_store.tmp_dir, max_size=MAX_UPLOAD_SIZE)
+        deduplicated = await asyncio.to_thread(
+            blob_store.ingest, stored.path, stored.sha256, file_path
+        )
+        await _index_file(file_path, stored.sha256)
         
         return {
-            "filename": file.filename,
+            "filename": filename,
             "file_path": file_path,
-            "size": len(content),
+            "size": stored.size,
+            "sha256": stored.sha256,
+            "deduplicated": deduplicated,
             "success": True
         }
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"文件上传失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/files")
-async def list_files():
-    """列出上传的文件"""
+def _validate_upload_filename(filename):
+    """去除路径部分并检查文件类型，返回安全的文件名"""
+    filename = os.path.basename(filename or "")
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension not in ALLOWED_VIDEO_EXTENSIONS:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"不支持的文件格式。支持的格式: {', '.join(ALLOWED_VIDEO_EXTENSIONS)}"
+        )
+    return filename
+
+@app.post("/api/uploads", status_code=201)
+async def create_resumable_upload(request: ResumableUploadRequest):
+    """创建断点续传上传会话"""
+    filename = _validate_upload_filename(request.filename)
+    if MAX_UPLOAD_SIZE and request.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=str(UploadTooLargeError(MAX_UPLOAD_SIZE)))
+    if request.sha256 and blob_store.has(request.sha256.lower()):
+        # 内容已存在，无需上传任何数据
+        file_path = os.path.join("uploads", filename)
+        await asyncio.to_thread(blob_store.link, request.sha256.lower(), file_path)
+        await _index_file(file_path, request.sha256.lower())
+        return {
+            "filename": filename,
+            "file_path": file_path,
+            "size": request.size,
+            "sha256": request.sha256.lower(),
+            "deduplicated": True,
+            "complete": True,
+            "success": True
+        }
     try:
-        uploads_dir = "uploads"
-        outputs_dir = "outputs"
-        
-        uploaded_files = []
-        output_files = []
-        
-        if os.path.exists(uploads_dir):
-            for filename in os.listdir(uploads_dir):
-                file_path = os.path.join(uploads_dir, filename)
-                if os.path.isfile(file_path):
-                    uploaded_files.append({
-                        "name": filename,
-                        "path": os.path.abspath(file_path),  # 返回绝对路径
-                        "size": os.path.getsize(file_path)
-                    })
+        return await resumable_uploads.create(
+            filename, request.size, request.chunk_size, request.sha256
+        )
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request):
+    """上传一个分块，可乱序并行上传，重复上传同一分块会覆盖"""
+    offset = request.headers.get("upload-offset")
+    try:
+        return await resumable_uploads.write_chunk(
+            upload_id,
+            index,
+            request.stream(),
+            checksum=request.headers.get("x-chunk-sha256"),
+            offset=int(offset) if offset is not None else None
+        )
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 Upload-Offset")
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload_status(upload_id: str):
+    """查询断点续传进度"""
+    try:
+        return await asyncio.to_thread(resumable_uploads.status, upload_id)
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    """校验所有分块并将文件移动到 uploads 目录"""
+    try:
+        state = await asyncio.to_thread(resumable_uploads.status, upload_id)
+        file_path = os.path.join("uploads", state["filename"])
+        deduplicated = False
         
-        if os.path.exists(outputs_dir):
-            for filename in os.listdir(outputs_dir):
-                file_path = os.path.join(outputs_dir, filename)
-                if os.path.isfile(file_path):
-                    output_files.append({
-                        "name": filename,
-                        "path": os.path.abspath(file_path),  # 返回绝对路径
-                        "size": os.path.getsize(file_path)
-                    })
+        def commit(part_path, digest):
+            nonlocal deduplicated
+            deduplicated = blob_store.ingest(part_path, digest, file_path)
+            return file_path
         
+        stored = await resumable_uploads.finalize(upload_id, commit)
+        await _index_file(file_path, stored.sha256)
         return {
-            "uploaded_files": uploaded_files,
-            "output_files": output_files
+            "filename": state["filename"],
+            "file_path": file_path,
+            "size": stored.size,
+            "sha256": stored.sha256,
+            "deduplicated": deduplicated,
+            "success": True
         }
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.delete("/api/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    """取消断点续传上传"""
+    try:
+        await resumable_uploads.abort(upload_id)
+        return {"message": "上传已取消", "success": True}
+    except ResumableUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+def _etag_matches(request, etag):
+    """If-None-Match 是否命中（弱比较）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    strip = lambda tag: tag.strip().removeprefix("W/")
+    return strip(etag) in (strip(tag) for tag in header.split(","))
+
+@app.get("/api/files")
+async def list_files(
+    request: Request,
+    type: Optional[str] = None,
+    limit: int = 500,
+    cursor: Optional[str] = None,
+    sort: str = "name",
+    order: str = "asc",
+    q: Optional[str] = None,
+    kind: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None
+):
+    """
+    分页列出文件，数据来自元数据索引
+
+    参数 type 为 upload / output 时只返回对应列表；sort 可选 name / size / mtime / duration，
+    q 按文件名过滤，kind 按类别（video / audio / image / other）过滤，since / until 按修改时间
+    （Unix 秒）过滤。下一页使用返回的 next_cursor（需同时指定 type）。
+    响应带有弱 ETag，索引未变化时对 If-None-Match 返回 304。
+    """
+    if type not in (None, "upload", "output"):
+        raise HTTPException(status_code=400, detail="无效的文件类型")
+    if cursor and not type:
+        raise HTTPException(status_code=400, detail="使用分页游标时需要指定 type")
+    if sort not in ("name", "size", "mtime", "duration") or order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="无效的排序参数")
+    limit = max(1, min(limit, 1000))
+    try:
+        # 目录未变化时只比较一次目录 mtime
+        if await asyncio.to_thread(media_index.rescan):
+            _schedule_probe()
+        
+        # 索引版本加上查询参数即可确定响应内容
+        version = await asyncio.to_thread(media_index.version)
+        query_hash = hashlib.sha1(str(request.url.query).encode("utf-8")).hexdigest()[:12]
+        etag = f'W/"{version}-{query_hash}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        
+        result = {}
+        for file_type, key in (("upload", "uploaded_files"), ("output", "output_files")):
+            if type and type != file_type:
+                continue
+            files, next_cursor = await asyncio.to_thread(
+                media_index.page, file_type, limit, sort, order, q, kind, since, until, cursor
+            )
+            result[key] = files
+            result[f"{key}_next_cursor"] = next_cursor
+        return JSONResponse(content=result, headers=headers)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"获取文件列表失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/thumbnails/{key}/{name}")
+async def get_thumbnail(key: str, name: str):
+    """返回封面图（poster.jpg）、进度条预览雪碧图（sprite.jpg）或其 WebVTT 索引（sprite.vtt）"""
+    if name not in ("poster.jpg", "sprite.jpg", "sprite.vtt"):
+        raise HTTPException(status_code=400, detail="无效的缩略图名称")
+    path = thumbnails.file_path(key, name)
+    if path is None:
+        # 已被缓存淘汰时在后台重新生成，请求本身不做任何解码
+        if await asyncio.to_thread(media_index.regenerate_thumbnail, key):
+            _schedule_probe()
+        raise HTTPException(status_code=404, detail="缩略图不存在")
+    media_type = "text/vtt" if name.endswith(".vtt") else "image/jpeg"
+    # 按内容哈希寻址，内容不会改变
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 @app.get("/api/download/{file_type}/{filename}")
 async def download_file(file_type: str, filename: str):
     """下载文件"""
     try:
-        if file_type == "upload":
-            file_path = os.path.join("uploads", filename)
-        elif file_type == "output":
-            file_path = os.path.join("outputs", filename)
-        else:
-            raise HTTPException(status_code=400, detail="无效的文件类型")
+        file_path = _user_file_path(file_type, filename)
         
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="文件不存在")
         
+        headers = {}
+        digest = blob_store.digest_of(file_path)
+        if digest:
+            headers["X-Content-SHA256"] = digest
+        
         return FileResponse(
             file_path,
             filename=filename,
-            media_type='application/octet-stream'
+            media_type='application/octet-stream',
+            headers=headers
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"文件下载失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/api/files/{file_type}/{filename}")
 async def delete_file(file_type: str, filename: str):
-    """删除文件"""
+    """删除文件，内容的最后一个引用被删除时才释放存储"""
     try:
-        if file_type == "upload":
-            file_path = os.path.join("uploads", filename)
-        elif file_type == "output":
-            file_path = os.path.join("outputs", filename)
-        else:
-            raise HTTPException(status_code=400, detail="无效的文件类型")
+        file_path = _user_file_path(file_type, filename)
         
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if await asyncio.to_thread(blob_store.release, file_path):
+            media_files.invalidate(file_path)
+            await asyncio.to_thread(media_index.remove, file_path)
             return {"message": f"文件 {filename} 已删除", "success": True}
         else:
             raise HTTPException(status_code=404, detail="文件不存在")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"文件删除失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/media/{file_type}/{filename}")
-async def stream_media(file_type: str, filename: str):
-    """流式传输媒体文件，支持范围请求"""
+@app.api_route("/api/media/{file_type}/{filename}", methods=["GET", "HEAD"])
+async def stream_media(file_type: str, filename: str, request: Request):
+    """流式传输媒体文件，支持单区间/多区间 Range、If-Range 以及 ETag / Last-Modified 条件请求"""
     try:
-        if file_type == "upload":
-            file_path = os.path.join("uploads", filename)
-        elif file_type == "output":
-            file_path = os.path.join("outputs", filename)
-        else:
-            raise HTTPException(status_code=400, detail="无效的文件类型")
+        file_path = _user_file_path(file_type, filename)
         
-        if not os.path.exists(file_path):
+        try:
+            info = media_files.get(file_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="文件不存在")
         
-        # 获取文件大小
-        file_size = os.path.getsize(file_path)
+        return MediaFileResponse(
+            info,
+            request.headers,
+            method=request.method,
+            headers={"Cache-Control": "public, max-age=3600"}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"媒体文件流传输失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/preview/{file_type}/{filename}/index.m3u8")
+async def preview_playlist(file_type: str, filename: str):
+    """视频的 HLS 预览播放列表，首次请求时开始切片，第一个切片就绪后立即返回"""
+    try:
+        file_path = _user_file_path(file_type, filename)
         
-        # 确定MIME类型
-        import mimetypes
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            if filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm')):
-                mime_type = 'video/mp4'
-            elif filename.lower().endswith(('.mp3', '.wav', '.aac', '.flac', '.ogg')):
-                mime_type = 'audio/mpeg'
-            elif filename.lower().endswith(('.jpg', '.jpeg')):
-                mime_type = 'image/jpeg'
-            elif filename.lower().endswith('.png'):
-                mime_type = 'image/png'
-            elif filename.lower().endswith('.gif'):
-                mime_type = 'image/gif'
-            elif filename.lower().endswith('.webp'):
-                mime_type = 'image/webp'
-            elif filename.lower().endswith('.svg'):
-                mime_type = 'image/svg+xml'
-            elif filename.lower().endswith(('.bmp', '.tiff', '.ico')):
-                mime_type = 'image/bmp'
-            else:
-                mime_type = 'application/octet-stream'
+        if not os.path.isfile(file_path):
+            raise HTTPException(status_code=404, detail="文件不存在")
+        if media_kind(filename) != "video":
+            raise HTTPException(status_code=400, detail="只有视频文件支持 HLS 预览")
         
-        # 返回文件响应，支持范围请求
-        return FileResponse(
-            file_path,
-            media_type=mime_type,
-            headers={
-                "Accept-Ranges": "bytes",
-                "Content-Length": str(file_size),
-                "Cache-Control": "public, max-age=3600"
-            }
+        playlist = await hls_previews.playlist(file_path)
+        return Response(
+            content=playlist,
+            media_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "no-cache"}
         )
+    except HTTPException:
+        raise
+    except PreviewError as e:
+        logger.error(f"生成预览失败 {filename}: {e}")
+        raise HTTPException(status_code=500, detail=f"生成预览失败: {e}")
     except Exception as e:
-        logger.error(f"媒体文件流传输失败: {e}")
+        logger.error(f"获取预览播放列表失败: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/preview/segments/{key}/{segment}")
+async def preview_segment(key: str, segment: str):
+    """HLS 预览切片，按内容哈希寻址，内容不会变化"""
+    path = hls_previews.segment_path(key, segment)
+    if path is None:
+        raise HTTPException(status_code=404, detail="切片不存在")
+    return FileResponse(path, media_type="video/mp2t", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
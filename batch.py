@@ -0,0 +1,208 @@
+# batch.py - 对多个文件批量执行同一个工具
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from job_queue import SUCCEEDED, FAILED, CANCELLED, JobCancelledError
+from tool_cache import CACHEABLE_TOOLS
+
+logger = logging.getLogger(__name__)
+
+# 可以批量执行的工具：第一个输入参数逐个替换为选中的文件，其余输入文件对所有文件相同；
+# concat_videos 本身就以多个文件为输入，不适合逐个执行
+BATCH_TOOLS = {name: spec for name, spec in CACHEABLE_TOOLS.items() if name != "concat_videos"}
+
+# 单个批处理最多包含的文件数
+MAX_BATCH_ITEMS = 1000
+
+
+class BatchError(ValueError):
+    """批处理请求无效"""
+
+
+def _render(value, context):
+    """把参数模板中的 {name}、{stem}、{ext}、{index} 替换为当前文件的值"""
+    if isinstance(value, str):
+        try:
+            return value.format_map(context)
+        except (KeyError, ValueError, IndexError) as e:
+            raise BatchError(f"参数模板无效: {value!r} ({e})") from e
+    if isinstance(value, list):
+        return [_render(v, context) for v in value]
+    if isinstance(value, dict):
+        return {k: _render(v, context) for k, v in value.items()}
+    return value
+
+
+def _default_extension(tool, arguments, input_ext):
+    if tool == "extract_audio_from_video":
+        return "." + str(arguments.get("audio_format") or "mp3").lstrip(".").lower()
+    if tool == "extract_frames_from_video":
+        return ""
+    return input_ext
+
+
+def plan_batch(tool, template, inputs, resolve_path, output_dir="outputs"):
+    """
+    为每个文件生成工具参数，整个批次只规划一次，不经过 LLM
+
+    参数模板中的字符串可以使用 {name}（文件名）、{stem}（不含扩展名）、{ext}（扩展名）和
+    {index}（序号）；未指定输出位置时按输入文件名和参数生成确定的名称，便于命中工具缓存。
+
+    Args:
+        tool: 工具名
+        template: 参数模板
+        inputs: 输入文件列表
+        resolve_path: 把客户端传入的文件名解析为绝对路径的函数
+        output_dir: 输出目录
+
+    Returns:
+        list: [{"index", "input", "output", "arguments"}]
+    """
+    spec = BATCH_TOOLS.get(tool)
+    if spec is None:
+        raise BatchError(f"工具不支持批处理: {tool}，可用: {', '.join(BATCH_TOOLS)}")
+    input_arg = spec["inputs"][0]
+    output_arg = spec["output"]
+    if input_arg in template:
+        raise BatchError(f"参数 {input_arg} 由文件选择决定，不能在模板中指定")
+
+    paths = list(dict.fromkeys(resolve_path(path) for path in inputs))
+    if not paths:
+        raise BatchError("没有选择任何文件")
+    if len(paths) > MAX_BATCH_ITEMS:
+        raise BatchError(f"单个批处理最多 {MAX_BATCH_ITEMS} 个文件")
+
+    fixed = dict(template)
+    for name in spec["inputs"][1:]:
+        if isinstance(fixed.get(name), str):
+            fixed[name] = resolve_path(fixed[name])
+    payload = json.dumps(template, sort_keys=True, ensure_ascii=False)
+    tag = f"{tool.split('_')[0]}_{hashlib.sha1(payload.encode('utf-8')).hexdigest()[:8]}"
+
+    items = []
+    outputs = set()
+    for index, path in enumerate(paths):
+        name = os.path.basename(path)
+        stem, ext = os.path.splitext(name)
+        arguments = _render(fixed, {"name": name, "stem": stem, "ext": ext, "index": index})
+        arguments[input_arg] = path
+        output = None
+        if output_arg:
+            if arguments.get(output_arg):
+                output = os.path.basename(str(arguments[output_arg]))
+                if not output or output.startswith("."):
+                    raise BatchError(f"无效的输出文件名: {arguments[output_arg]!r}")
+            else:
+                output = f"{stem}_{tag}{_default_extension(tool, arguments, ext)}"
+            if output in outputs:
+                raise BatchError(f"多个文件的输出重名: {output}，请在模板中使用 {{stem}}")
+            outputs.add(output)
+            arguments[output_arg] = os.path.abspath(os.path.join(output_dir, output))
+        items.append({"index": index, "input": name, "output": output, "arguments": arguments})
+    return items
+
+
+async def _forward(child, job, index):
+    # 子任务的进度事件（如 ffmpeg_progress）带上序号转发到批处理任务
+    async for _, event in child.subscribe():
+        job.publish({**event, "index": index})
+
+
+async def run_batch(job, tool, items, scheduler, call_tool, concurrency=4):
+    """
+    把每个文件作为子任务提交到任务队列并汇总结果
+
+    同一批次同时在队列中的子任务不超过 concurrency 个，整体并发仍受 worker 数限制，
+    其他用户的任务可以穿插执行。批处理被取消时取消所有未结束的子任务。
+
+    Args:
+        job: 批处理任务，进度事件发布到其中
+        tool: 工具名
+        items: plan_batch 生成的条目
+        scheduler: 任务调度器
+        call_tool: 工具调用函数 call_tool(tool, arguments, on_progress)
+        concurrency: 同时执行的子任务数上限
+
+    Returns:
+        dict: 汇总结果
+    """
+    started = time.monotonic()
+    slots = asyncio.Semaphore(concurrency)
+    children = {}
+    results = [None] * len(items)
+    counts = {SUCCEEDED: 0, FAILED: 0, CANCELLED: 0}
+
+    job.publish({
+        "type": "batch_start",
+        "tool": tool,
+        "total": len(items),
+        "concurrency": concurrency,
+        "items": [{"index": i["index"], "input": i["input"], "output": i["output"]} for i in items],
+    })
+
+    async def run_item(item):
+        index = item["index"]
+        async with slots:
+            async def work(child):
+                return await call_tool(tool, item["arguments"], on_progress=child.publish)
+
+            child = scheduler.submit(work, user=job.user, priority=job.priority, kind="tool",
+                                     description=f"{tool}: {item['input']}")
+            children[index] = child
+            job.publish({"type": "batch_item_start", "index": index, "input": item["input"], "job_id": child.id})
+            item_started = time.monotonic()
+            forward = asyncio.create_task(_forward(child, job, index))
+            result, error = None, None
+            try:
+                result = await child.wait()
+                status = SUCCEEDED
+            except JobCancelledError as e:
+                status, error = CANCELLED, str(e)
+            except asyncio.CancelledError:
+                # 批处理被取消：子任务由外层统一取消，不再转发其事件
+                forward.cancel()
+                raise
+            except Exception as e:
+                status, error = FAILED, str(e)[:200]
+            children.pop(index, None)
+            await forward
+
+        counts[status] += 1
+        results[index] = {
+            "index": index,
+            "input": item["input"],
+            "output": item["output"],
+            "status": status,
+            "error": error,
+            "elapsed": round(time.monotonic() - item_started, 3),
+        }
+        job.publish({"type": "batch_item_done", **results[index], "result": result})
+        done = sum(counts.values())
+        job.publish({
+            "type": "batch_progress",
+            "done": done,
+            "total": len(items),
+            "percent": round(done / len(items) * 100, 1),
+            **counts,
+        })
+
+    try:
+        await asyncio.gather(*(run_item(item) for item in items))
+    finally:
+        for child in list(children.values()):
+            scheduler.cancel(child.id)
+
+    summary = {
+        "tool": tool,
+        "total": len(items),
+        **counts,
+        "elapsed": round(time.monotonic() - started, 3),
+        "items": results,
+    }
+    logger.info(f"批处理完成 {tool}: {counts[SUCCEEDED]}/{len(items)} 成功，耗时 {summary['elapsed']} 秒")
+    job.publish({"type": "batch_summary", **summary})
+    return summary
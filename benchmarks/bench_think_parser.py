@@ -0,0 +1,273 @@
+# bench_think_parser.py - 思考过程拆分的微基准
+#
+# 对比三种做法在大响应上的耗时和峰值内存（tracemalloc）：
+#   buffered  缓存完整响应后用正则拆分，没有标签时再逐行扫描关键词（原 _separate_thinking_and_result）
+#   splitter  原来的增量拆分（每个分块与上次剩余的文本拼接后切片）
+#   parser    think_parser.ThinkParser 状态机
+# 并检查三者拆分出的思考内容和结果一致。
+#
+#   python benchmarks/bench_think_parser.py --sizes 65536,1048576,8388608 --chunk-sizes 16,4096
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from think_parser import ThinkParser  # noqa: E402
+
+# 没有 <think> 标签时，按行首关键词判断思考过程和结果
+_THINKING_KEYWORDS = re.compile("分析|思考|考虑|首先|接下来|然后")
+_RESULT_KEYWORDS = re.compile("结果|完成|成功|输出|生成")
+
+
+def legacy_separate(response):
+    """原 FFmpegMCPClient._separate_thinking_and_result 的实现"""
+    import re
+
+    think_pattern = r'<think>(.*?)</think>'
+    think_matches = re.findall(think_pattern, response, re.DOTALL)
+    thinking_process = ""
+    if think_matches:
+        thinking_process = "\n".join(think_matches).strip()
+    final_result = re.sub(think_pattern, '', response, flags=re.DOTALL).strip()
+    if not thinking_process:
+        lines = response.split('\n')
+        thinking_lines = []
+        result_lines = []
+        in_thinking = False
+        for line in lines:
+            if any(keyword in line.lower() for keyword in ['分析', '思考', '考虑', '首先', '接下来', '然后']):
+                if not result_lines:
+                    in_thinking = True
+                    thinking_lines.append(line)
+                    continue
+            if any(keyword in line.lower() for keyword in ['结果', '完成', '成功', '输出', '生成']):
+                in_thinking = False
+                result_lines.append(line)
+                continue
+            if in_thinking:
+                thinking_lines.append(line)
+            else:
+                result_lines.append(line)
+        if thinking_lines:
+            thinking_process = '\n'.join(thinking_lines).strip()
+            final_result = '\n'.join(result_lines).strip()
+    return thinking_process, final_result
+
+
+def separate(response):
+    """
+    拆分完整响应中的思考过程和最终结果：用 ThinkParser 重新实现 legacy_separate，作为对照
+
+    有 <think> 标签时，各段思考内容以换行连接作为思考过程，其余部分作为结果；
+    没有标签时按行判断：结果出现之前、以思考类关键词（分析、首先等）开头的段落视为思考过程，
+    遇到结果类关键词（完成、输出等）的行后转为结果。
+
+    Args:
+        response: 模型的完整响应
+
+    Returns:
+        tuple: (thinking_process, final_result)
+    """
+    parser = ThinkParser()
+    blocks = []
+    result = []
+    for event in parser.feed(response) + parser.flush():
+        (blocks if event["type"] == "thinking_chunk" else result).append(event["content"])
+    thinking_process = "\n".join(blocks).strip()
+    final_result = "".join(result).strip()
+    if thinking_process:
+        return thinking_process, final_result
+
+    thinking_lines = []
+    result_lines = []
+    in_thinking = False
+    for line in response.split("\n"):
+        if not result_lines and _THINKING_KEYWORDS.search(line):
+            in_thinking = True
+            thinking_lines.append(line)
+        elif _RESULT_KEYWORDS.search(line):
+            in_thinking = False
+            result_lines.append(line)
+        elif in_thinking:
+            thinking_lines.append(line)
+        else:
+            result_lines.append(line)
+    if thinking_lines:
+        return "\n".join(thinking_lines).strip(), "\n".join(result_lines).strip()
+    return "", final_result
+
+
+class LegacySplitter:
+    """原 ffmpeg_mcp_demo._ThinkSplitter 的实现"""
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""
+
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        for length in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text):
+        text = self._pending + text
+        self._pending = ""
+        parts = []
+        while text:
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            pos = text.find(tag)
+            if pos >= 0:
+                if pos:
+                    parts.append((self.in_think, text[:pos]))
+                text = text[pos + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            keep = self._partial_tag_length(text, tag)
+            if keep:
+                self._pending = text[-keep:]
+                text = text[:-keep]
+            if text:
+                parts.append((self.in_think, text))
+            break
+        return parts
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        return [(self.in_think, text)] if text else []
+
+
+def make_response(size, blocks):
+    """生成约 size 个字符的响应：blocks 段 <think> 思考内容，每段后面跟着结果文本"""
+    thinking = "首先分析视频信息，然后考虑缩放参数。<b>width</b> 保持 16:9。\n"
+    result = "已完成缩放，输出文件 outputs/video_scaled.mp4 < 1GB。\n"
+    if not blocks:
+        unit = thinking + result
+        return unit * max(1, size // len(unit))
+    per_block = max(1, size // blocks)
+    think_text = thinking * max(1, per_block * 3 // 4 // len(thinking))
+    result_text = result * max(1, per_block // 4 // len(result))
+    return "".join(f"<think>{think_text}</think>{result_text}" for _ in range(blocks))
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def run_buffered(chunks):
+    buffer = []
+    for chunk in chunks:
+        buffer.append(chunk)
+    thinking, result = legacy_separate("".join(buffer))
+    return len(thinking), len(result)
+
+
+def run_splitter(chunks):
+    splitter = LegacySplitter()
+    thinking = result = 0
+    for chunk in chunks:
+        for is_thinking, text in splitter.feed(chunk):
+            if is_thinking:
+                thinking += len(text)
+            else:
+                result += len(text)
+    for is_thinking, text in splitter.flush():
+        if is_thinking:
+            thinking += len(text)
+        else:
+            result += len(text)
+    return thinking, result
+
+
+def run_parser(chunks):
+    parser = ThinkParser()
+    thinking = result = 0
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            if event["type"] == "thinking_chunk":
+                thinking += len(event["content"])
+            else:
+                result += len(event["content"])
+    for event in parser.flush():
+        if event["type"] == "thinking_chunk":
+            thinking += len(event["content"])
+        else:
+            result += len(event["content"])
+    return thinking, result
+
+
+def measure(func, chunks, repeat):
+    """
+    Returns:
+        tuple: (最快一次的耗时秒数, 峰值内存字节数, 返回值)
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = func(chunks)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(chunks)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, value
+
+
+def check(response, chunks):
+    """增量拆分的结果与完整响应的拆分结果一致"""
+    parser = ThinkParser()
+    thinking, result = [], []
+    for event in [e for chunk in chunks for e in parser.feed(chunk)] + parser.flush():
+        (thinking if event["type"] == "thinking_chunk" else result).append(event["content"])
+    expected = legacy_separate(response)
+    if "<think>" in response:
+        return "".join(result).strip() == expected[1] and separate(response) == expected
+    return separate(response) == expected
+
+
+def _csv(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="思考过程拆分的微基准")
+    parser.add_argument("--sizes", type=_csv, default=[64 * 1024, 1024 * 1024, 8 * 1024 * 1024], help="响应字符数")
+    parser.add_argument("--chunk-sizes", type=_csv, default=[16, 4096], help="分块字符数")
+    parser.add_argument("--blocks", type=_csv, default=[1, 64, 0], help="<think> 段数，0 为没有标签")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'响应大小':>10} {'分块':>6} {'段数':>5} {'做法':>9} {'耗时 ms':>10} {'MB/s':>9} {'峰值内存 KB':>12}")
+    failed = False
+    for size in args.sizes:
+        for blocks in args.blocks:
+            response = make_response(size, blocks)
+            for chunk_size in args.chunk_sizes:
+                chunks = chunked(response, chunk_size)
+                if not check(response, chunks):
+                    print(f"拆分结果不一致: size={size} blocks={blocks} chunk={chunk_size}")
+                    failed = True
+                for name, func in (("buffered", run_buffered), ("splitter", run_splitter), ("parser", run_parser)):
+                    elapsed, peak, _ = measure(func, chunks, args.repeat)
+                    throughput = len(response.encode("utf-8")) / elapsed / 1024 / 1024
+                    print(f"{len(response):>10} {chunk_size:>6} {blocks:>5} {name:>9} "
+                          f"{elapsed * 1000:>10.1f} {throughput:>9.1f} {peak / 1024:>12.1f}")
+            if blocks == 0:
+                for name, func in (("legacy", legacy_separate), ("separate", separate)):
+                    elapsed, peak, _ = measure(func, response, args.repeat)
+                    print(f"{len(response):>10} {'-':>6} {blocks:>5} {name:>9} "
+                          f"{elapsed * 1000:>10.1f} {'':>9} {peak / 1024:>12.1f}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# fake_llm.py - 基准测试用的本地 OpenAI 兼容服务，按脚本返回工具调用计划
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# 默认脚本：按消息中的关键词选择计划。{input} 为选中的文件，{stem} 为其文件名主干，
+# {outputs} 为与 uploads/ 同级的 outputs/，{n} 为本服务的计划序号（让并发请求的输出文件互不覆盖）
+DEFAULT_SCRIPT = [
+    {
+        "match": r"缩放|scale",
+        "calls": [
+            {"name": "get_video_info", "arguments": {"video_path": "{input}"}},
+            {"name": "scale_video", "arguments": {
+                "video_path": "{input}", "width": "640", "height": "360",
+                "output_path": "{outputs}/{stem}_scaled_{n}.mp4"
+            }},
+        ],
+        "reply": "已将 {stem} 缩放为 640x360，输出文件保存在 {outputs}",
+    },
+    {
+        "match": r"剪切|clip",
+        "calls": [
+            {"name": "get_video_info", "arguments": {"video_path": "{input}"}},
+            {"name": "clip_video", "arguments": {
+                "video_path": "{input}", "start": "0", "end": "1",
+                "output_path": "{outputs}/{stem}_clip_{n}.mp4"
+            }},
+        ],
+        "reply": "已剪切 {stem} 的前 1 秒，输出文件保存在 {outputs}",
+    },
+    {
+        "match": r"音频|audio",
+        "calls": [
+            {"name": "extract_audio_from_video", "arguments": {
+                "video_path": "{input}", "output_path": "{outputs}/{stem}_{n}.aac"
+            }},
+        ],
+        "reply": "已提取 {stem} 的音频，输出文件保存在 {outputs}",
+    },
+    {
+        "match": r"",
+        "calls": [{"name": "get_video_info", "arguments": {"video_path": "{input}"}}],
+        "reply": "已获取视频信息。",
+    },
+]
+
+_SELECTED_RE = re.compile(r"文件路径[:：]\s*(\S+)")
+
+
+class ScriptedLLM:
+    """按脚本回复的流式补全
+
+    第一轮（还没有工具结果时）返回脚本中的全部工具调用，之后返回带 <think> 的文字回复。
+    首个分块延迟和每个分块的间隔模拟真实服务的响应时间。
+    """
+
+    def __init__(self, script, first_chunk_latency=0.0, chunk_interval=0.0, reply_chunks=8):
+        self.script = [dict(entry, pattern=re.compile(entry["match"], re.I)) for entry in script]
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_interval = chunk_interval
+        self.reply_chunks = max(1, reply_chunks)
+        self.requests = 0
+        self.tool_call_rounds = 0
+
+    def _entry(self, message):
+        for entry in self.script:
+            if entry["pattern"].search(message):
+                return entry
+        return self.script[-1]
+
+    @staticmethod
+    def _fill(value, variables):
+        if isinstance(value, dict):
+            return {k: ScriptedLLM._fill(v, variables) for k, v in value.items()}
+        if isinstance(value, list):
+            return [ScriptedLLM._fill(v, variables) for v in value]
+        if isinstance(value, str):
+            for name, text in variables.items():
+                value = value.replace(f"{{{name}}}", text)
+        return value
+
+    def _variables(self, message):
+        selected = _SELECTED_RE.search(message)
+        path = os.path.abspath(selected.group(1)) if selected else ""
+        return {
+            "input": path,
+            "stem": os.path.splitext(os.path.basename(path))[0],
+            "outputs": os.path.join(os.path.dirname(os.path.dirname(path)), "outputs"),
+            "n": str(self.tool_call_rounds),
+        }
+
+    async def completion(self, body):
+        """
+        生成一次流式补全的 SSE 数据
+
+        Args:
+            body: chat.completions 请求体
+        """
+        self.requests += 1
+        messages = body.get("messages", [])
+        user = [m for m in messages if m["role"] == "user"]
+        message = (user[-1].get("content") or "") if user else ""
+        entry = self._entry(message)
+        created = int(time.time())
+        model = body.get("model", "fake")
+
+        def chunk(delta, finish=None):
+            data = {
+                "id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "created": created,
+                "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        await asyncio.sleep(self.first_chunk_latency)
+        if not any(m["role"] == "tool" for m in messages) and entry["calls"]:
+            self.tool_call_rounds += 1
+            variables = self._variables(message)
+            for i, call in enumerate(entry["calls"]):
+                if i:
+                    await asyncio.sleep(self.chunk_interval)
+                arguments = json.dumps(self._fill(call["arguments"], variables), ensure_ascii=False)
+                yield chunk({"tool_calls": [{
+                    "index": i, "id": f"call_{self.requests}_{i}", "type": "function",
+                    "function": {"name": call["name"], "arguments": arguments}
+                }]})
+            yield chunk({}, "tool_calls")
+            completion_tokens = 30 * len(entry["calls"])
+        else:
+            variables = self._variables(message)
+            text = "<think>根据工具结果整理回复</think>" + self._fill(entry.get("reply", "完成"), variables)
+            size = max(1, -(-len(text) // self.reply_chunks))
+            for start in range(0, len(text), size):
+                if start:
+                    await asyncio.sleep(self.chunk_interval)
+                yield chunk({"content": text[start:start + size]})
+            yield chunk({}, "stop")
+            completion_tokens = len(text)
+        if body.get("stream_options", {}).get("include_usage"):
+            prompt_tokens = sum(len(json.dumps(m, ensure_ascii=False)) for m in messages) // 2
+            usage = {
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            }
+            data = {"id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": [], "usage": usage}
+            yield f"data: {json.dumps(data)}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+def create_app(llm):
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if not body.get("stream"):
+            return {"error": {"message": "只支持流式补全"}}
+        return StreamingResponse(llm.completion(body), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": llm.requests, "tool_call_rounds": llm.tool_call_rounds}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基准测试用的本地 OpenAI 兼容服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--script", help="计划脚本（JSON 列表，格式同 DEFAULT_SCRIPT），默认使用内置脚本")
+    parser.add_argument("--first-chunk-latency", type=float, default=0.2, help="首个分块前的延迟（秒）")
+    parser.add_argument("--chunk-interval", type=float, default=0.01, help="分块之间的间隔（秒）")
+    args = parser.parse_args()
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            script = json.load(f)
+    llm = ScriptedLLM(script, args.first_chunk_latency, args.chunk_interval)
+    uvicorn.run(create_app(llm), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
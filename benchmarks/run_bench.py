@@ -0,0 +1,466 @@
+# run_bench.py - Web 服务的吞吐和延迟基准测试
+#
+# 在临时工作目录中启动 app.py 和本地的 fake_llm.py（代替 NVIDIA 接口），用 FFmpeg testsrc
+# 生成测试视频，按指定并发压测各个接口，输出 p50/p95/p99 延迟、RPS 以及服务进程（含子进程）
+# 的 CPU 和 RSS。结果可以保存为基线，之后的运行与基线对比，退化超过阈值时返回非零退出码。
+#
+#   python benchmarks/run_bench.py --concurrency 1,8 --requests 40
+#   python benchmarks/run_bench.py --save-baseline local
+#   python benchmarks/run_bench.py --compare local --tolerance 0.2
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+SCENARIOS = ("upload", "files", "media", "media-range", "process", "process-stream")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_video(directory, size="640x360", duration=5, rate=30):
+    """
+    用 testsrc 和 sine 生成带音轨的 H.264 测试视频，已存在时直接复用
+
+    Args:
+        directory: 保存目录
+        size: 分辨率，如 1280x720
+        duration: 时长（秒）
+        rate: 帧率
+
+    Returns:
+        str: 视频路径
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"testsrc_{size}_{duration}s_{rate}fps.mp4")
+    if os.path.isfile(path):
+        return path
+    tmp = f"{path}.tmp.mp4"
+    subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate={rate}:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-shortest", "-movflags", "+faststart", tmp,
+        ],
+        check=True
+    )
+    os.replace(tmp, path)
+    return path
+
+
+def percentile(samples, p):
+    """最近秩法的分位数"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+class ResourceSampler:
+    """定期采样进程树（服务进程、MCP 桥接和 FFmpeg 子进程）的 CPU 和 RSS"""
+
+    def __init__(self, pid, interval=0.25):
+        self.root = psutil.Process(pid)
+        self.interval = interval
+        self._processes = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.cpu = []
+        self.rss = []
+
+    def _tree(self):
+        try:
+            tree = [self.root] + self.root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+        current = {}
+        for process in tree:
+            # 同一个 Process 对象才能得到两次采样之间的 CPU 占用
+            current[process.pid] = self._processes.get(process.pid, process)
+        self._processes = current
+        return list(current.values())
+
+    def _sample(self):
+        cpu = rss = 0.0
+        for process in self._tree():
+            try:
+                cpu += process.cpu_percent(None)
+                rss += process.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return cpu, rss
+
+    def _record(self):
+        cpu, rss = self._sample()
+        self.cpu.append(cpu)
+        self.rss.append(rss)
+
+    def _run(self):
+        self._sample()
+        while not self._stop.wait(self.interval):
+            self._record()
+        # 最后一次采样覆盖末尾不足一个间隔的时间，很短的场景也至少有一个样本
+        self._record()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        mb = 1024 * 1024
+        return {
+            "cpu_avg_percent": round(sum(self.cpu) / len(self.cpu), 1) if self.cpu else None,
+            "cpu_max_percent": round(max(self.cpu), 1) if self.cpu else None,
+            "rss_avg_mb": round(sum(self.rss) / len(self.rss) / mb, 1) if self.rss else None,
+            "rss_max_mb": round(max(self.rss) / mb, 1) if self.rss else None,
+        }
+
+
+class Services:
+    """在临时工作目录中启动 fake_llm.py 和 app.py"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="mcp-bench-")
+        self.llm_port = args.llm_port or _free_port()
+        self.app_port = args.app_port or _free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+        self.llm = None
+        self.app = None
+
+    def _spawn(self, command, env, log_name):
+        with open(os.path.join(self.workdir, log_name), "wb") as log:
+            return subprocess.Popen(command, cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def start(self):
+        # app.py 使用相对路径的 uploads/、outputs/、storage/ 和 static/，在临时目录中运行，不影响项目目录
+        os.symlink(os.path.join(PROJECT_ROOT, "static"), os.path.join(self.workdir, "static"))
+        env = dict(os.environ)
+        env.update({
+            "NVIDIA_BASE_URL": f"http://127.0.0.1:{self.llm_port}/v1",
+            "NVIDIA_API_KEY": "bench",
+            "NVIDIA_MODEL": "bench/fake",
+        })
+        for item in self.args.env:
+            name, _, value = item.partition("=")
+            env[name] = value
+        llm_command = [
+            sys.executable, os.path.join(BENCH_DIR, "fake_llm.py"), "--port", str(self.llm_port),
+            "--first-chunk-latency", str(self.args.llm_latency),
+            "--chunk-interval", str(self.args.llm_chunk_interval),
+        ]
+        if self.args.llm_script:
+            llm_command += ["--script", os.path.abspath(self.args.llm_script)]
+        self.llm = self._spawn(llm_command, env, "fake_llm.log")
+        self.app = self._spawn(
+            [
+                sys.executable, "-m", "uvicorn", "app:app", "--app-dir", PROJECT_ROOT,
+                "--host", "127.0.0.1", "--port", str(self.app_port), "--log-level", "warning",
+            ],
+            env, "app.log"
+        )
+        self._wait_ready(f"http://127.0.0.1:{self.llm_port}/v1/models", self.llm)
+        self._wait_ready(f"{self.base_url}/api/files?limit=1", self.app)
+
+    def _wait_ready(self, url, process, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"进程提前退出（退出码 {process.returncode}），日志见 {self.workdir}")
+            try:
+                if httpx.get(url, timeout=2).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"等待 {url} 就绪超时，日志见 {self.workdir}")
+
+    def stop(self):
+        for process in (self.app, self.llm):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        if self.args.keep_workdir:
+            print(f"工作目录保留在 {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Bench:
+    """按并发执行各个场景的请求并统计结果"""
+
+    def __init__(self, services, args, video):
+        self.services = services
+        self.args = args
+        self.video = video
+        with open(video, "rb") as f:
+            self.video_bytes = f.read()
+        self.fixture = None
+
+    def _message(self):
+        path = os.path.join(self.services.workdir, "uploads", self.fixture)
+        return f"{self.args.message}\n\n当前选中的文件:\n文件路径: {path} (文件名: {self.fixture})"
+
+    async def setup(self, client):
+        """上传压测 media 和 process 场景使用的视频"""
+        self.fixture = f"bench-{os.path.basename(self.video)}"
+        response = await client.post("/api/upload", files={"file": (self.fixture, self.video_bytes, "video/mp4")})
+        response.raise_for_status()
+
+    async def _upload(self, client, i):
+        name = f"bench-upload-{i}.mp4"
+        response = await client.post("/api/upload", files={"file": (name, self.video_bytes, "video/mp4")})
+        response.raise_for_status()
+
+    async def _files(self, client, i):
+        response = await client.get("/api/files", params={"type": "upload", "limit": 100})
+        response.raise_for_status()
+
+    async def _media(self, client, i):
+        async with client.stream("GET", f"/api/media/upload/{self.fixture}") as response:
+            response.raise_for_status()
+            async for _ in response.aiter_raw():
+                pass
+
+    async def _media_range(self, client, i):
+        size = len(self.video_bytes)
+        length = min(size, 256 * 1024)
+        start = random.randrange(0, size - length + 1)
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        response = await client.get(f"/api/media/upload/{self.fixture}", headers=headers)
+        if response.status_code != 206:
+            raise RuntimeError(f"Range 请求返回 {response.status_code}")
+
+    async def _process(self, client, i):
+        payload = {"message": self._message(), "use_plan_cache": self.args.plan_cache}
+        response = await client.post("/api/process", json=payload)
+        response.raise_for_status()
+        if not response.json().get("success"):
+            raise RuntimeError("处理失败")
+
+    async def _process_stream(self, client, i):
+        payload = {"message": self._message(), "use_plan_cache": self.args.plan_cache}
+        started = time.perf_counter()
+        first_event = None
+        async with client.stream("POST", "/api/process-stream", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                if first_event is None:
+                    first_event = time.perf_counter() - started
+                event = json.loads(line[6:])
+                if event.get("type") == "error":
+                    raise RuntimeError(event.get("message"))
+                if event.get("type") == "end":
+                    break
+        return first_event
+
+    async def run(self, client, scenario, concurrency, requests):
+        """
+        以指定并发执行一个场景
+
+        Returns:
+            dict: 请求数、错误数、RPS、延迟分位数（毫秒）以及 CPU/RSS
+        """
+        handler = getattr(self, f"_{scenario.replace('-', '_')}")
+        latencies, first_events, errors = [], [], []
+        counter = iter(range(requests))
+
+        async def worker():
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    first_event = await handler(client, i)
+                except Exception as e:
+                    errors.append(repr(e))
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if first_event is not None:
+                    first_events.append(first_event)
+
+        with ResourceSampler(self.services.app.pid) as sampler:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+
+        result = {
+            "requests": requests,
+            "errors": len(errors),
+            "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "p50_ms": ms(percentile(latencies, 50)),
+            "p95_ms": ms(percentile(latencies, 95)),
+            "p99_ms": ms(percentile(latencies, 99)),
+            "max_ms": ms(max(latencies)) if latencies else None,
+            **sampler.summary(),
+        }
+        if first_events:
+            result["first_event_p50_ms"] = ms(percentile(first_events, 50))
+            result["first_event_p95_ms"] = ms(percentile(first_events, 95))
+        if errors:
+            result["first_error"] = errors[0]
+        return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基线对比，p95 延迟升高或 RPS 下降超过 tolerance 视为退化
+
+    Returns:
+        list: 退化说明
+    """
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        if base.get("p95_ms") and current.get("p95_ms") and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {base['p95_ms']} ms -> {current['p95_ms']} ms")
+        if base.get("rps") and current.get("rps") is not None and current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: RPS {base['rps']} -> {current['rps']}")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{key}: 错误数 {base.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def _print_table(results):
+    columns = ("rps", "p50_ms", "p95_ms", "p99_ms", "errors", "cpu_avg_percent", "rss_max_mb")
+    header = f"{'场景@并发':<24}" + "".join(f"{c:>16}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for key, result in results.items():
+        print(f"{key:<24}" + "".join(f"{str(result.get(c)):>16}" for c in columns))
+
+
+async def _run_all(bench, args):
+    results = {}
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2)
+    async with httpx.AsyncClient(base_url=bench.services.base_url, timeout=args.timeout, limits=limits) as client:
+        await bench.setup(client)
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # 预热，不计入结果
+                await bench.run(client, scenario, concurrency, min(args.warmup, args.requests))
+                key = f"{scenario}@{concurrency}"
+                results[key] = await bench.run(client, scenario, concurrency, args.requests)
+                print(f"{key}: {results[key]}", flush=True)
+    return results
+
+
+def _csv(value, cast=str):
+    return [cast(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP Demo Web 服务基准测试")
+    parser.add_argument("--scenarios", type=_csv, default=list(SCENARIOS), help=f"逗号分隔，可选 {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=lambda v: _csv(v, int), default=[1, 4, 16], help="逗号分隔的并发数")
+    parser.add_argument("--requests", type=int, default=50, help="每个场景、每个并发下的请求数")
+    parser.add_argument("--warmup", type=int, default=3, help="每轮开始前的预热请求数")
+    parser.add_argument("--timeout", type=float, default=300, help="单个请求的超时（秒）")
+    parser.add_argument("--video-size", default="640x360", help="测试视频分辨率")
+    parser.add_argument("--video-duration", type=int, default=5, help="测试视频时长（秒）")
+    parser.add_argument("--media-dir", default=os.path.join(tempfile.gettempdir(), "mcp-bench-media"),
+                        help="测试视频的缓存目录")
+    parser.add_argument("--message", default="把视频缩放到 640x360", help="process 场景发送的消息")
+    parser.add_argument("--plan-cache", action="store_true", help="process 场景使用计划缓存（默认每次都经过 LLM）")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM 的首个分块延迟（秒）")
+    parser.add_argument("--llm-chunk-interval", type=float, default=0.01, help="fake LLM 的分块间隔（秒）")
+    parser.add_argument("--llm-script", help="fake LLM 的计划脚本（JSON）")
+    parser.add_argument("--env", action="append", default=[], help="传给 app.py 的环境变量，如 --env JOB_WORKERS=8")
+    parser.add_argument("--app-port", type=int, default=0)
+    parser.add_argument("--llm-port", type=int, default=0)
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时工作目录（含服务日志）")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--save-baseline", metavar="NAME", help=f"把结果保存为基线 {BASELINE_DIR}/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="与基线对比，退化时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(sorted(unknown))}")
+
+    video = generate_video(args.media_dir, args.video_size, args.video_duration)
+    services = Services(args)
+    try:
+        services.start()
+        results = asyncio.run(_run_all(Bench(services, args, video), args))
+    finally:
+        services.stop()
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "video": os.path.basename(video),
+            "llm_latency": args.llm_latency,
+            "plan_cache": args.plan_cache,
+            "env": args.env,
+        },
+        "results": results,
+    }
+    print()
+    _print_table(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save_baseline}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存: {path}")
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json"), "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("cpu_count") != os.cpu_count():
+            print(f"注意: 基线在 {baseline['meta'].get('cpu_count')} 核的机器上生成，本机 {os.cpu_count()} 核")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("性能退化:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"与基线 {args.compare} 相比没有超过 {args.tolerance:.0%} 的退化")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+# blob_store.py - 内容寻址的去重文件存储
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Linux FICLONE ioctl，用于在支持的文件系统上创建写时复制的 reflink
+_FICLONE = 0x40049409
+
+# 计算文件哈希时的读取块大小
+_HASH_READ_SIZE = 1024 * 1024
+
+# 合法的内容哈希：64 位小写十六进制的 SHA-256
+_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def hash_file(path):
+    """计算文件的 SHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(_HASH_READ_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def is_valid_digest(digest):
+    """是否为合法的 SHA-256 十六进制串，哈希会拼进 blob 路径，必须先校验"""
+    return isinstance(digest, str) and _DIGEST_RE.fullmatch(digest) is not None
+
+
+def _reflink(src, dest):
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+class BlobStore:
+    """内容寻址的 blob 存储
+
+    文件内容按 SHA-256 保存一份在 blobs/ 下，uploads/ 和 outputs/ 中面向用户的文件名
+    通过 reflink（文件系统支持时）或硬链接指向 blob，都不支持时退化为复制。
+    每个用户文件名在 SQLite 中登记一条引用，删除最后一个引用时才删除 blob。
+    """
+
+    def __init__(self, root):
+        """
+        初始化 blob 存储
+
+        Args:
+            root: 存储根目录，blobs/ 和 tmp/ 都位于其下，需与 uploads/ 在同一文件系统
+        """
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.db_path = os.path.join(root, "blobs.sqlite3")
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS refs (
+                    path TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest);
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def blob_path(self, digest):
+        """blob 在存储中的路径"""
+        if not is_valid_digest(digest):
+            raise ValueError(f"无效的内容哈希: {digest!r}")
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def has(self, digest):
+        """是否已存储该内容"""
+        if not is_valid_digest(digest):
+            return False
+        return os.path.exists(self.blob_path(digest))
+
+    def refcount(self, digest):
+        """引用该内容的用户文件数"""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT COUNT(*) AS n FROM refs WHERE digest = ?", (digest,)
+            ).fetchone()
+        return row["n"]
+
+    def digest_of(self, path):
+        """
+        查询用户文件的内容哈希
+
+        Returns:
+            str: 哈希值；文件未登记或登记后被修改过时返回 None
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT digest, size, mtime_ns FROM refs WHERE path = ?", (self._key(path),)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if st.st_size != row["size"] or st.st_mtime_ns != row["mtime_ns"]:
+            return None
+        return row["digest"]
+
+    def digests_in(self, directory):
+        """
+        批量查询目录下已登记文件的内容哈希
+
+        Returns:
+            dict: 文件名 -> (哈希, 大小, mtime_ns)，调用方应用 stat 结果校验是否过期
+        """
+        prefix = os.path.join(self._key(directory), "")
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT path, digest, size, mtime_ns FROM refs WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix)
+            ).fetchall()
+        return {
+            row["path"][len(prefix):]: (row["digest"], row["size"], row["mtime_ns"])
+            for row in rows
+        }
+
+    def ingest(self, tmp_path, digest, dest_path):
+        """
+        将已计算好哈希的临时文件存入 blob 存储并链接到用户文件名
+
+        Args:
+            tmp_path: 临时文件（应位于 tmp_dir 或同一文件系统中），调用后被移走或删除
+            digest: 文件内容的 SHA-256
+            dest_path: 面向用户的文件路径
+
+        Returns:
+            bool: 内容是否已存在（即本次被去重）
+        """
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        deduplicated = os.path.exists(blob)
+        if deduplicated:
+            os.remove(tmp_path)
+        else:
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+        self._link(blob, dest_path)
+        self._record(dest_path, digest)
+        if deduplicated:
+            logger.info(f"内容已存在，去重保存: {dest_path} -> {digest[:12]}")
+        return deduplicated
+
+    def link(self, digest, dest_path):
+        """为已存储的内容创建一个新的用户文件名"""
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            raise FileNotFoundError(f"blob 不存在: {digest}")
+        self._link(blob, dest_path)
+        self._record(dest_path, digest)
+
+    def retain(self, digest, holder):
+        """
+        为不对应用户文件的持有者（如缓存条目）登记一个引用，阻止 blob 被删除
+
+        Args:
+            digest: 内容哈希
+            holder: 持有者标识，需带有不会与文件路径冲突的前缀，如 "tool-cache:..."
+        """
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO refs VALUES (?, ?, 0, 0, ?)",
+                (holder, digest, time.time())
+            )
+
+    def drop(self, holder):
+        """释放 retain 登记的引用"""
+        with self._connect() as db:
+            row = db.execute("SELECT digest FROM refs WHERE path = ?", (holder,)).fetchone()
+            db.execute("DELETE FROM refs WHERE path = ?", (holder,))
+        if row is not None:
+            self._collect(row["digest"])
+
+    def adopt(self, path, min_age=0.0):
+        """
+        将不经过上传流程产生的文件（如 FFmpeg 输出）纳入存储
+
+        Args:
+            path: 用户文件路径
+            min_age: 文件最近修改时间距今至少多少秒才处理，避免收录仍在写入的文件
+
+        Returns:
+            str: 内容哈希；文件仍在写入或无法处理时返回 None
+        """
+        digest = self.digest_of(path)
+        if digest is not None:
+            return digest
+        try:
+            before = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time() - before.st_mtime < min_age:
+            return None
+        digest = hash_file(path)
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+            # 计算哈希期间文件仍在变化
+            return None
+
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            self._link(blob, path)
+        else:
+            # 先在 tmp 中生成再原子移入，blobs 目录中不会出现不完整的文件
+            tmp_path = os.path.join(self.tmp_dir, f"adopt-{uuid.uuid4().hex}")
+            self._clone(path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob)
+            self._link(blob, path)
+        self._record(path, digest)
+        return digest
+
+    def adopt_dir(self, directory, min_age=2.0):
+        """收录目录中所有未登记或已变化的文件"""
+        adopted = 0
+        for entry in os.scandir(directory):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            try:
+                if self.digest_of(entry.path) is None and self.adopt(entry.path, min_age):
+                    adopted += 1
+            except OSError as e:
+                logger.warning(f"收录文件失败 {entry.path}: {e}")
+        return adopted
+
+    def release(self, path):
+        """
+        删除用户文件并释放引用，最后一个引用释放时删除 blob
+
+        Returns:
+            bool: 文件是否存在
+        """
+        key = self._key(path)
+        with self._connect() as db:
+            row = db.execute("SELECT digest FROM refs WHERE path = ?", (key,)).fetchone()
+            db.execute("DELETE FROM refs WHERE path = ?", (key,))
+        existed = os.path.exists(path)
+        if existed:
+            os.remove(path)
+        if row is not None:
+            self._collect(row["digest"])
+        return existed
+
+    def detach(self, path):
+        """
+        让用户文件不再与 blob 共享 inode，之后可以被原地覆盖写入
+
+        硬链接的文件替换为内容和修改时间都相同的独立副本，并释放其引用；
+        复制或 reflink 得到的文件本身就是独立的，不做处理。
+
+        Returns:
+            bool: 是否替换了文件
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_nlink <= 1:
+            return False
+        directory, name = os.path.split(path)
+        tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        key = self._key(path)
+        with self._connect() as db:
+            row = db.execute("SELECT digest FROM refs WHERE path = ?", (key,)).fetchone()
+            db.execute("DELETE FROM refs WHERE path = ?", (key,))
+        if row is not None:
+            self._collect(row["digest"])
+        return True
+
+    def _record(self, path, digest):
+        st = os.stat(path)
+        key = self._key(path)
+        with self._connect() as db:
+            previous = db.execute("SELECT digest FROM refs WHERE path = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?)",
+                (key, digest, st.st_size, st.st_mtime_ns, time.time())
+            )
+        if previous is not None and previous["digest"] != digest:
+            # 同名文件被新内容替换，旧内容可能已无人引用
+            self._collect(previous["digest"])
+
+    def _collect(self, digest):
+        if self.refcount(digest) == 0:
+            try:
+                os.remove(self.blob_path(digest))
+                logger.info(f"已删除无引用的 blob: {digest[:12]}")
+            except FileNotFoundError:
+                pass
+
+    def _link(self, blob, dest_path):
+        try:
+            if os.path.samefile(blob, dest_path):
+                return
+        except FileNotFoundError:
+            pass
+        # 先链接到临时名称再原子替换，已存在的同名文件不会出现中间状态
+        directory, name = os.path.split(dest_path)
+        tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        self._clone(blob, tmp_path)
+        os.replace(tmp_path, dest_path)
+
+    @staticmethod
+    def _clone(src, dest):
+        """reflink 优先，其次硬链接，最后复制"""
+        try:
+            _reflink(src, dest)
+            return
+        except OSError:
+            try:
+                os.remove(dest)
+            except FileNotFoundError:
+                pass
+        try:
+            os.link(src, dest)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+        shutil.copyfile(src, dest)
@@ -0,0 +1,250 @@
+# bridge_pool.py - 常驻 MCP 桥接会话池
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PooledBridge:
+    """池中的一个常驻桥接会话
+
+    MCP 的 stdio 客户端内部使用 anyio 任务组，进入和退出必须发生在同一个任务中，
+    因此每个会话都由一个专属的后台任务持有，直到被要求关闭。
+    """
+
+    def __init__(self, bridge_factory):
+        self._bridge_factory = bridge_factory
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task = None
+        self._error = None
+        self.bridge = None
+        self.uses = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.broken = False
+
+    @property
+    def alive(self):
+        """会话所在任务仍在运行且未被标记为损坏"""
+        return self._task is not None and not self._task.done() and not self.broken
+
+    async def open(self):
+        """启动子进程并完成 MCP 握手"""
+        self._task = asyncio.create_task(self._run())
+        await self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    async def _run(self):
+        try:
+            async with self._bridge_factory() as bridge:
+                self.bridge = bridge
+                self._ready.set()
+                await self._closing.wait()
+        except Exception as e:
+            if not self._ready.is_set():
+                self._error = e
+            else:
+                logger.warning(f"桥接会话异常退出: {e}")
+        finally:
+            self.broken = True
+            self._ready.set()
+
+    async def close(self):
+        """关闭会话并等待子进程退出"""
+        self._closing.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                logger.warning(f"关闭桥接会话失败: {e}")
+
+
+class BridgePool:
+    """有界的常驻桥接会话池
+
+    会话在首次使用前完成子进程启动和 MCP 握手，之后被反复借出复用；
+    处理请求数达到上限或崩溃的会话会被回收，并按需补足到最小数量。
+    """
+
+    def __init__(self, bridge_factory, min_size=1, max_size=4,
+                 max_requests=100, health_check_interval=30.0,
+                 health_check_timeout=5.0):
+        """
+        初始化会话池
+
+        Args:
+            bridge_factory: 返回桥接异步上下文管理器（如 BridgeManager）的可调用对象
+            min_size: 常驻会话的最小数量
+            max_size: 会话的最大数量
+            max_requests: 单个会话处理多少个请求后回收
+            health_check_interval: 空闲会话健康检查的间隔（秒）
+            health_check_timeout: 单次健康检查的超时时间（秒）
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"无效的会话池大小: min={min_size}, max={max_size}")
+        self.bridge_factory = bridge_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_requests = max_requests
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+
+        self._idle = []
+        self._size = 0
+        self._condition = asyncio.Condition()
+        self._health_task = None
+        self._closed = False
+        # 关闭、补充会话等后台任务，保留引用避免被垃圾回收
+        self._tasks = set()
+
+    @property
+    def size(self):
+        """当前会话总数（包括正在创建的）"""
+        return self._size
+
+    @property
+    def idle(self):
+        """当前空闲会话数"""
+        return len(self._idle)
+
+    async def start(self):
+        """预热最小数量的会话并启动健康检查"""
+        await self._replenish()
+        if self.health_check_interval:
+            self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(f"桥接会话池已启动: {self._size} 个会话")
+
+    async def close(self):
+        """关闭所有空闲会话，借出的会话在归还时关闭"""
+        self._closed = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+        async with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        await asyncio.gather(*(entry.close() for entry in idle))
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info("桥接会话池已关闭")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @asynccontextmanager
+    async def session(self):
+        """借出一个会话，使用完毕后自动归还"""
+        entry = await self._acquire()
+        try:
+            yield entry.bridge
+        except Exception:
+            # 使用期间出现任何异常（取消除外）都无法确认会话状态，不再复用
+            entry.broken = True
+            raise
+        finally:
+            await self._release(entry)
+
+    async def _acquire(self):
+        while True:
+            async with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("桥接会话池已关闭")
+                    if self._idle:
+                        entry = self._idle.pop()
+                        if entry.alive:
+                            return entry
+                        # 空闲期间崩溃的会话直接丢弃
+                        self._size -= 1
+                        self._spawn(entry.close())
+                        continue
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    await self._condition.wait()
+            entry = await self._create()
+            if entry is not None:
+                return entry
+
+    async def _create(self):
+        entry = PooledBridge(self.bridge_factory)
+        try:
+            await entry.open()
+            return entry
+        except Exception:
+            async with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    async def _release(self, entry):
+        entry.uses += 1
+        entry.last_used = time.monotonic()
+        recycle = (
+            not entry.alive
+            or self._closed
+            or (self.max_requests and entry.uses >= self.max_requests)
+        )
+        async with self._condition:
+            if recycle:
+                self._size -= 1
+            else:
+                self._idle.append(entry)
+            self._condition.notify()
+        if recycle:
+            logger.info(f"回收桥接会话: 已处理 {entry.uses} 个请求, 存活={entry.alive}")
+            self._spawn(entry.close())
+            if not self._closed:
+                self._spawn(self._replenish())
+
+    async def _replenish(self):
+        """补足到最小会话数"""
+        while not self._closed:
+            async with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = await self._create()
+            except Exception as e:
+                logger.error(f"创建桥接会话失败: {e}")
+                return
+            async with self._condition:
+                self._idle.append(entry)
+                self._condition.notify()
+
+    async def _health_loop(self):
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            async with self._condition:
+                entries, self._idle = self._idle, []
+            healthy = []
+            for entry in entries:
+                if await self._check(entry):
+                    healthy.append(entry)
+                else:
+                    logger.warning("桥接会话健康检查失败，已丢弃")
+                    self._spawn(entry.close())
+            async with self._condition:
+                self._size -= len(entries) - len(healthy)
+                self._idle.extend(healthy)
+                self._condition.notify_all()
+            await self._replenish()
+
+    async def _check(self, entry):
+        if not entry.alive:
+            return False
+        try:
+            await asyncio.wait_for(
+                entry.bridge.mcp_client.session.send_ping(),
+                timeout=self.health_check_timeout
+            )
+            return True
+        except Exception:
+            return False
@@ -0,0 +1,753 @@
+# encode_planner.py - 按源文件的编码信息为剪切、合并、缩放选择处理方式
+import asyncio
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from mcp.types import CallToolResult, TextContent
+
+import metrics
+from ffmpeg_progress import ProgressParser, parse_time, progress_sink
+
+logger = logging.getLogger(__name__)
+
+# 由规划器执行的工具，无法规划时仍交给 MCP 服务器
+PLANNED_TOOLS = ("clip_video", "concat_videos", "scale_video")
+
+# auto 按源文件自动选择；copy / smart / encode 为指定的策略，条件不满足时退回重新编码
+STRATEGIES = ("auto", "copy", "smart", "encode")
+
+# 与硬件无关的编码预设：preset、crf 按 libx264 的含义给出，硬件编码器换算为对应的参数；
+# cost 为相对 libx264 medium 的编码耗时，用于估算加速比
+ENCODER_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 28, "cost": 0.25, "description": "最快，画质较低，适合预览"},
+    "fast": {"preset": "veryfast", "crf": 23, "cost": 0.45, "description": "较快，文件比 balanced 稍大"},
+    "balanced": {"preset": "medium", "crf": 23, "cost": 1.0, "description": "与 FFmpeg 默认的 libx264 参数相同"},
+    "quality": {"preset": "slow", "crf": 18, "cost": 1.9, "description": "较慢，画质更高"},
+}
+
+# 硬件编码器：libx264 preset 到各编码器 preset 的映射，按顺序检测
+_HW_PRESETS = {
+    "h264_nvenc": {"ultrafast": "p1", "veryfast": "p2", "medium": "p4", "slow": "p6"},
+    "h264_qsv": {"ultrafast": "veryfast", "veryfast": "faster", "medium": "medium", "slow": "slower"},
+    "h264_videotoolbox": {},
+}
+# 硬件编码和流复制相对 libx264 medium 的耗时
+HW_ENCODE_COST = 0.2
+COPY_COST = 0.02
+
+# 输出容器能直接容纳的 (视频编码, 音频编码)，None 表示不限
+_CONTAINER_CODECS = {
+    ".mp4": ({"h264", "hevc", "mpeg4", "av1"}, {"aac", "mp3", "ac3", "eac3", "alac", "opus"}),
+    ".m4v": ({"h264", "hevc", "mpeg4"}, {"aac", "mp3", "ac3", "alac"}),
+    ".mov": ({"h264", "hevc", "mpeg4", "prores", "mjpeg"}, {"aac", "mp3", "ac3", "alac", "pcm_s16le"}),
+    ".mkv": (None, None),
+    ".ts": ({"h264", "hevc", "mpeg2video"}, {"aac", "mp3", "ac3"}),
+    ".webm": ({"vp8", "vp9", "av1"}, {"opus", "vorbis"}),
+}
+# 重新编码时输出 H.264/AAC 的容器，其他容器（如 webm）交给 MCP 工具
+_H264_CONTAINERS = {".mp4", ".m4v", ".mov", ".mkv", ".ts"}
+_FASTSTART_CONTAINERS = {".mp4", ".m4v", ".mov"}
+
+# ffprobe 的 H.264 profile -> libx264 的 -profile:v，智能剪切重新编码的片段需要与源文件一致
+_H264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+    "High 10": "high10",
+    "High 4:2:2": "high422",
+    "High 4:4:4 Predictive": "high444",
+}
+
+# 查找剪切起点之后第一个关键帧的范围（秒），超出时不做智能剪切
+KEYFRAME_SEARCH = 20.0
+# 读取关键帧时在范围之后多读的时间（秒），用于确认范围末尾的关键帧之后没有前导帧
+KEYFRAME_LOOKAHEAD = 1.0
+# 智能剪切的预计耗时低于完整重新编码的这个比例时才采用
+SMART_CUT_RATIO = 0.6
+# 流复制、智能剪切结果的时长与预期的最大偏差（秒），超出时改为重新编码
+DURATION_TOLERANCE = 0.5
+PROBE_TIMEOUT = 30
+
+
+def _ratio(value):
+    try:
+        num, den = str(value).split("/")
+        return float(num) / float(den) if float(den) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def stream_info(path, ffprobe="ffprobe"):
+    """
+    用 ffprobe 读取判断能否流复制所需的编码参数
+
+    Returns:
+        dict: duration、video（codec、width、height、pix_fmt、profile、fps、frame_rate）、
+              audio（codec、sample_rate、channels）；没有对应的流时为 None，读取失败时返回 None
+    """
+    try:
+        completed = subprocess.run(
+            [ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+            capture_output=True, timeout=PROBE_TIMEOUT, check=True
+        )
+        data = json.loads(completed.stdout or b"{}")
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logger.warning(f"读取编码信息失败 {path}: {e}")
+        return None
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    try:
+        duration = float(data.get("format", {}).get("duration") or 0) or None
+    except ValueError:
+        duration = None
+    info = {"duration": duration, "video": None, "audio": None}
+    if video:
+        info["video"] = {
+            "codec": video.get("codec_name"),
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "pix_fmt": video.get("pix_fmt"),
+            "profile": video.get("profile"),
+            "fps": _ratio(video.get("avg_frame_rate")) or _ratio(video.get("r_frame_rate")),
+            "frame_rate": video.get("r_frame_rate"),
+        }
+    if audio:
+        info["audio"] = {
+            "codec": audio.get("codec_name"),
+            "sample_rate": audio.get("sample_rate"),
+            "channels": audio.get("channels"),
+        }
+    return info
+
+
+def keyframes(path, start, end, ffprobe="ffprobe"):
+    """
+    读取 [start, end] 附近可以作为剪切点的关键帧时间，只读取数据包，不解码
+
+    数据包的 K 标记也包括开放 GOP 中的非 IDR I 帧（恢复点），其后按解码顺序还有显示时间更早、
+    引用上一个 GOP 的前导帧，从这里开始复制码流会得到花屏的开头。只保留之后没有前导帧的关键帧，
+    即 IDR 或闭合 GOP 的起点。
+
+    Returns:
+        list: 关键帧时间（秒），按时间排序；包括 start 之前最近的一个关键帧
+    """
+    completed = subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+         "-of", "csv=p=0", "-read_intervals", f"{start:.6f}%{end + KEYFRAME_LOOKAHEAD:.6f}", path],
+        capture_output=True, timeout=PROBE_TIMEOUT, check=True, text=True
+    )
+    # 按解码顺序排列的 (显示时间, 是否带 K 标记)
+    packets = []
+    for line in completed.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        try:
+            packets.append((float(pts), "K" in flags))
+        except ValueError:
+            continue
+    times = []
+    later = None
+    for pts, key in reversed(packets):
+        # later: 解码顺序在其后的所有数据包中最早的显示时间，为 None 时无法确认
+        if key and pts <= end and later is not None and later >= pts:
+            times.append(pts)
+        later = pts if later is None else min(later, pts)
+    return sorted(times)
+
+
+@dataclass
+class EncodePlan:
+    """一次剪切、合并或缩放的执行计划"""
+    tool: str
+    strategy: str
+    profile: str
+    encoder: str
+    reason: str
+    expected_speedup: float
+    output: str
+    # [(FFmpeg 参数, 预计输出时长)]，在临时目录中依次执行，{tmp} 替换为临时目录
+    steps: list = field(default_factory=list)
+    # 需要写入临时目录的文件（如 concat 列表）: 文件名 -> 内容
+    files: dict = field(default_factory=dict)
+    # 最后一步写出的文件名，成功后移动到 output
+    result_name: str = ""
+    # 流复制的结果需要核对时长，防止时间戳异常导致输出被截断
+    verify_duration: float = None
+
+    def to_dict(self):
+        return {
+            "strategy": self.strategy,
+            "profile": self.profile,
+            "encoder": self.encoder,
+            "reason": self.reason,
+            "expected_speedup": self.expected_speedup,
+        }
+
+
+_STRATEGY_NAMES = {"copy": "流复制", "smart": "智能剪切", "encode": "重新编码"}
+
+
+class EncodePlanner:
+    """剪切、合并和缩放的处理策略规划
+
+    根据源文件的编码、关键帧和输出容器选择最快的处理方式，而不是按 LLM 的调用方式一律重新编码：
+    - copy: 剪切起点在关键帧上、缩放目标与源尺寸相同、待合并的视频编码参数一致时直接复制码流
+    - smart: 剪切起点不在关键帧上时，只重新编码起点到下一个关键帧之间的片段，其余部分复制码流
+    - encode: 按编码预设（draft / fast / balanced / quality）重新编码，可使用检测到的硬件编码器
+    计划和预计加速比（相对 libx264 medium 的完整重新编码）写入工具结果，并作为进度事件发出。
+    无法规划的调用（缺少参数、webm 等非 H.264 输出、音频流不一致的合并）仍交给 MCP 工具。
+    """
+
+    def __init__(self, profile="balanced", encoder="libx264", threads=0, ffmpeg=None, ffprobe=None,
+                 max_entries=256):
+        """
+        初始化规划器
+
+        Args:
+            profile: 默认的编码预设
+            encoder: 视频编码器，auto 时检测可用的硬件编码器，没有时使用 libx264
+            threads: 编码线程数，0 由 FFmpeg 决定
+            ffmpeg: ffmpeg 可执行文件，默认从 PATH 查找
+            ffprobe: ffprobe 可执行文件，默认从 PATH 查找
+            max_entries: 缓存编码信息的文件数
+        """
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"未知的编码预设: {profile}，可用: {', '.join(ENCODER_PROFILES)}")
+        self.profile = profile
+        self.threads = threads
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self.ffprobe = ffprobe or shutil.which("ffprobe")
+        self.max_entries = max_entries
+        self._encoder_setting = encoder
+        self._encoder = None
+        self._lock = threading.Lock()
+        # (路径, 大小, mtime_ns) -> 编码信息
+        self._info = OrderedDict()
+        # (工具, 策略) -> 次数，策略 mcp 表示交给了 MCP 工具
+        self._counts = {}
+
+    # ---- 编码器和预设 ----
+
+    @property
+    def encoder(self):
+        """实际使用的视频编码器，auto 时首次访问检测"""
+        if self._encoder is None:
+            self._encoder = self._detect_encoder() if self._encoder_setting == "auto" else self._encoder_setting
+            logger.info(f"视频编码器: {self._encoder}")
+        return self._encoder
+
+    def _detect_encoder(self):
+        if not self.ffmpeg:
+            return "libx264"
+        try:
+            listed = subprocess.run(
+                [self.ffmpeg, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=PROBE_TIMEOUT
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            return "libx264"
+        for encoder in _HW_PRESETS:
+            if f" {encoder} " not in listed:
+                continue
+            # 编译进 FFmpeg 不代表有对应的硬件，试编码一帧确认
+            try:
+                test = subprocess.run(
+                    [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i",
+                     "color=size=256x256:duration=0.1", "-frames:v", "1", *self._encoder_args(encoder, "fast"),
+                     "-f", "null", "-"],
+                    capture_output=True, timeout=PROBE_TIMEOUT
+                )
+            except (OSError, subprocess.SubprocessError):
+                continue
+            if test.returncode == 0:
+                return encoder
+        return "libx264"
+
+    def _encoder_args(self, encoder, profile):
+        p = ENCODER_PROFILES[profile]
+        if encoder == "libx264":
+            args = ["-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]), "-pix_fmt", "yuv420p"]
+        elif encoder == "h264_nvenc":
+            args = ["-c:v", encoder, "-preset", _HW_PRESETS[encoder][p["preset"]],
+                    "-rc", "vbr", "-cq", str(p["crf"]), "-b:v", "0", "-pix_fmt", "yuv420p"]
+        elif encoder == "h264_qsv":
+            args = ["-c:v", encoder, "-preset", _HW_PRESETS[encoder][p["preset"]],
+                    "-global_quality", str(p["crf"]), "-pix_fmt", "nv12"]
+        elif encoder == "h264_videotoolbox":
+            args = ["-c:v", encoder, "-q:v", str(max(1, min(100, 100 - 2 * p["crf"]))), "-pix_fmt", "yuv420p"]
+        else:
+            args = ["-c:v", encoder, "-pix_fmt", "yuv420p"]
+        if self.threads:
+            args += ["-threads", str(self.threads)]
+        return args
+
+    def _encode_cost(self, profile):
+        return ENCODER_PROFILES[profile]["cost"] if self.encoder == "libx264" else HW_ENCODE_COST
+
+    def profiles(self):
+        """可用的编码预设、默认预设和编码器"""
+        return {
+            "default": self.profile,
+            "encoder": self.encoder,
+            "strategies": list(STRATEGIES),
+            "profiles": {name: dict(p) for name, p in ENCODER_PROFILES.items()},
+        }
+
+    def stats(self):
+        """
+        各工具按策略统计的执行次数
+
+        Returns:
+            dict: {(工具, 策略): 次数}，策略 mcp 表示交给了 MCP 工具
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, tool, strategy):
+        with self._lock:
+            self._counts[(tool, strategy)] = self._counts.get((tool, strategy), 0) + 1
+
+    # ---- 规划 ----
+
+    def inspect(self, path):
+        """读取文件的编码信息，按路径、大小和 mtime 缓存"""
+        if not isinstance(path, str) or not self.ffprobe:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._info:
+                self._info.move_to_end(key)
+                return self._info[key]
+        info = stream_info(path, self.ffprobe)
+        if info is not None:
+            with self._lock:
+                self._info[key] = info
+                while len(self._info) > self.max_entries:
+                    self._info.popitem(last=False)
+        return info
+
+    def _base_args(self):
+        return [self.ffmpeg, "-hide_banner", "-nostdin", "-y", "-loglevel", "error", "-progress", "pipe:1", "-nostats"]
+
+    @staticmethod
+    def _copyable(info, ext):
+        """源文件的编码能否直接放入输出容器"""
+        if ext not in _CONTAINER_CODECS:
+            return False
+        video_codecs, audio_codecs = _CONTAINER_CODECS[ext]
+        if info["video"] and video_codecs is not None and info["video"]["codec"] not in video_codecs:
+            return False
+        if info["audio"] and audio_codecs is not None and info["audio"]["codec"] not in audio_codecs:
+            return False
+        return True
+
+    @staticmethod
+    def _audio_args(info, ext):
+        """重新编码视频时，音频能直接复制就不重新编码"""
+        if not info["audio"]:
+            return []
+        audio_codecs = _CONTAINER_CODECS.get(ext, ((), ()))[1]
+        if audio_codecs is None or info["audio"]["codec"] in audio_codecs:
+            return ["-c:a", "copy"]
+        return ["-c:a", "aac", "-b:a", "192k"]
+
+    @staticmethod
+    def _mux_args(ext):
+        return ["-movflags", "+faststart"] if ext in _FASTSTART_CONTAINERS else []
+
+    def _new_plan(self, tool, strategy, profile, reason, baseline, cost, output):
+        speedup = round(baseline / cost, 1) if cost > 0 else 1.0
+        encoder = "copy" if strategy == "copy" else ("libx264" if strategy == "smart" else self.encoder)
+        return EncodePlan(tool, strategy, profile, encoder, reason, speedup, output,
+                          result_name="output" + os.path.splitext(output)[1].lower())
+
+    def plan(self, tool, arguments, profile=None, strategy="auto"):
+        """
+        为一次工具调用制定计划
+
+        Args:
+            tool: 工具名
+            arguments: 工具参数
+            profile: 编码预设，默认使用初始化时的预设
+            strategy: auto / copy / smart / encode
+
+        Returns:
+            EncodePlan: 执行计划；无法规划时返回 None，由 MCP 工具执行
+        """
+        if tool not in PLANNED_TOOLS or not self.ffmpeg or not self.ffprobe:
+            return None
+        output = arguments.get("output_path")
+        if not isinstance(output, str) or not output:
+            return None
+        profile = profile or self.profile
+        if tool == "clip_video":
+            return self._plan_clip(arguments, output, profile, strategy)
+        if tool == "scale_video":
+            return self._plan_scale(arguments, output, profile, strategy)
+        return self._plan_concat(arguments, output, profile, strategy)
+
+    def _plan_clip(self, arguments, output, profile, strategy):
+        path = arguments.get("video_path")
+        info = self.inspect(path)
+        if not info or not info["video"]:
+            return None
+        start = parse_time(arguments.get("start")) or 0.0
+        end = parse_time(arguments.get("end"))
+        length = parse_time(arguments.get("duration"))
+        if length:
+            end = start + length
+        if info["duration"] and (end is None or end > info["duration"]):
+            end = info["duration"]
+        if end is None or end <= start:
+            return None
+        duration = end - start
+        ext = os.path.splitext(output)[1].lower()
+        copyable = self._copyable(info, ext)
+        fps = info["video"]["fps"] or 25.0
+        tolerance = 0.5 / fps
+
+        reason = "指定重新编码"
+        if strategy != "encode" and not copyable:
+            reason = f"源文件的编码不能直接放入 {ext or '该'} 容器"
+        elif strategy != "encode":
+            frames = keyframes(path, start, min(end, start + KEYFRAME_SEARCH), self.ffprobe) if start else [0.0]
+            previous = [t for t in frames if t <= start + tolerance]
+            aligned = not start or (previous and start - previous[-1] <= tolerance)
+            if aligned or strategy == "copy":
+                note = "剪切起点在关键帧上" if aligned else (
+                    f"指定流复制，起点对齐到之前的关键帧 {previous[-1]:.3f} 秒" if previous else "指定流复制"
+                )
+                plan = self._new_plan("clip_video", "copy", profile, note, duration, duration * COPY_COST, output)
+                plan.steps.append(([
+                    *self._base_args(), "-ss", f"{start:.6f}", "-i", path, "-t", f"{duration:.6f}",
+                    "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-avoid_negative_ts", "make_zero",
+                    *self._mux_args(ext), "{tmp}/" + plan.result_name
+                ], duration))
+                plan.verify_duration = duration if aligned else None
+                return plan
+            following = [t for t in frames if start + tolerance < t < end]
+            h264_profile = _H264_PROFILES.get(info["video"]["profile"])
+            if not following:
+                reason = f"剪切起点之后 {KEYFRAME_SEARCH:.0f} 秒内没有可作为剪切点的 IDR 关键帧"
+            elif info["video"]["codec"] != "h264" or not h264_profile or ext not in _H264_CONTAINERS:
+                reason = "剪切起点不在关键帧上，源文件不支持智能剪切"
+            else:
+                keyframe = following[0]
+                head = keyframe - start
+                cost = head * ENCODER_PROFILES[profile]["cost"] + (end - keyframe) * COPY_COST
+                if strategy == "smart" or cost < SMART_CUT_RATIO * duration * self._encode_cost(profile):
+                    plan = self._new_plan(
+                        "clip_video", "smart", profile,
+                        f"剪切起点不在关键帧上，只重新编码开头 {head:.2f} 秒", duration, cost, output
+                    )
+                    self._smart_cut_steps(plan, path, info, ext, start, keyframe, end, profile, h264_profile)
+                    return plan
+                reason = "剪切起点不在关键帧上，片段较短，完整重新编码更快"
+
+        if ext not in _H264_CONTAINERS:
+            return None
+        plan = self._new_plan(
+            "clip_video", "encode", profile, reason, duration, duration * self._encode_cost(profile), output
+        )
+        plan.steps.append(([
+            *self._base_args(), "-ss", f"{start:.6f}", "-i", path, "-t", f"{duration:.6f}",
+            "-map", "0:v:0", "-map", "0:a:0?", *self._encoder_args(self.encoder, profile),
+            *self._audio_args(info, ext), *self._mux_args(ext), "{tmp}/" + plan.result_name
+        ], duration))
+        return plan
+
+    def _smart_cut_steps(self, plan, path, info, ext, start, keyframe, end, profile, h264_profile):
+        """
+        智能剪切：起点到下一个关键帧之间用与源文件相同的 profile 和像素格式重新编码，
+        其余部分复制码流，两段以 MPEG-TS 拼接（参数集随码流携带），音频从源文件直接复制
+        """
+        p = ENCODER_PROFILES[profile]
+        head, tail = keyframe - start, end - keyframe
+        plan.files["parts.txt"] = "file 'head.ts'\nfile 'tail.ts'\n"
+        plan.steps.append(([
+            *self._base_args(), "-ss", f"{start:.6f}", "-i", path, "-t", f"{head:.6f}",
+            "-map", "0:v:0", "-an", "-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]),
+            "-profile:v", h264_profile, "-pix_fmt", info["video"]["pix_fmt"] or "yuv420p",
+            *(["-threads", str(self.threads)] if self.threads else []),
+            "-f", "mpegts", "{tmp}/head.ts"
+        ], head))
+        plan.steps.append(([
+            *self._base_args(), "-ss", f"{keyframe:.6f}", "-i", path, "-t", f"{tail:.6f}",
+            "-map", "0:v:0", "-an", "-c:v", "copy", "-f", "mpegts", "{tmp}/tail.ts"
+        ], tail))
+        plan.steps.append(([
+            *self._base_args(), "-f", "concat", "-safe", "0", "-i", "{tmp}/parts.txt",
+            "-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", path,
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", *self._audio_args(info, ext),
+            *self._mux_args(ext), "{tmp}/" + plan.result_name
+        ], end - start))
+        plan.verify_duration = end - start
+
+    @staticmethod
+    def _dimension(value):
+        try:
+            number = int(str(value).strip())
+        except (TypeError, ValueError):
+            return None
+        return number if number > 0 or number in (-1, -2) else None
+
+    def _plan_scale(self, arguments, output, profile, strategy):
+        path = arguments.get("video_path")
+        info = self.inspect(path)
+        width, height = self._dimension(arguments.get("width")), self._dimension(arguments.get("height"))
+        if not info or not info["video"] or width is None or height is None or (width < 0 and height < 0):
+            return None
+        src_w, src_h = info["video"]["width"], info["video"]["height"]
+        duration = info["duration"] or 1.0
+        ext = os.path.splitext(output)[1].lower()
+        if src_w and src_h:
+            target_w = width if width > 0 else round(src_w * height / src_h)
+            target_h = height if height > 0 else round(src_h * width / src_w)
+            same = abs(target_w - src_w) <= 1 and abs(target_h - src_h) <= 1
+        else:
+            same = False
+
+        if same and strategy != "encode" and self._copyable(info, ext):
+            plan = self._new_plan(
+                "scale_video", "copy", profile, "目标尺寸与源文件相同，直接复制码流",
+                duration, duration * COPY_COST, output
+            )
+            plan.steps.append(([
+                *self._base_args(), "-i", path, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy",
+                *self._mux_args(ext), "{tmp}/" + plan.result_name
+            ], duration))
+            plan.verify_duration = info["duration"]
+            return plan
+        if ext not in _H264_CONTAINERS:
+            return None
+        audio = self._audio_args(info, ext)
+        reason = "缩放需要重新编码" + ("，音频直接复制" if audio[-1:] == ["copy"] else "")
+        plan = self._new_plan(
+            "scale_video", "encode", profile, reason, duration, duration * self._encode_cost(profile), output
+        )
+        # -1 保持宽高比时取偶数，yuv420p 要求宽高为偶数
+        scale = f"scale={-2 if width < 0 else width}:{-2 if height < 0 else height}"
+        plan.steps.append(([
+            *self._base_args(), "-i", path, "-map", "0:v:0", "-map", "0:a:0?", "-vf", scale,
+            *self._encoder_args(self.encoder, profile), *audio, *self._mux_args(ext), "{tmp}/" + plan.result_name
+        ], duration))
+        return plan
+
+    @staticmethod
+    def _signature(info):
+        video, audio = info["video"], info["audio"]
+        return (
+            video["codec"], video["width"], video["height"], video["pix_fmt"], video["profile"],
+            video["frame_rate"],
+            audio and (audio["codec"], audio["sample_rate"], audio["channels"]),
+        )
+
+    def _plan_concat(self, arguments, output, profile, strategy):
+        files = arguments.get("input_files")
+        if not isinstance(files, list) or len(files) < 2:
+            return None
+        infos = [self.inspect(path) for path in files]
+        if any(not info or not info["video"] for info in infos):
+            return None
+        total = sum(info["duration"] or 0.0 for info in infos) or 1.0
+        ext = os.path.splitext(output)[1].lower()
+        same = len({self._signature(info) for info in infos}) == 1
+
+        if strategy != "encode" and arguments.get("fast", True) is not False \
+                and same and self._copyable(infos[0], ext):
+            plan = self._new_plan(
+                "concat_videos", "copy", profile, "所有视频的编码参数一致，直接拼接码流",
+                total, total * COPY_COST, output
+            )
+            plan.files["inputs.txt"] = "".join(
+                "file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")) for path in files
+            )
+            plan.steps.append(([
+                *self._base_args(), "-f", "concat", "-safe", "0", "-i", "{tmp}/inputs.txt",
+                "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", *self._mux_args(ext), "{tmp}/" + plan.result_name
+            ], total))
+            plan.verify_duration = total if all(info["duration"] for info in infos) else None
+            return plan
+
+        has_audio = {bool(info["audio"]) for info in infos}
+        if ext not in _H264_CONTAINERS or len(has_audio) > 1:
+            return None
+        audio = has_audio.pop()
+        if strategy == "encode" or arguments.get("fast", True) is False:
+            reason = "指定重新编码"
+        elif not same:
+            reason = "视频的编码参数不一致，统一为第一个视频的尺寸和帧率后重新编码"
+        else:
+            reason = f"编码不能直接放入 {ext} 容器"
+        plan = self._new_plan(
+            "concat_videos", "encode", profile, reason, total, total * self._encode_cost(profile), output
+        )
+        first = infos[0]["video"]
+        width, height = (first["width"] or 1280) // 2 * 2, (first["height"] or 720) // 2 * 2
+        frame_rate = first["frame_rate"] if _ratio(first["frame_rate"]) else "25"
+        filters = []
+        inputs = []
+        for i, path in enumerate(files):
+            inputs += ["-i", path]
+            filters.append(
+                f"[{i}:v:0]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={frame_rate}[v{i}]"
+            )
+            if audio:
+                filters.append(f"[{i}:a:0]aresample=48000,aformat=channel_layouts=stereo[a{i}]")
+        pads = "".join(f"[v{i}]" + (f"[a{i}]" if audio else "") for i in range(len(files)))
+        filters.append(f"{pads}concat=n={len(files)}:v=1:a={int(audio)}[v]" + ("[a]" if audio else ""))
+        plan.steps.append(([
+            *self._base_args(), *inputs, "-filter_complex", ";".join(filters), "-map", "[v]",
+            *(["-map", "[a]", "-c:a", "aac", "-b:a", "192k"] if audio else []),
+            *self._encoder_args(self.encoder, profile), *self._mux_args(ext), "{tmp}/" + plan.result_name
+        ], total))
+        return plan
+
+    # ---- 执行 ----
+
+    async def _run_step(self, command, duration, tool, sink):
+        parser = ProgressParser(duration)
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            while True:
+                data = await process.stdout.read(4096)
+                if not data:
+                    break
+                for update in parser.feed(data.decode("utf-8", errors="replace")):
+                    if sink:
+                        sink({"type": "ffmpeg_progress", "tool": tool, **update})
+            stderr = await stderr_task
+            await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            message = stderr.decode("utf-8", errors="replace").strip()[-500:]
+            raise RuntimeError(f"FFmpeg 执行失败: {message or process.returncode}")
+
+    async def execute(self, plan, sink=None):
+        """
+        执行计划：中间文件和输出先写入输出目录下的临时目录，全部成功后再移动到输出位置
+
+        Returns:
+            float: 执行耗时（秒）
+        """
+        started = time.monotonic()
+        output_dir = os.path.dirname(os.path.abspath(plan.output))
+        os.makedirs(output_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".encode-", dir=output_dir)
+        try:
+            for name, content in plan.files.items():
+                with open(os.path.join(tmp, name), "w", encoding="utf-8") as f:
+                    f.write(content)
+            with metrics.ffmpeg_running("tool"):
+                for command, duration in plan.steps:
+                    command = [arg.replace("{tmp}", tmp) if arg.startswith("{tmp}") else arg for arg in command]
+                    logger.debug(f"执行: {' '.join(command)}")
+                    await self._run_step(command, duration, plan.tool, sink)
+            result = os.path.join(tmp, plan.result_name)
+            if plan.verify_duration:
+                info = await asyncio.to_thread(stream_info, result, self.ffprobe)
+                actual = info and info["duration"]
+                if not actual or abs(actual - plan.verify_duration) > DURATION_TOLERANCE:
+                    raise RuntimeError(f"输出时长 {actual} 秒与预期的 {plan.verify_duration:.2f} 秒不符")
+            os.replace(result, plan.output)
+        finally:
+            await asyncio.to_thread(shutil.rmtree, tmp, True)
+        return time.monotonic() - started
+
+    @staticmethod
+    def _result(payload, is_error=False):
+        text = json.dumps(payload, ensure_ascii=False)
+        return CallToolResult(content=[TextContent(type="text", text=text)], isError=is_error)
+
+    @staticmethod
+    def _announce(sink, plan):
+        if sink:
+            name = _STRATEGY_NAMES[plan.strategy]
+            sink({
+                "type": "progress",
+                "tool": plan.tool,
+                "encode_plan": plan.to_dict(),
+                "message": f"🧭 {plan.tool} 采用{name}（{plan.reason}），预计比完整重新编码快 {plan.expected_speedup} 倍",
+            })
+
+    async def call(self, tool_name, arguments, call_tool):
+        """
+        执行工具调用：能规划时按计划直接运行 FFmpeg，否则交给 call_tool
+
+        Args:
+            tool_name: 工具名
+            arguments: 工具参数，可以包含 profile（编码预设）和 strategy（策略）
+            call_tool: 交给 MCP 工具执行的函数 call_tool(tool_name, arguments)
+
+        Returns:
+            CallToolResult: 与 MCP 工具相同格式的结果，规划执行时为包含输出路径和计划的 JSON
+        """
+        if tool_name not in PLANNED_TOOLS or not isinstance(arguments, dict):
+            return await call_tool(tool_name, arguments)
+        arguments = dict(arguments)
+        profile = arguments.pop("profile", None) or self.profile
+        strategy = arguments.pop("strategy", None) or "auto"
+        if profile not in ENCODER_PROFILES:
+            return self._result({"error": f"未知的编码预设: {profile}，可用: {', '.join(ENCODER_PROFILES)}"}, True)
+        if strategy not in STRATEGIES:
+            return self._result({"error": f"未知的处理策略: {strategy}，可用: {', '.join(STRATEGIES)}"}, True)
+
+        try:
+            plan = await asyncio.to_thread(self.plan, tool_name, arguments, profile, strategy)
+        except Exception as e:
+            logger.warning(f"规划 {tool_name} 失败，交给 MCP 工具执行: {e}")
+            plan = None
+        if plan is None:
+            self._count(tool_name, "mcp")
+            return await call_tool(tool_name, arguments)
+
+        sink = progress_sink.get()
+        self._announce(sink, plan)
+        try:
+            elapsed = await self.execute(plan, sink)
+        except Exception as e:
+            if plan.strategy == "encode":
+                logger.error(f"{tool_name} 执行失败: {e}")
+                return self._result({"error": str(e), **plan.to_dict()}, True)
+            # 流复制或智能剪切的结果不可用（如时间戳异常），改为完整重新编码
+            logger.warning(f"{tool_name} {_STRATEGY_NAMES[plan.strategy]}失败，改为重新编码: {e}")
+            failed = _STRATEGY_NAMES[plan.strategy]
+            plan = await asyncio.to_thread(self.plan, tool_name, arguments, profile, "encode")
+            if plan is None:
+                self._count(tool_name, "mcp")
+                return await call_tool(tool_name, arguments)
+            plan.reason = f"{failed}失败，改为重新编码"
+            self._announce(sink, plan)
+            try:
+                elapsed = await self.execute(plan, sink)
+            except Exception as e:
+                logger.error(f"{tool_name} 执行失败: {e}")
+                return self._result({"error": str(e), **plan.to_dict()}, True)
+        self._count(tool_name, plan.strategy)
+        logger.info(f"{tool_name} 采用{_STRATEGY_NAMES[plan.strategy]}完成，耗时 {elapsed:.2f} 秒: {plan.output}")
+        return self._result({
+            "success": True,
+            "output_path": plan.output,
+            **plan.to_dict(),
+            "elapsed_seconds": round(elapsed, 3),
+        })
@@ -0,0 +1,103 @@
+# event_channel.py - 支持多订阅者和断线重放的事件通道
+import asyncio
+from collections import deque
+
+
+class EventChannel:
+    """单个请求的事件广播通道
+
+    事件按发布顺序编号（从 1 开始），最近的 max_events 条保存在环形缓冲区中。
+    订阅者之间共享同一个唤醒信号，空闲的订阅者只是挂起在 Event 上，不占用 CPU；
+    断线重连时可以从 Last-Event-ID 之后继续接收，通道关闭后订阅者在取完事件后退出。
+    """
+
+    def __init__(self, max_events=1000):
+        """
+        初始化事件通道
+
+        Args:
+            max_events: 缓冲区保存的事件数量上限，更早的事件无法重放
+        """
+        self._buffer = deque(maxlen=max_events)
+        self._last_id = 0
+        self._closed = False
+        self._changed = asyncio.Event()
+
+    @property
+    def last_id(self):
+        """最近一条事件的编号，尚无事件时为 0"""
+        return self._last_id
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def publish(self, event, event_id=None):
+        """
+        发布一条事件
+
+        Args:
+            event: 事件内容
+            event_id: 事件编号，默认为上一条加一；转发其他进程的事件时沿用原编号，必须递增
+
+        Returns:
+            int: 事件编号
+        """
+        if self._closed:
+            raise RuntimeError("事件通道已关闭")
+        if event_id is None:
+            event_id = self._last_id + 1
+        elif event_id <= self._last_id:
+            raise ValueError(f"事件编号必须递增: {event_id} <= {self._last_id}")
+        self._last_id = event_id
+        self._buffer.append((self._last_id, event))
+        self._wake()
+        return self._last_id
+
+    def close(self):
+        """关闭通道，订阅者取完剩余事件后结束"""
+        if not self._closed:
+            self._closed = True
+            self._wake()
+
+    def _wake(self):
+        # 唤醒当前所有等待者，后续等待者使用新的 Event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def events_after(self, last_event_id=0):
+        """
+        缓冲区中编号大于 last_event_id 的事件
+
+        Returns:
+            list: [(编号, 事件)]
+        """
+        if not self._buffer or last_event_id >= self._last_id:
+            return []
+        first_id = self._buffer[0][0]
+        # 编号连续时直接定位；转发的事件编号有跳跃时向前回退到第一条编号更大的事件
+        start = min(max(0, last_event_id + 1 - first_id), len(self._buffer))
+        while start > 0 and self._buffer[start - 1][0] > last_event_id:
+            start -= 1
+        return [self._buffer[i] for i in range(start, len(self._buffer))]
+
+    async def subscribe(self, last_event_id=0):
+        """
+        订阅事件，先重放 last_event_id 之后仍在缓冲区中的事件，再实时接收新事件
+
+        Args:
+            last_event_id: 客户端已收到的最后一条事件编号
+
+        Yields:
+            tuple: (编号, 事件)
+        """
+        cursor = last_event_id
+        while True:
+            changed = self._changed
+            for event_id, event in self.events_after(cursor):
+                cursor = event_id
+                yield event_id, event
+            if self._closed and cursor >= self._last_id:
+                return
+            if cursor >= self._last_id:
+                await changed.wait()
@@ -1,22 +1,53 @@
 # ffmpeg_mcp_demo.py - FFmpeg MCP 服务器调用示例
 import asyncio
+import copy
+import functools
+import json
 import os
+import shutil
+import time
+import uuid
+from contextlib import aclosing, asynccontextmanager
+from contextvars import ContextVar
+import httpx
 from dotenv import load_dotenv
+from openai import AsyncOpenAI
 from mcp import StdioServerParameters
+from mcp.client.stdio import get_default_environment
 from mcp_llm_bridge.config import BridgeConfig, LLMConfig
 from mcp_llm_bridge.bridge import BridgeManager
 import logging
 
+from bridge_pool import BridgePool
+from tool_cache import result_text
+from ffmpeg_progress import progress_sink, ProgressMonitor, DurationHints, expected_duration
+from prompts import build_system_prompt, ToolSchemas, UsageStats, usage_of
+from llm_scheduler import LLMScheduler
+from think_parser import ThinkParser
+import metrics
+
 # Setup logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# 单个请求中 LLM 连续调用工具的最大轮数，避免模型陷入循环
+MAX_TOOL_ROUNDS = 10
+
+# 当前请求执行工具调用的方式 runner(tool_name, call)，call 是执行实际调用的协程函数；
+# 为空时在当前任务中直接执行。Web 服务借此只把工具调用放进任务队列，LLM 对话本身不占用 worker
+tool_runner = ContextVar("tool_runner", default=None)
+
+
+class ToolCallError(Exception):
+    """MCP 工具执行失败"""
+
 
 class FFmpegMCPClient:
     """FFmpeg MCP客户端，用于与ffmpeg-mcp服务器交互"""
     
-    def __init__(self, api_key=None, model=None, base_url=None):
+    def __init__(self, api_key=None, model=None, base_url=None, tool_cache=None, report_dir=None,
+                 plan_cache=None, prompt_variant=None, llm_scheduler=None, encode_planner=None):
         """
         初始化FFmpeg MCP客户端
         
@@ -24,6 +55,12 @@ class FFmpegMCPClient:
             api_key: NVIDIA API密钥
             model: 使用的模型名称
             base_url: API基础URL
+            tool_cache: 工具调用结果缓存（ToolResultCache），为空时不缓存
+            report_dir: FFmpeg 日志目录，用于解析处理进度，默认为 storage/ffreport
+            plan_cache: 相同请求的工具调用计划缓存（PlanCache），为空时每个请求都经过 LLM
+            prompt_variant: 系统提示词和工具定义的版本 full / compact，默认读取 SYSTEM_PROMPT_VARIANT
+            llm_scheduler: LLM 请求调度器（LLMScheduler），负责并发、速率、超时、重试和对冲
+            encode_planner: 剪切、合并、缩放的处理策略规划（EncodePlanner），为空时全部交给 MCP 工具
         """
         load_dotenv()
         
@@ -41,8 +78,11 @@ class FFmpegMCPClient:
             ("nvapi-eVqx3Byag8gqjACkiH0lPHIq-_eN1JMkqM2NSyJUYoYQIx0v"
              "V9OPSJSOaS70Jkd1")
         )
-        self.model = model or "nvidia/llama-3.1-nemotron-ultra-253b-v1"
-        self.base_url = base_url or "https://integrate.api.nvidia.com/v1"
+        self.model = model or os.getenv("NVIDIA_MODEL", "nvidia/llama-3.1-nemotron-ultra-253b-v1")
+        self.base_url = base_url or os.getenv("NVIDIA_BASE_URL", "https://integrate.api.nvidia.com/v1")
+        self.prompt_variant = prompt_variant or os.getenv("SYSTEM_PROMPT_VARIANT", "full")
+        # 流式补全的最后一个分块返回 token 用量；不支持 stream_options 的服务设置 LLM_STREAM_USAGE=0
+        self.stream_usage = os.getenv("LLM_STREAM_USAGE", "1") != "0"
         
         # 配置ffmpeg-mcp服务器参数
         self.config = BridgeConfig(
@@ -61,36 +101,128 @@ class FFmpegMCPClient:
                 model=self.model,
                 base_url=self.base_url
             ),
-            system_prompt=(
-                "你是一个专业的视频处理助手，可以使用FFmpeg工具来帮助用户进行视频编辑、"
-                "剪切、合并、格式转换等操作。\n\n"
-                "可用的工具及其完整名称（请务必使用完整的工具名称）：\n"
-                "1. find_video_path - 查找视频文件路径\n"
-                "2. get_video_info - 获取视频信息\n"
-                "3. clip_video - 剪切视频片段\n"
-                "4. concat_videos - 合并多个视频\n"
-                "5. play_video - 播放视频\n"
-                "6. overlay_video - 视频叠加效果\n"
-                "7. scale_video - 视频缩放\n"
-                "8. extract_frames_from_video - 提取视频帧为图片（注意：必须使用完整名称）\n"
-                "9. extract_audio_from_video - 提取视频中的音频（注意：必须使用完整名称）\n\n"
-                "重要：调用工具时必须使用上述完整的工具名称，不要使用简化名称！\n\n"
-                "请根据用户的需求选择合适的工具并执行相应操作,在你对视频进行操作之前请获取视频信息再进行。\n"
-                f"上传文件的绝对路径在: {uploads_dir}\n"
-                f"输出文件的绝对路径在: {outputs_dir}\n"
-                "重要提示：\n"
-                "- 当用户消息中包含'当前选中的文件:'信息时，请优先使用这些具体的文件路径\n"
-                "- 如果用户提到'input.mp4'等通用文件名，请替换为实际选中的文件路径\n"
-                "- 始终使用完整的绝对路径来访问文件\n"
-                "- 输出文件应保存到outputs目录中\n"
-                "- 调用工具时必须使用完整的工具名称，例如使用'extract_frames_from_video'而不是'extract_frames'\n"
-                "响应格式要求：\n"
-                "- 请详细说明你调用了哪些工具\n"
-                "- 说明每个工具的具体参数\n"
-                "- 报告执行结果和生成的文件路径\n"
-                "- 如果有FFmpeg命令执行，请说明具体的命令内容\n"
-            )
+            system_prompt=build_system_prompt(uploads_dir, outputs_dir, self.prompt_variant)
+        )
+        
+        # 常驻桥接会话池，未启动时每个请求单独创建会话
+        self.pool = None
+        self.tool_cache = tool_cache
+        self.plan_cache = plan_cache
+        self.encode_planner = encode_planner
+        # 流式调用 LLM 的异步客户端，首次使用时创建；所有会话共用其 HTTP 连接池
+        self._llm = None
+        self.llm_scheduler = llm_scheduler or LLMScheduler()
+        # 每个桥接会话的 FFmpeg 日志写入此目录下的独立子目录
+        self.report_dir = report_dir or os.path.join(project_root, "storage", "ffreport")
+        self.duration_hints = DurationHints()
+        # 发送给 LLM 的工具定义（排序固定，保证请求前缀不变）和 token 用量统计
+        self.tool_schemas = ToolSchemas(self.prompt_variant)
+        self.usage = UsageStats()
+    
+    async def start_pool(self, min_size=1, max_size=4, max_requests=100,
+                         health_check_interval=30.0):
+        """
+        启动常驻桥接会话池
+        
+        Args:
+            min_size: 常驻会话的最小数量
+            max_size: 会话的最大数量
+            max_requests: 单个会话处理多少个请求后回收
+            health_check_interval: 空闲会话健康检查的间隔（秒）
+        """
+        if self.pool is not None:
+            return
+        pool = BridgePool(
+            self._open_bridge,
+            min_size=min_size,
+            max_size=max_size,
+            max_requests=max_requests,
+            health_check_interval=health_check_interval
         )
+        await pool.start()
+        self.pool = pool
+    
+    async def close_pool(self):
+        """关闭常驻桥接会话池"""
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+    
+    def _session_config(self, session_dir):
+        """为会话生成独立的配置：通过 FFREPORT 让服务器中的 FFmpeg 把日志写入会话目录"""
+        params = self.config.mcp_server_params
+        report = session_dir.replace("\\", "\\\\").replace(":", "\\:")
+        env = {
+            **get_default_environment(),
+            **(params.env or {}),
+            "FFREPORT": f"file={report}/%p-%t.log:level=32"
+        }
+        config = copy.copy(self.config)
+        config.mcp_server_params = params.model_copy(update={"env": env})
+        return config
+    
+    @asynccontextmanager
+    async def _open_bridge(self):
+        """创建桥接会话，接入进度监控和工具调用缓存"""
+        session_dir = os.path.join(self.report_dir, uuid.uuid4().hex)
+        os.makedirs(session_dir, exist_ok=True)
+        started = time.perf_counter()
+        try:
+            async with BridgeManager(self._session_config(session_dir)) as bridge:
+                # 启动 MCP 服务器子进程并完成握手
+                metrics.observe("bridge_start", time.perf_counter() - started)
+                call_tool = bridge.mcp_client.call_tool
+                
+                async def monitored_call_tool(tool_name, arguments):
+                    if self.tool_cache is not None:
+                        # 输出位置可能是 blob 的硬链接，交给 FFmpeg 覆盖写入前先解除
+                        await asyncio.to_thread(self.tool_cache.prepare_output, tool_name, arguments)
+                    sink = progress_sink.get()
+                    with metrics.ffmpeg_running("tool"):
+                        if sink is None or not isinstance(arguments, dict):
+                            return await call_tool(tool_name, arguments)
+                        input_path = arguments.get("video_path") or arguments.get("background_video")
+                        duration = expected_duration(
+                            tool_name, arguments, self.duration_hints.get(input_path)
+                        )
+                        monitor = ProgressMonitor(session_dir, sink, tool_name, duration)
+                        return await monitor.run(call_tool(tool_name, arguments))
+                
+                async def planned_call_tool(tool_name, arguments):
+                    # 剪切、合并、缩放按源文件选择流复制、智能剪切或编码预设，无法规划时交给 MCP 工具
+                    if self.encode_planner is None:
+                        return await monitored_call_tool(tool_name, arguments)
+                    return await self.encode_planner.call(tool_name, arguments, monitored_call_tool)
+                
+                async def session_call_tool(tool_name, arguments):
+                    with metrics.span(f"tool.{tool_name}"):
+                        if self.tool_cache is not None:
+                            result = await self.tool_cache.call(tool_name, arguments, planned_call_tool)
+                        else:
+                            result = await planned_call_tool(tool_name, arguments)
+                    if tool_name == "get_video_info" and isinstance(arguments, dict):
+                        self.duration_hints.remember(arguments.get("video_path"), result_text(result))
+                    return result
+                
+                bridge.mcp_client.call_tool = session_call_tool
+                yield bridge
+        finally:
+            shutil.rmtree(session_dir, ignore_errors=True)
+    
+    @asynccontextmanager
+    async def _bridge_session(self):
+        """获取一个桥接会话：优先从会话池借出，否则临时创建"""
+        if self.pool is None:
+            async with self._open_bridge() as bridge:
+                yield bridge
+            return
+        started = time.perf_counter()
+        async with self.pool.session() as bridge:
+            metrics.observe("pool_acquire", time.perf_counter() - started)
+            # 复用的会话需要清空上一个请求的对话历史
+            if hasattr(bridge, "llm_client"):
+                bridge.llm_client.messages = []
+            yield bridge
     
     async def process_video_request(self, user_input):
         """
@@ -100,12 +232,14 @@ class FFmpegMCPClient:
             user_input: 用户输入的请求
             
         Returns:
-            处理结果
+            处理结果（不含思考过程）
         """
         try:
-            async with BridgeManager(self.config) as bridge:
-                response = await bridge.process_message(user_input)
-                return response
+            chunks = []
+            async for event in self.stream_video_request(user_input):
+                if event["type"] == "response_chunk":
+                    chunks.append(event["content"])
+            return "".join(chunks).strip()
         except Exception as e:
             logger.error(f"处理请求时发生错误: {e}")
             return f"错误: {e}"
@@ -122,96 +256,332 @@ class FFmpegMCPClient:
             处理结果
         """
         try:
-            if progress_callback:
-                await progress_callback("🔍 正在分析您的请求...")
+            thinking = []
+            chunks = []
+            async for event in self.stream_video_request(user_input):
+                if event["type"] == "response_chunk":
+                    chunks.append(event["content"])
+                elif event["type"] == "thinking_chunk":
+                    thinking.append(event["content"])
+                elif progress_callback and "message" in event:
+                    await progress_callback(event["message"])
             
-            async with BridgeManager(self.config) as bridge:
-                if progress_callback:
-                    await progress_callback("🤖 正在调用AI助手分析请求...")
-                
-                # 这里我们可以添加更详细的日志记录
-                logger.info(f"开始处理请求: {user_input}")
-                
-                if progress_callback:
-                    await progress_callback("⚙️ 正在执行FFmpeg工具调用...")
-                
-                # 获取完整的响应，包括思考过程
-                response = await bridge.process_message(user_input)
-                
-                if progress_callback:
-                    await progress_callback("✅ 处理完成，正在整理结果...")
-                
-                # 分离思考过程和最终结果
-                thinking_process, final_result = self._separate_thinking_and_result(response)
-                
-                # 如果有思考过程，通过回调发送
-                if thinking_process and progress_callback:
-                    await progress_callback(f"💭 AI思考过程：\n{thinking_process}")
-                
-                return final_result
+            thinking_process = "".join(thinking).strip()
+            if thinking_process and progress_callback:
+                await progress_callback(f"💭 AI思考过程：\n{thinking_process}")
+            return "".join(chunks).strip()
         except Exception as e:
             logger.error(f"处理请求时发生错误: {e}")
             if progress_callback:
                 await progress_callback(f"❌ 处理失败: {str(e)}")
             return f"错误: {e}"
     
-    def _separate_thinking_and_result(self, response):
-        """
-        分离AI响应中的思考过程和最终结果
-        
-        Args:
-            response: AI的完整响应
-            
-        Returns:
-            tuple: (thinking_process, final_result)
+    def _llm_client(self):
+        if self._llm is None:
+            # 重试和超时由调度器负责，SDK 自身不再重试
+            connections = self.llm_scheduler.max_concurrent * 2
+            self._llm = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+                    timeout=httpx.Timeout(self.llm_scheduler.timeout, connect=10.0)
+                )
+            )
+        return self._llm
+    
+    async def close(self):
+        """关闭会话池和 LLM 的 HTTP 连接"""
+        await self.close_pool()
+        if self._llm is not None:
+            llm, self._llm = self._llm, None
+            await llm.close()
+    
+    async def stream_video_request(self, user_input, use_plan_cache=True):
         """
-        # 查找<think>标签
-        import re
+        流式处理视频相关请求，模型输出和工具调用在发生时即产出事件
         
-        # 匹配<think>...</think>标签
-        think_pattern = r'<think>(.*?)</think>'
-        think_matches = re.findall(think_pattern, response, re.DOTALL)
+        相同的请求（文件路径除外）命中计划缓存时，直接按缓存的工具调用序列执行，不再请求 LLM；
+        重放失败时删除该计划并回退到 LLM。
         
-        # 提取思考过程
-        thinking_process = ""
-        if think_matches:
-            thinking_process = "\n".join(think_matches).strip()
+        事件类型：
+            progress: 处理阶段提示，{"message"}
+            thinking_chunk: 模型思考过程的增量文本，{"content"}
+            response_chunk: 模型回复的增量文本，{"content"}
+            tool_call: 开始执行工具，{"tool", "arguments", "message"}
+            tool_result: 工具执行结束，{"tool", "success", "message"}
+            usage: 本次请求的 LLM token 用量，{"completions", "prompt_tokens", "completion_tokens", "cached_tokens"}
         
-        # 移除思考过程，得到最终结果
-        final_result = re.sub(think_pattern, '', response, flags=re.DOTALL).strip()
+        Args:
+            user_input: 用户输入的请求
+            use_plan_cache: 是否使用计划缓存
+        """
+        yield {"type": "progress", "message": "🔍 正在分析您的请求..."}
+        plan_request = None
+        if use_plan_cache and self.plan_cache is not None:
+            plan_request = await asyncio.to_thread(self.plan_cache.prepare, user_input, self.model)
+        if plan_request is not None:
+            plan = await asyncio.to_thread(self.plan_cache.get, plan_request)
+            if plan:
+                executed = []
+                async for event in self._replay_plan(plan, executed):
+                    yield event
+                if len(executed) == len(plan) and all(call["success"] for call in executed):
+                    yield {"type": "response_chunk", "content": self._plan_summary(executed)}
+                    return
+                await asyncio.to_thread(self.plan_cache.invalidate, plan_request.key)
+                yield {"type": "progress", "message": "🔁 缓存的处理计划执行失败，改为由 AI 重新分析..."}
         
-        # 如果没有找到think标签，尝试其他分离方法
-        if not thinking_process:
-            # 查找常见的思考过程标识
-            lines = response.split('\n')
-            thinking_lines = []
-            result_lines = []
-            in_thinking = False
+        executed = []
+        async with self._bridge_session() as bridge:
+            yield {"type": "progress", "message": "🤖 正在调用AI助手分析请求..."}
+            logger.info(f"开始处理请求: {user_input}")
             
-            for line in lines:
-                # 检查是否是思考过程的开始
-                if any(keyword in line.lower() for keyword in ['分析', '思考', '考虑', '首先', '接下来', '然后']):
-                    if not result_lines:  # 如果还没有结果内容，认为是思考过程
-                        in_thinking = True
-                        thinking_lines.append(line)
-                        continue
+            llm = bridge.llm_client
+            llm.messages.append({"role": "user", "content": user_input})
+            usage = []
+            for _ in range(MAX_TOOL_ROUNDS):
+                tool_calls = {}
+                content = []
+                async for event in self._stream_completion(llm, content, tool_calls, usage):
+                    yield event
                 
-                # 检查是否是结果的开始
-                if any(keyword in line.lower() for keyword in ['结果', '完成', '成功', '输出', '生成']):
-                    in_thinking = False
-                    result_lines.append(line)
-                    continue
+                message = {"role": "assistant", "content": "".join(content)}
+                calls = [tool_calls[i] for i in sorted(tool_calls)]
+                if calls:
+                    message["tool_calls"] = [
+                        {
+                            "id": call["id"],
+                            "type": "function",
+                            "function": {"name": call["name"], "arguments": call["arguments"]}
+                        }
+                        for call in calls
+                    ]
+                llm.messages.append(message)
+                if not calls:
+                    yield self._record_usage(usage)
+                    if plan_request is not None and executed:
+                        await asyncio.to_thread(self.plan_cache.store, plan_request, executed)
+                    return
                 
-                if in_thinking:
-                    thinking_lines.append(line)
-                else:
-                    result_lines.append(line)
+                for call in calls:
+                    async for event in self._run_tool_call(bridge, call, executed):
+                        yield event
             
-            if thinking_lines:
-                thinking_process = '\n'.join(thinking_lines).strip()
-                final_result = '\n'.join(result_lines).strip()
+            yield self._record_usage(usage)
+            raise RuntimeError(f"工具调用超过 {MAX_TOOL_ROUNDS} 轮，已停止")
+    
+    def _record_usage(self, usage):
+        """汇总一个请求中各次补全的 token 用量，计入累计统计并生成 usage 事件"""
+        total = {
+            "completions": len(usage),
+            "prompt_tokens": sum(u["prompt_tokens"] for u in usage),
+            "completion_tokens": sum(u["completion_tokens"] for u in usage),
+            "cached_tokens": sum(u["cached_tokens"] for u in usage),
+        }
+        if usage:
+            self.usage.record(total)
+            logger.info(
+                f"LLM 用量: 输入 {total['prompt_tokens']} tokens（前缀缓存命中 {total['cached_tokens']}），"
+                f"输出 {total['completion_tokens']} tokens，{total['completions']} 次补全"
+            )
+        return {"type": "usage", **total}
+    
+    async def _stream_completion(self, llm, content, tool_calls, usage=None):
+        """
+        发起一次流式补全，转发文本增量，并把工具调用片段拼接到 tool_calls 中
+        
+        Args:
+            llm: 桥接会话的 LLM 客户端，提供对话历史、工具定义和模型配置
+            content: 收集本轮完整文本（含思考标签）的列表
+            tool_calls: 收集工具调用的字典，索引 -> {"id", "name", "arguments"}
+            usage: 收集本次补全 token 用量的列表
+        """
+        config = llm.config
+        # 系统提示词和工具定义在前、对话内容在后：前缀对所有请求保持不变，可以命中服务端的前缀缓存
+        messages = list(llm.messages)
+        if llm.system_prompt:
+            messages.insert(0, {"role": "system", "content": llm.system_prompt})
+        params = {
+            "model": config.model,
+            "messages": messages,
+            "temperature": getattr(config, "temperature", None),
+            "max_tokens": getattr(config, "max_tokens", None),
+            "stream": True,
+        }
+        if llm.tools:
+            params["tools"] = self.tool_schemas.get(llm.tools)
+        if self.stream_usage:
+            params["stream_options"] = {"include_usage": True}
+        params = {key: value for key, value in params.items() if value is not None}
+        
+        parser = ThinkParser()
+        client = self._llm_client()
+        started = time.perf_counter()
+        first_chunk = True
+        # 拆分思考内容的累计耗时，只在开启指标时计时
+        split_time = 0.0
+        async with aclosing(self.llm_scheduler.stream(lambda: client.chat.completions.create(**params))) as stream:
+            async for chunk in stream:
+                if first_chunk:
+                    first_chunk = False
+                    metrics.observe("llm_first_chunk", time.perf_counter() - started)
+                if getattr(chunk, "usage", None) and usage is not None:
+                    usage.append(usage_of(chunk.usage))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                # 部分模型通过单独的字段返回思考过程
+                reasoning = getattr(delta, "reasoning_content", None)
+                if reasoning:
+                    yield {"type": "thinking_chunk", "content": reasoning}
+                if delta.content:
+                    content.append(delta.content)
+                    if metrics.ENABLED:
+                        split_started = time.perf_counter()
+                        events = parser.feed(delta.content)
+                        split_time += time.perf_counter() - split_started
+                    else:
+                        events = parser.feed(delta.content)
+                    for event in events:
+                        yield event
+                for fragment in delta.tool_calls or []:
+                    call = tool_calls.setdefault(fragment.index, {"id": "", "name": "", "arguments": ""})
+                    if fragment.id:
+                        call["id"] = fragment.id
+                    if fragment.function:
+                        call["name"] += fragment.function.name or ""
+                        call["arguments"] += fragment.function.arguments or ""
+        metrics.observe("llm_completion", time.perf_counter() - started)
+        metrics.observe("think_split", split_time)
+        for event in parser.flush():
+            yield event
+    
+    async def _run_tool_call(self, bridge, call, executed=None):
+        """执行一次模型发起的工具调用，并把结果写回对话历史"""
+        tool_name = bridge.tool_name_mapping.get(call["name"], call["name"])
+        try:
+            arguments = json.loads(call["arguments"] or "{}")
+        except ValueError:
+            arguments = {}
+        outcome = []
+        async for event in self._execute_tool(bridge, tool_name, arguments, outcome):
+            yield event
+        output, success = outcome[0]
+        if executed is not None:
+            executed.append({"tool": tool_name, "arguments": arguments, "success": success, "output": output})
+        bridge.llm_client.messages.append(
+            {"role": "tool", "tool_call_id": call["id"], "content": output}
+        )
+    
+    async def _execute_tool(self, bridge, tool_name, arguments, outcome):
+        """
+        执行工具并产出 tool_call、FFmpeg 进度和 tool_result 事件
         
-        return thinking_process, final_result
+        Args:
+            bridge: 桥接会话
+            tool_name: 工具名称
+            arguments: 工具参数
+            outcome: 执行结束后追加 (结果文本, 是否成功)
+        """
+        yield {
+            "type": "tool_call",
+            "tool": tool_name,
+            "arguments": arguments,
+            "message": f"⚙️ 正在执行工具 {tool_name}..."
+        }
+        # 工具执行期间产生的 FFmpeg 进度事件经队列转发
+        progress = asyncio.Queue()
+        token = progress_sink.set(progress.put_nowait)
+        try:
+            runner = tool_runner.get()
+            call = functools.partial(bridge.mcp_client.call_tool, tool_name, arguments)
+            task = asyncio.create_task(runner(tool_name, call) if runner else call())
+        finally:
+            progress_sink.reset(token)
+        try:
+            while not task.done():
+                getter = asyncio.ensure_future(progress.get())
+                await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            while not progress.empty():
+                yield progress.get_nowait()
+            result = task.result()
+            output = result_text(result)
+            success = not getattr(result, "isError", False)
+        except Exception as e:
+            logger.error(f"工具 {tool_name} 调用失败: {e}")
+            output = f"Error: {e}"
+            success = False
+        finally:
+            if not task.done():
+                task.cancel()
+        outcome.append((output, success))
+        yield {
+            "type": "tool_result",
+            "tool": tool_name,
+            "success": success,
+            "message": f"✅ 工具 {tool_name} 执行完成" if success else f"❌ 工具 {tool_name} 执行失败: {output[:200]}"
+        }
+    
+    async def _replay_plan(self, plan, executed):
+        """按缓存的计划依次执行工具，遇到失败即停止"""
+        yield {"type": "progress", "message": f"♻️ 命中处理计划缓存，直接执行 {len(plan)} 个工具..."}
+        logger.info(f"命中计划缓存，重放 {len(plan)} 个工具调用")
+        started = time.perf_counter()
+        async with self._bridge_session() as bridge:
+            for step in plan:
+                outcome = []
+                async for event in self._execute_tool(bridge, step["tool"], step["arguments"], outcome):
+                    yield event
+                output, success = outcome[0]
+                executed.append({**step, "success": success, "output": output})
+                if not success:
+                    return
+        metrics.observe("plan_replay", time.perf_counter() - started)
+    
+    @staticmethod
+    def _plan_summary(executed):
+        """重放计划后的回复：列出执行的工具、参数和结果"""
+        lines = ["已按相同请求的处理计划直接执行（未重新调用 AI）：", ""]
+        for i, call in enumerate(executed, 1):
+            arguments = json.dumps(call["arguments"], ensure_ascii=False)
+            lines.append(f"{i}. {call['tool']}")
+            lines.append(f"   参数: {arguments}")
+            lines.append(f"   结果: {call['output'][:500]}")
+        return "\n".join(lines)
+    
+    async def call_tool(self, tool_name, arguments, on_progress=None):
+        """
+        直接调用 MCP 工具，不经过 LLM
+        
+        Args:
+            tool_name: 工具名称
+            arguments: 工具参数
+            on_progress: FFmpeg 进度事件回调 on_progress(event)
+            
+        Returns:
+            工具返回的结果，JSON 文本会被解析为对象
+        """
+        if tool_name not in self.get_tool_names():
+            raise ValueError(f"未知的工具: {tool_name}")
+        token = progress_sink.set(on_progress)
+        try:
+            async with self._bridge_session() as bridge:
+                result = await bridge.mcp_client.call_tool(tool_name, arguments)
+        finally:
+            progress_sink.reset(token)
+        text = result_text(result)
+        if getattr(result, "isError", False):
+            raise ToolCallError(text)
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
     
     def get_available_tools(self):
         """获取可用的工具列表"""
@@ -227,6 +597,10 @@ class FFmpegMCPClient:
             "extract_audio_from_video - 提取视频中的音频"
         ]
         return tools
+    
+    def get_tool_names(self):
+        """获取可用工具的名称列表"""
+        return [tool.split(" - ")[0] for tool in self.get_available_tools()]
 
 
 async def interactive_demo():
@@ -0,0 +1,307 @@
+# ffmpeg_progress.py - 从 FFmpeg 日志中解析实时进度
+import asyncio
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# 当前工具调用的进度接收函数 sink(event)，为空时不监控进度
+progress_sink = ContextVar("progress_sink", default=None)
+
+# 进度事件的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+# 读取日志的间隔（秒）
+POLL_INTERVAL = 0.25
+# 超过该时间（秒）进度没有变化视为卡住
+STALL_TIMEOUT = 30.0
+
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_STATS_RE = re.compile(r"(\w+)=\s*(\S+)")
+_DURATION_FIELD_RE = re.compile(r'"duration"\s*:\s*"?(\d+(?:\.\d+)?)')
+
+
+def parse_time(value):
+    """
+    解析 FFmpeg 的时间表示
+
+    Args:
+        value: "HH:MM:SS.xx"、"MM:SS" 或秒数
+
+    Returns:
+        float: 秒数，无法解析时返回 None
+    """
+    if value is None:
+        return None
+    try:
+        seconds = 0.0
+        for part in str(value).strip().split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds if seconds >= 0 else None
+    except ValueError:
+        return None
+
+
+def expected_duration(tool, arguments, known_duration=None):
+    """
+    根据工具参数估算输出时长，用于计算完成百分比
+
+    Args:
+        tool: 工具名
+        arguments: 工具参数
+        known_duration: 输入文件的已知时长
+
+    Returns:
+        float: 预计输出时长（秒），未知时返回 None
+    """
+    if tool == "clip_video":
+        duration = parse_time(arguments.get("duration"))
+        if duration:
+            return duration
+        start = parse_time(arguments.get("start")) or 0.0
+        end = parse_time(arguments.get("end"))
+        if end and end > start:
+            return end - start
+        if known_duration:
+            return max(known_duration - start, 0.0) or None
+    return known_duration
+
+
+class DurationHints:
+    """记录 get_video_info 返回的视频时长，供后续处理同一文件时计算进度"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._durations = {}
+
+    def remember(self, path, result_text):
+        """从 get_video_info 的结果文本中提取时长"""
+        match = _DURATION_FIELD_RE.search(result_text or "")
+        if match and isinstance(path, str):
+            if len(self._durations) >= self.max_entries:
+                self._durations.pop(next(iter(self._durations)))
+            self._durations[os.path.abspath(path)] = float(match.group(1))
+
+    def get(self, path):
+        if not isinstance(path, str):
+            return None
+        return self._durations.get(os.path.abspath(path))
+
+
+class ProgressParser:
+    """增量解析 FFmpeg 输出
+
+    同时支持终端统计行（frame=  90 fps=30 ... time=00:00:03.00 speed=1.5x）和
+    -progress 输出的 key=value 块，输入时长从 "Duration:" 行获取。
+    """
+
+    def __init__(self, duration=None, sum_durations=False):
+        """
+        Args:
+            duration: 已知的输出时长（秒），为空时使用日志中的输入时长
+            sum_durations: 是否累加多个输入的时长（如合并视频）
+        """
+        self.duration = duration
+        self.sum_durations = sum_durations
+        self._log_duration = None
+        self._tail = ""
+        self._block = {}
+
+    def feed(self, text):
+        """
+        输入一段新的日志文本
+
+        Returns:
+            list: 解析出的进度字典
+        """
+        text = self._tail + text
+        lines = re.split(r"[\r\n]", text)
+        self._tail = lines.pop()
+        updates = []
+        for line in lines:
+            update = self._parse_line(line)
+            if update:
+                updates.append(update)
+        return updates
+
+    def _parse_line(self, line):
+        match = _DURATION_RE.search(line)
+        if match:
+            h, m, s = match.groups()
+            seconds = int(h) * 3600 + int(m) * 60 + float(s)
+            if self._log_duration is None:
+                self._log_duration = seconds
+            elif self.sum_durations:
+                self._log_duration += seconds
+            return None
+
+        line = line.strip()
+        if line.startswith(("frame=", "size=")) and " time=" in line:
+            # 统计行：一行包含所有字段（只有音频时没有 frame 字段）
+            fields = dict(_STATS_RE.findall(line))
+            return self._build(fields.get("frame"), fields.get("fps"),
+                               parse_time(fields.get("time")), fields.get("speed"), False)
+
+        if "=" in line and " " not in line:
+            # -progress 块：每行一个字段，以 progress=continue/end 结束
+            key, value = line.split("=", 1)
+            self._block[key] = value
+            if key == "progress":
+                block, self._block = self._block, {}
+                out_time = None
+                if block.get("out_time_us", "N/A").lstrip("-").isdigit():
+                    out_time = int(block["out_time_us"]) / 1_000_000
+                return self._build(block.get("frame"), block.get("fps"), out_time,
+                                   block.get("speed"), value == "end")
+        return None
+
+    def _build(self, frame, fps, out_time, speed, finished):
+        progress = {
+            "frame": int(frame) if frame and frame.isdigit() else None,
+            "fps": _to_float(fps),
+            "out_time": round(out_time, 3) if out_time is not None else None,
+            "speed": _to_float((speed or "").rstrip("x")),
+            "percent": None,
+            "eta": None,
+        }
+        duration = self.duration or self._log_duration
+        if duration and out_time is not None:
+            progress["percent"] = 100.0 if finished else round(min(out_time / duration * 100, 100.0), 1)
+            if progress["speed"]:
+                progress["eta"] = round(max(duration - out_time, 0.0) / progress["speed"], 1)
+        return progress
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressMonitor:
+    """在工具调用期间跟踪会话报告目录中 FFmpeg 写出的日志
+
+    FFmpeg 在 MCP 服务器子进程中运行，通过 FFREPORT 环境变量把日志写入每个会话独立的目录；
+    这里增量读取本次调用期间新产生的日志，按固定间隔发出进度事件，并在长时间没有进展时发出告警。
+    """
+
+    def __init__(self, report_dir, sink, tool, duration=None,
+                 interval=PROGRESS_INTERVAL, stall_timeout=STALL_TIMEOUT):
+        """
+        Args:
+            report_dir: FFREPORT 日志目录
+            sink: 进度事件接收函数 sink(event)
+            tool: 工具名，写入事件中
+            duration: 预计输出时长（秒）
+            interval: 进度事件的最小间隔（秒）
+            stall_timeout: 判定卡住的时长（秒）
+        """
+        self.report_dir = report_dir
+        self.sink = sink
+        self.tool = tool
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.parser = ProgressParser(duration, sum_durations=(tool == "concat_videos"))
+        self._existing = set()
+        self._offsets = {}
+        self._last_emit = 0.0
+        self._last_change = time.monotonic()
+        self._last_progress = None
+        self._last_sent = None
+        self._stalled = False
+
+    def _new_logs(self):
+        try:
+            names = [n for n in os.listdir(self.report_dir) if n.startswith("ffmpeg-") and n.endswith(".log")]
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n not in self._existing)
+
+    def _read_new(self):
+        text = []
+        for name in self._new_logs():
+            path = os.path.join(self.report_dir, name)
+            offset = self._offsets.get(name, 0)
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            self._offsets[name] = offset + len(data)
+            text.append(data.decode("utf-8", errors="replace"))
+        return "".join(text)
+
+    def _emit(self, progress, force=False):
+        now = time.monotonic()
+        if progress != self._last_progress:
+            self._last_progress = progress
+            self._last_change = now
+            self._stalled = False
+        if progress == self._last_sent:
+            return
+        if force or now - self._last_emit >= self.interval:
+            self._last_emit = now
+            self._last_sent = progress
+            self.sink({"type": "ffmpeg_progress", "tool": self.tool, **progress})
+
+    def _check_stall(self):
+        stalled_for = time.monotonic() - self._last_change
+        if not self._stalled and stalled_for >= self.stall_timeout:
+            self._stalled = True
+            logger.warning(f"FFmpeg 进度超过 {stalled_for:.0f} 秒没有变化: {self.tool}")
+            self.sink({
+                "type": "ffmpeg_stalled",
+                "tool": self.tool,
+                "seconds": round(stalled_for, 1),
+                "message": f"⚠️ {self.tool} 已 {stalled_for:.0f} 秒没有进展"
+            })
+
+    def _poll(self, final=False):
+        text = self._read_new()
+        updates = self.parser.feed(text + "\n" if final else text)
+        if updates:
+            self._emit(updates[-1], force=final)
+        elif final:
+            # 结束时补发因限流未发出的最后进度
+            if self._last_progress is not None:
+                self._emit(self._last_progress, force=True)
+        elif self._offsets:
+            # 已经开始输出日志但进度没有变化
+            self._check_stall()
+
+    async def run(self, call):
+        """
+        执行工具调用并在其运行期间监控进度
+
+        Args:
+            call: 工具调用协程
+
+        Returns:
+            工具调用结果
+        """
+        self._existing = set(self._new_logs())
+        task = asyncio.ensure_future(call)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=POLL_INTERVAL)
+                if done:
+                    break
+                await asyncio.to_thread(self._poll)
+            await asyncio.to_thread(self._poll, True)
+            return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+            self._cleanup()
+
+    def _cleanup(self):
+        # 删除本次调用产生的日志，避免会话目录不断增长
+        for name in self._offsets:
+            try:
+                os.remove(os.path.join(self.report_dir, name))
+            except OSError:
+                pass
@@ -0,0 +1,31 @@
+# file_lock.py - 多个 worker 进程之间的文件锁
+import fcntl
+import os
+
+
+def lock_file(path, blocking=True):
+    """
+    获取排他文件锁，多个 worker 进程共享缓存目录时保证同一内容只有一个进程在生成
+
+    Args:
+        path: 锁文件路径，不存在时创建
+        blocking: 是否等待其他进程释放锁
+
+    Returns:
+        int: 锁文件的描述符，关闭即释放锁；非阻塞模式下锁被其他进程持有时返回 None
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        if blocking:
+            raise
+        return None
+    return fd
+
+
+def unlock(fd):
+    """释放 lock_file 获取的锁"""
+    if fd is not None:
+        os.close(fd)
@@ -0,0 +1,295 @@
+# hls_preview.py - 按需生成并缓存 HLS 预览
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+
+import metrics
+from file_lock import lock_file, unlock
+from media_index import probe
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_NAME = "index.m3u8"
+# 切片时长（秒），第一个切片更短以便尽快开始播放
+SEGMENT_SECONDS = 4
+FIRST_SEGMENT_SECONDS = 1
+# 等待第一个切片的超时时间（秒）
+FIRST_SEGMENT_TIMEOUT = 20.0
+
+# 可以直接复制到 MPEG-TS 切片中、浏览器能够播放的编码
+_COPY_VIDEO_CODECS = {"h264"}
+_COPY_AUDIO_CODECS = {"aac", "mp3"}
+
+_KEY_RE = re.compile(r"[0-9a-f]{64}")
+_SEGMENT_RE = re.compile(r"seg_\d{5}\.ts")
+
+
+class PreviewError(Exception):
+    """预览生成失败"""
+
+
+def _dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def _playlist_finished(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return "#EXT-X-ENDLIST" in f.read()
+    except FileNotFoundError:
+        return False
+
+
+class HlsPreviewCache:
+    """按需生成的 HLS 预览缓存
+
+    第一次请求某个视频的预览时启动 FFmpeg 切片：编码兼容时直接复制码流，否则转码为 H.264/AAC。
+    播放列表以 event 类型边生成边提供，第一个切片写出后即可开始播放，与源文件大小无关。
+    切片按内容哈希保存在缓存目录中，总大小超过预算时淘汰最久未访问的预览。
+    多个 worker 进程共享缓存目录时，每个预览由持有 <键>.lock 文件锁的进程生成，
+    其他进程直接读取生成中的播放列表，生成完成后从磁盘收录。
+    """
+
+    def __init__(self, root, max_bytes=5 * 1024 ** 3, max_concurrent=2, blob_store=None,
+                 media_index=None, base_url="/api/preview/segments"):
+        """
+        初始化预览缓存
+
+        Args:
+            root: 缓存目录
+            max_bytes: 缓存总大小上限
+            max_concurrent: 同时运行的切片进程数
+            blob_store: 用于查询内容哈希的 BlobStore
+            media_index: 用于查询编码信息的 MediaIndex
+            base_url: 切片的访问地址前缀
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blob_store = blob_store
+        self.media_index = media_index
+        self.base_url = base_url.rstrip("/")
+        self.ffmpeg = shutil.which("ffmpeg")
+        self.ffprobe = shutil.which("ffprobe")
+        self._slots = asyncio.Semaphore(max_concurrent)
+        # 内容哈希 -> 生成任务
+        self._building = {}
+        # 内容哈希 -> [最近访问时间, 已完成预览的大小]
+        self._entries = {}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # 保留上次运行已完成的预览，清理生成到一半的目录（其他 worker 正在生成的除外）
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not _KEY_RE.fullmatch(entry.name):
+                continue
+            if _playlist_finished(os.path.join(entry.path, PLAYLIST_NAME)):
+                self._entries[entry.name] = [entry.stat().st_mtime, _dir_size(entry.path)]
+                continue
+            fd = lock_file(self._lock_path(entry.name), blocking=False)
+            if fd is not None:
+                try:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                finally:
+                    unlock(fd)
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, f"{key}.lock")
+
+    def _adopt(self, key):
+        """收录其他 worker 已生成完成的预览，没有时返回 False"""
+        out_dir = os.path.join(self.root, key)
+        if not _playlist_finished(os.path.join(out_dir, PLAYLIST_NAME)):
+            return False
+        self._entries[key] = [time.time(), _dir_size(out_dir)]
+        return True
+
+    def key_for(self, path):
+        """预览的缓存键：内容哈希，未登记到 blob 存储时使用路径、大小和 mtime 的哈希"""
+        digest = self.blob_store.digest_of(path) if self.blob_store else None
+        if digest:
+            return digest
+        st = os.stat(path)
+        return hashlib.sha256(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+    def segment_path(self, key, segment):
+        """切片文件路径，名称无效时返回 None"""
+        if not _KEY_RE.fullmatch(key) or not _SEGMENT_RE.fullmatch(segment):
+            return None
+        path = os.path.join(self.root, key, segment)
+        if key in self._entries:
+            self._entries[key][0] = time.time()
+        return path if os.path.exists(path) else None
+
+    async def playlist(self, path):
+        """
+        获取视频的预览播放列表，必要时启动切片并等待第一个切片
+
+        Args:
+            path: 源视频路径
+
+        Returns:
+            str: m3u8 播放列表内容
+        """
+        key = await asyncio.to_thread(self.key_for, path)
+        playlist_path = os.path.join(self.root, key, PLAYLIST_NAME)
+        task = self._building.get(key)
+        if key in self._entries and not os.path.exists(playlist_path):
+            # 已被其他 worker 淘汰
+            del self._entries[key]
+        if key in self._entries:
+            self._entries[key][0] = time.time()
+        elif task is None and await asyncio.to_thread(self._adopt, key):
+            pass
+        elif task is None:
+            task = self._building[key] = asyncio.create_task(self._build(key, path))
+
+        deadline = time.monotonic() + FIRST_SEGMENT_TIMEOUT
+        while True:
+            text = await asyncio.to_thread(self._read_playlist, playlist_path)
+            if text and "#EXTINF" in text:
+                return text
+            if task is None or task.done():
+                if task is not None and not task.cancelled() and task.exception():
+                    raise PreviewError(str(task.exception()))
+                if key not in self._entries:
+                    raise PreviewError("预览生成失败")
+            if time.monotonic() > deadline:
+                raise PreviewError("等待预览切片超时")
+            await asyncio.sleep(0.1)
+
+    @staticmethod
+    def _read_playlist(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _codecs(self, path):
+        info = self.media_index.get(path) if self.media_index else None
+        if not info or not (info.get("video_codec") or info.get("audio_codec")):
+            info = probe(path, self.ffprobe) if self.ffprobe else None
+        return (info or {}).get("video_codec"), (info or {}).get("audio_codec")
+
+    def _command(self, key, path, video_codec, audio_codec):
+        out_dir = os.path.join(self.root, key)
+        command = [self.ffmpeg, "-hide_banner", "-nostdin", "-loglevel", "error", "-y", "-i", path,
+                   "-map", "0:v:0?", "-map", "0:a:0?"]
+        if video_codec in _COPY_VIDEO_CODECS:
+            command += ["-c:v", "copy"]
+        else:
+            command += [
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",
+                "-force_key_frames", f"expr:gte(t,n_forced*{FIRST_SEGMENT_SECONDS})",
+            ]
+        if audio_codec in _COPY_AUDIO_CODECS:
+            command += ["-c:a", "copy"]
+        else:
+            command += ["-c:a", "aac", "-b:a", "128k", "-ac", "2"]
+        command += [
+            "-f", "hls",
+            "-hls_time", str(SEGMENT_SECONDS),
+            "-hls_init_time", str(FIRST_SEGMENT_SECONDS),
+            "-hls_list_size", "0",
+            "-hls_playlist_type", "event",
+            "-hls_flags", "temp_file+independent_segments",
+            "-hls_segment_filename", os.path.join(out_dir, "seg_%05d.ts"),
+            "-hls_base_url", f"{self.base_url}/{key}/",
+            os.path.join(out_dir, PLAYLIST_NAME),
+        ]
+        return command
+
+    async def _wait_other_worker(self, key):
+        """等待持有锁的其他 worker 生成完毕并收录结果，期间播放列表可以直接读取"""
+        lock_path = self._lock_path(key)
+        while True:
+            await asyncio.sleep(0.2)
+            fd = await asyncio.to_thread(lock_file, lock_path, False)
+            if fd is None:
+                continue
+            unlock(fd)
+            if await asyncio.to_thread(self._adopt, key):
+                return
+            raise PreviewError("预览生成失败")
+
+    async def _build(self, key, path):
+        out_dir = os.path.join(self.root, key)
+        lock = None
+        try:
+            if not self.ffmpeg:
+                raise PreviewError("未找到 ffmpeg")
+            lock = await asyncio.to_thread(lock_file, self._lock_path(key), False)
+            if lock is None:
+                logger.info(f"预览正在由其他 worker 生成: {path}")
+                await self._wait_other_worker(key)
+                return
+            if await asyncio.to_thread(self._adopt, key):
+                return
+            async with self._slots:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                os.makedirs(out_dir)
+                video_codec, audio_codec = await asyncio.to_thread(self._codecs, path)
+                command = self._command(key, path, video_codec, audio_codec)
+                mode = "复制码流" if video_codec in _COPY_VIDEO_CODECS else "转码"
+                logger.info(f"开始生成预览（{mode}）: {path}")
+                started = time.monotonic()
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    with metrics.ffmpeg_running("preview"):
+                        _, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    process.kill()
+                    await process.wait()
+                    raise
+                if process.returncode != 0:
+                    raise PreviewError(stderr.decode("utf-8", errors="replace").strip()[-500:] or "FFmpeg 执行失败")
+            size = await asyncio.to_thread(_dir_size, out_dir)
+            self._entries[key] = [time.time(), size]
+            logger.info(f"预览生成完成: {path} ({size} 字节, {time.monotonic() - started:.1f} 秒)")
+            for victim in self._evict():
+                await asyncio.to_thread(shutil.rmtree, os.path.join(self.root, victim), True)
+        except BaseException as e:
+            if lock is not None:
+                shutil.rmtree(out_dir, ignore_errors=True)
+            if not isinstance(e, asyncio.CancelledError):
+                logger.error(f"预览生成失败 {path}: {e}")
+            raise
+        finally:
+            unlock(lock)
+            self._building.pop(key, None)
+
+    def _evict(self):
+        """
+        淘汰最久未访问的预览，直到总大小不超过预算
+
+        Returns:
+            list: 被淘汰的缓存键，对应目录由调用方删除
+        """
+        total = sum(size for _, size in self._entries.values())
+        victims = []
+        for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            del self._entries[key]
+            victims.append(key)
+            total -= size
+            logger.info(f"淘汰预览缓存: {key}")
+        return victims
+
+    async def close(self):
+        """停止正在运行的切片进程"""
+        tasks = list(self._building.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
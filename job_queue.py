@@ -0,0 +1,409 @@
+# job_queue.py - 有界并发的异步任务队列
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from event_channel import EventChannel
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobCancelledError(Exception):
+    """任务已被取消"""
+
+
+class Job:
+    """一个排队执行的任务及其进度事件"""
+
+    def __init__(self, work, user, priority, kind, description, max_events=1000):
+        self.id = uuid.uuid4().hex
+        self.work = work
+        self.user = user
+        self.priority = priority
+        self.kind = kind
+        self.description = description
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.events = EventChannel(max_events)
+        self.task = None
+        self._done = asyncio.Event()
+        # 多 worker 部署时同步状态和事件的共享存储
+        self.store = None
+        # 提交时的上下文（含请求 ID），任务在其中执行
+        self.context = contextvars.copy_context()
+
+    @property
+    def done(self):
+        return self.status in FINISHED_STATES
+
+    def publish(self, event):
+        """
+        发布一条进度事件
+
+        Args:
+            event: 事件字典，至少包含 type 字段
+
+        Returns:
+            int: 事件编号
+        """
+        event_id = self.events.publish(event)
+        if self.store is not None:
+            self.store.publish(self, event_id, event)
+        return event_id
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._done.set()
+        self.events.close()
+        if self.store is not None:
+            self.store.track(self)
+
+    def subscribe(self, last_event_id=0):
+        """
+        订阅进度事件，任务结束且事件取完后停止
+
+        Args:
+            last_event_id: 已收到的最后一条事件编号，断线重连时从其后继续
+
+        Returns:
+            异步迭代器，产出 (编号, 事件)
+        """
+        return self.events.subscribe(last_event_id)
+
+    async def wait(self):
+        """
+        等待任务结束
+
+        Returns:
+            任务结果；任务失败时抛出原异常，被取消时抛出 JobCancelledError
+        """
+        await self._done.wait()
+        if self.status == FAILED:
+            raise self.error
+        if self.status == CANCELLED:
+            raise JobCancelledError(f"任务 {self.id} 已取消")
+        return self.result
+
+    def to_dict(self):
+        """任务状态的 JSON 表示"""
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "user": self.user,
+            "priority": self.priority,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": str(self.error) if self.error else None,
+            "last_event_id": self.events.last_id,
+        }
+
+
+class JobScheduler:
+    """有界并发的任务调度器
+
+    固定数量的 worker 从队列中取任务执行，同时运行的 FFmpeg 处理数不会超过 worker 数。
+    优先级高的任务先执行；同优先级时在用户之间轮转，避免单个用户的大量任务饿死其他用户。
+    多进程部署时传入 JobStore：任务仍在提交它的进程中执行，状态和事件同步到共享存储，
+    其他进程查询、订阅和取消该任务时经由共享存储完成。
+    """
+
+    def __init__(self, workers=None, max_finished=1000, max_events=1000, store=None):
+        """
+        初始化任务调度器
+
+        Args:
+            workers: worker 数量，默认为 CPU 核数
+            max_finished: 保留的已结束任务数量，超出后丢弃最早结束的
+            max_events: 每个任务可供断线重放的事件数量
+            store: 多个进程共享的 JobStore，为空时只在本进程内可见
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_finished = max_finished
+        self.max_events = max_events
+        self.store = store
+        self.jobs = OrderedDict()
+        # 用户 -> 待执行任务堆 [(-优先级, 序号, 任务)]
+        self._pending = {}
+        # 用户 -> 最近一次被调度的序号，用户没有排队和运行中的任务时删除
+        self._last_served = {}
+        # 用户 -> 运行中的任务数
+        self._running = {}
+        self._seq = itertools.count()
+        self._serve_seq = itertools.count()
+        self._available = asyncio.Condition()
+        self._worker_tasks = []
+        self._detached = set()
+
+    async def start(self):
+        """启动 worker"""
+        if self.store is not None:
+            await self.store.start(on_cancel=self._cancel_local)
+        for i in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(i)))
+        logger.info(f"任务调度器已启动: {self.workers} 个 worker")
+
+    async def close(self):
+        """停止 worker 并取消所有未结束的任务"""
+        tasks = self._worker_tasks + list(self._detached)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in self.jobs.values():
+            if not job.done:
+                job._finish(CANCELLED)
+        if self.store is not None:
+            await self.store.close()
+
+    async def drain(self, timeout):
+        """
+        等待已接收的任务（包括排队中的）执行完毕，用于平滑退出
+
+        Args:
+            timeout: 最长等待时间（秒），超时后未结束的任务由 close 取消
+
+        Returns:
+            int: 超时后仍未结束的任务数
+        """
+        waiters = [asyncio.create_task(job._done.wait()) for job in self.jobs.values() if not job.done]
+        if not waiters:
+            return 0
+        logger.info(f"等待 {len(waiters)} 个未结束的任务，最多 {timeout:.0f} 秒")
+        _, pending = await asyncio.wait(waiters, timeout=timeout)
+        for waiter in pending:
+            waiter.cancel()
+        remaining = sum(1 for job in self.jobs.values() if not job.done)
+        if remaining:
+            logger.warning(f"{remaining} 个任务未能在 {timeout:.0f} 秒内结束，将被取消")
+        return remaining
+
+    def submit(self, work, user="anonymous", priority=0, kind="process", description=None):
+        """
+        提交任务
+
+        Args:
+            work: 协程函数 work(job)，返回值作为任务结果，可通过 job.publish 发布进度
+            user: 提交任务的用户，用于公平调度
+            priority: 优先级，数值越大越先执行
+            kind: 任务类型
+            description: 任务描述
+
+        Returns:
+            Job: 新任务
+        """
+        job = self._new_job(work, user, priority, kind, description)
+        heapq.heappush(self._pending.setdefault(user, []), (-priority, next(self._seq), job))
+        asyncio.create_task(self._wake())
+        self._prune()
+        return job
+
+    def run_detached(self, work, user="anonymous", priority=0, kind="batch", description=None):
+        """
+        立即运行一个不占用 worker 的任务
+
+        用于只负责协调、自身不做重活的任务（如批处理把子任务提交回队列后等待其完成），
+        避免协调任务占满 worker 导致子任务无法执行。可以像普通任务一样查询、订阅和取消。
+
+        Args:
+            work: 协程函数 work(job)
+            user: 提交任务的用户
+            priority: 优先级，子任务可沿用
+            kind: 任务类型
+            description: 任务描述
+
+        Returns:
+            Job: 新任务
+        """
+        job = self._new_job(work, user, priority, kind, description)
+        self._start(job)
+        task = asyncio.create_task(self._settle(job))
+        self._detached.add(task)
+        task.add_done_callback(self._detached.discard)
+        self._prune()
+        return job
+
+    def _new_job(self, work, user, priority, kind, description):
+        job = Job(work, user, priority, kind, description, self.max_events)
+        self.jobs[job.id] = job
+        if self.store is not None:
+            job.store = self.store
+            self.store.track(job)
+        return job
+
+    async def _wake(self):
+        async with self._available:
+            self._available.notify()
+
+    def get(self, job_id):
+        """按 ID 查询任务，本进程中没有时到共享存储中查找，不存在时返回 None"""
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)
+        return job
+
+    def list_jobs(self, user):
+        """
+        某个用户的任务，包括其他进程中的任务
+
+        Returns:
+            list: Job 或 StoredJob，按提交时间排序
+        """
+        jobs = {job.id: job for job in self.jobs.values() if job.user == user}
+        if self.store is not None:
+            for job in self.store.list_jobs(user):
+                jobs.setdefault(job.id, job)
+        return sorted(jobs.values(), key=lambda job: job.created_at)
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务直接标记取消，运行中的任务会被中断
+
+        Returns:
+            bool: 任务是否存在且尚未结束
+        """
+        if job_id not in self.jobs and self.store is not None:
+            # 其他进程中的任务由其所在进程取消
+            return self.store.request_cancel(job_id)
+        return self._cancel_local(job_id)
+
+    def _cancel_local(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        if job.status == QUEUED:
+            job._finish(CANCELLED)
+        elif job.task is not None:
+            job.task.cancel()
+        return True
+
+    def queue_position(self, job):
+        """排队中的任务前面还有多少个任务（近似值）"""
+        if job.status != QUEUED:
+            return 0
+        if job.id not in self.jobs:
+            return self.store.queue_position(job)
+        key = (-job.priority, job.created_at)
+        return sum(
+            1 for other in self.jobs.values()
+            if other.status == QUEUED and other is not job
+            and (-other.priority, other.created_at) < key
+        )
+
+    def stats(self):
+        """调度器状态统计"""
+        counts = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        stats = {"workers": self.workers, **counts}
+        if self.store is not None:
+            # 所有进程的任务统计
+            stats["cluster"] = self.store.stats()
+        return stats
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _pop_next(self):
+        """选出下一个任务：先比较优先级，再优先最久未被调度的用户"""
+        best_user = None
+        best_key = None
+        for user, heap in self._pending.items():
+            while heap and heap[0][2].status != QUEUED:
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            key = (heap[0][0], self._last_served.get(user, -1))
+            if best_key is None or key < best_key:
+                best_user, best_key = user, key
+        # 清理空队列
+        for user in [u for u, heap in self._pending.items() if not heap]:
+            del self._pending[user]
+            self._forget_idle(user)
+        if best_user is None:
+            return None
+        _, _, job = heapq.heappop(self._pending[best_user])
+        self._last_served[best_user] = next(self._serve_seq)
+        self._running[best_user] = self._running.get(best_user, 0) + 1
+        return job
+
+    def _forget_idle(self, user):
+        """用户没有排队和运行中的任务时，删除其调度记录"""
+        if user not in self._pending and not self._running.get(user):
+            self._last_served.pop(user, None)
+            self._running.pop(user, None)
+
+    def _job_settled(self, user):
+        self._running[user] -= 1
+        if not self._running[user]:
+            del self._running[user]
+            self._forget_idle(user)
+
+    async def _next_job(self):
+        async with self._available:
+            while True:
+                job = self._pop_next()
+                if job is not None:
+                    return job
+                await self._available.wait()
+
+    async def _worker(self, index):
+        while True:
+            job = await self._next_job()
+            try:
+                self._start(job)
+                await self._settle(job)
+            finally:
+                self._job_settled(job.user)
+
+    @staticmethod
+    def _start(job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        observe("queue_wait", job.started_at - job.created_at)
+        job.task = asyncio.create_task(job.work(job), context=job.context)
+        if job.store is not None:
+            job.store.track(job)
+
+    async def _settle(self, job):
+        try:
+            result = await job.task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # 调度器自身被停止
+                job._finish(CANCELLED)
+                raise
+            job._finish(CANCELLED)
+            logger.info(f"任务已取消: {job.id}")
+        except Exception as e:
+            logger.error(f"任务执行失败 {job.id}: {e}")
+            job._finish(FAILED, error=e)
+        else:
+            job._finish(SUCCEEDED, result=result)
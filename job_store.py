@@ -0,0 +1,489 @@
+# job_store.py - 多个 worker 进程共享的任务状态和进度事件
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from event_channel import EventChannel
+from job_queue import QUEUED, RUNNING, FAILED, CANCELLED, FINISHED_STATES, JobCancelledError
+
+logger = logging.getLogger(__name__)
+
+# 订阅其他 worker 的任务时轮询新事件的间隔（秒）：有新事件时使用最短间隔，任务空闲时逐步加倍到最长间隔
+POLL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 2.0
+
+# 每次轮询最多读取的事件数
+POLL_BATCH = 500
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class JobStore:
+    """任务状态和进度事件的共享存储
+
+    任务由提交它的 worker 进程执行，状态变化和进度事件写入 SQLite，其他 worker 据此回答
+    任务查询、转发进度（SSE 断线后重连到另一个 worker 也能用 Last-Event-ID 续传）和转交取消请求。
+    写入在后台批量进行：事件先进入内存队列，每隔 flush_interval 在一个事务中写入，
+    本进程内的订阅者仍直接从内存通道接收，不受写入延迟影响。
+    每个 worker 定期更新心跳；心跳超时的 worker 留下的未结束任务标记为失败。
+    """
+
+    def __init__(self, db_path, worker_id=None, max_events=1000, max_finished=1000,
+                 flush_interval=0.05, heartbeat_interval=1.0, heartbeat_timeout=15.0, prune_interval=60.0):
+        """
+        初始化共享存储
+
+        Args:
+            db_path: 数据库路径
+            worker_id: 当前 worker 的标识，默认由主机名和进程号生成
+            max_events: 每个任务保留的事件数量
+            max_finished: 保留的已结束任务数量
+            flush_interval: 批量写入的间隔（秒）
+            heartbeat_interval: 心跳和处理转交的取消请求的间隔（秒）
+            heartbeat_timeout: 超过该时间没有心跳的 worker 视为已退出
+            prune_interval: 清理已退出 worker 的任务和过多的已结束任务的间隔（秒）
+        """
+        self.db_path = db_path
+        self.worker_id = worker_id or new_worker_id()
+        self.max_events = max_events
+        self.max_finished = max_finished
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.prune_interval = prune_interval
+        # 待写入的事件 [(任务 ID, 事件编号, JSON)] 和状态有变化的任务
+        self._events = []
+        self._dirty = {}
+        self._pending = asyncio.Event()
+        self._task = None
+        self._on_cancel = None
+        # 任务 ID -> 本进程对其他 worker 上该任务的轮询
+        self._feeds = {}
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    worker TEXT NOT NULL,
+                    kind TEXT,
+                    description TEXT,
+                    user TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    result TEXT,
+                    error TEXT,
+                    last_event_id INTEGER NOT NULL DEFAULT 0,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, created_at);
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, worker);
+                CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (job_id, id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS workers (
+                    id TEXT PRIMARY KEY,
+                    pid INTEGER NOT NULL,
+                    heartbeat REAL NOT NULL
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    # ---- 任务所在 worker 的写入 ----
+
+    def track(self, job):
+        """任务状态变化（提交、开始、结束）后调用，下次批量写入时保存"""
+        self._dirty[job.id] = job
+        self._pending.set()
+
+    def publish(self, job, event_id, event):
+        """记录任务发布的一条事件"""
+        self._events.append((job.id, event_id, json.dumps(event, ensure_ascii=False, default=str)))
+        self._dirty[job.id] = job
+        self._pending.set()
+
+    def _snapshot(self, job):
+        result = None
+        if job.status not in (QUEUED, RUNNING) and job.result is not None:
+            result = json.dumps(job.result, ensure_ascii=False, default=str)
+        return (
+            job.id, self.worker_id, job.kind, job.description, job.user, job.priority, job.status,
+            job.created_at, job.started_at, job.finished_at, result,
+            str(job.error) if job.error else None, job.events.last_id
+        )
+
+    def _write(self, events, jobs):
+        with self._connect() as db:
+            # 先写事件再写状态：看到任务已结束的读者一定能读到全部事件
+            db.executemany("INSERT OR REPLACE INTO job_events VALUES (?, ?, ?)", events)
+            db.executemany(
+                """
+                INSERT INTO jobs (id, worker, kind, description, user, priority, status, created_at,
+                                  started_at, finished_at, result, error, last_event_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    status = excluded.status, started_at = excluded.started_at,
+                    finished_at = excluded.finished_at, result = excluded.result,
+                    error = excluded.error, last_event_id = excluded.last_event_id
+                """,
+                jobs
+            )
+            db.executemany(
+                "DELETE FROM job_events WHERE job_id = ? AND id <= ?",
+                [(job[0], job[12] - self.max_events) for job in jobs if job[12] > self.max_events]
+            )
+
+    async def flush(self):
+        """把待写入的事件和任务状态写入数据库"""
+        if not self._events and not self._dirty:
+            return
+        # 在事件循环中取走待写入的内容，写入线程不与 publish 共享列表
+        events, self._events = self._events, []
+        jobs = [self._snapshot(job) for job in self._dirty.values()]
+        self._dirty = {}
+        try:
+            await asyncio.to_thread(self._write, events, jobs)
+        except Exception as e:
+            logger.error(f"写入任务状态失败: {e}")
+
+    def _maintain(self, prune=False):
+        """
+        更新心跳并取出发给本 worker 的取消请求；prune 时清理已退出 worker 的任务和过多的已结束任务
+
+        Returns:
+            list: 需要取消的任务 ID
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)", (self.worker_id, os.getpid(), now))
+            cancels = [
+                row["id"] for row in db.execute(
+                    "SELECT id FROM jobs WHERE worker = ? AND cancel_requested = 1 AND status IN (?, ?)",
+                    (self.worker_id, QUEUED, RUNNING)
+                )
+            ]
+            if cancels:
+                db.executemany("UPDATE jobs SET cancel_requested = 0 WHERE id = ?", [(i,) for i in cancels])
+            if not prune:
+                return cancels
+            dead = [
+                row["id"] for row in db.execute(
+                    "SELECT id FROM workers WHERE heartbeat < ?", (now - self.heartbeat_timeout,)
+                )
+            ]
+            for worker in dead:
+                orphaned = db.execute(
+                    """
+                    UPDATE jobs SET status = ?, error = ?, finished_at = ?
+                    WHERE worker = ? AND status IN (?, ?)
+                    """,
+                    (FAILED, "执行任务的 worker 已退出", now, worker, QUEUED, RUNNING)
+                ).rowcount
+                db.execute("DELETE FROM workers WHERE id = ?", (worker,))
+                if orphaned:
+                    logger.warning(f"worker {worker} 已退出，{orphaned} 个未结束的任务标记为失败")
+            expired = [
+                (row["id"],) for row in db.execute(
+                    "SELECT id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT -1 OFFSET ?",
+                    (self.max_finished,)
+                )
+            ]
+            db.executemany("DELETE FROM job_events WHERE job_id = ?", expired)
+            db.executemany("DELETE FROM jobs WHERE id = ?", expired)
+        return cancels
+
+    async def _run(self):
+        next_heartbeat = next_prune = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._pending.wait(), self.heartbeat_interval)
+                # 短暂等待，把这段时间内的事件合并为一次写入
+                await asyncio.sleep(self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._pending.clear()
+            await self.flush()
+            now = time.monotonic()
+            if now < next_heartbeat:
+                continue
+            next_heartbeat = now + self.heartbeat_interval
+            prune = now >= next_prune
+            if prune:
+                next_prune = now + self.prune_interval
+            try:
+                cancels = await asyncio.to_thread(self._maintain, prune)
+            except Exception as e:
+                logger.error(f"维护任务存储失败: {e}")
+                continue
+            for job_id in cancels:
+                logger.info(f"收到其他 worker 转交的取消请求: {job_id}")
+                self._on_cancel(job_id)
+
+    async def start(self, on_cancel):
+        """
+        启动后台写入和心跳
+
+        Args:
+            on_cancel: 收到其他 worker 转交的取消请求时调用，参数为任务 ID
+        """
+        self._on_cancel = on_cancel
+        await asyncio.to_thread(self._maintain)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"任务共享存储已启动: worker {self.worker_id}")
+
+    async def close(self):
+        """写入剩余的状态并注销当前 worker"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for feed in list(self._feeds.values()):
+            feed.stop()
+        await self.flush()
+        with self._connect() as db:
+            db.execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+
+    # ---- 任意 worker 的读取 ----
+
+    def load(self, job_id):
+        """查询任务，不存在时返回 None"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return StoredJob(self, dict(row)) if row else None
+
+    def list_jobs(self, user, limit=1000):
+        """某个用户最近的任务"""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM jobs WHERE user = ? ORDER BY created_at LIMIT ?", (user, limit)
+            ).fetchall()
+        return [StoredJob(self, dict(row)) for row in rows]
+
+    def events_after(self, job_id, last_event_id, limit=500):
+        """
+        编号大于 last_event_id 的事件
+
+        Returns:
+            list: [(编号, 事件)]
+        """
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, data FROM job_events WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (job_id, last_event_id, limit)
+            ).fetchall()
+        return [(row["id"], json.loads(row["data"])) for row in rows]
+
+    def _poll(self, job_id, last_event_id):
+        """
+        读取任务状态和编号大于 last_event_id 的事件
+
+        Returns:
+            tuple: (任务行，不存在时为 None, [(编号, 事件)])
+        """
+        # 先读状态再读事件：任务结束前写入的事件在状态之前落盘，不会漏掉
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return (dict(row) if row else None), self.events_after(job_id, last_event_id, POLL_BATCH)
+
+    @asynccontextmanager
+    async def watch(self, job_id):
+        """
+        关注其他 worker 上的任务：本进程内同一任务的所有订阅者共用一个轮询，事件经共享的事件通道分发
+
+        Yields:
+            _RemoteFeed: 任务的轮询，最后一个订阅者离开时停止
+        """
+        feed = self._feeds.get(job_id)
+        if feed is None:
+            feed = self._feeds[job_id] = _RemoteFeed(self, job_id)
+        feed.watchers += 1
+        try:
+            yield feed
+        finally:
+            feed.watchers -= 1
+            if feed.watchers == 0:
+                if self._feeds.get(job_id) is feed:
+                    del self._feeds[job_id]
+                feed.stop()
+
+    def request_cancel(self, job_id):
+        """
+        请求取消其他 worker 上的任务，由该 worker 在下次维护时执行
+
+        Returns:
+            bool: 任务是否存在且尚未结束
+        """
+        with self._connect() as db:
+            return db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)",
+                (job_id, QUEUED, RUNNING)
+            ).rowcount > 0
+
+    def queue_position(self, job):
+        """任务在其所在 worker 的队列中前面还有多少个任务（近似值）"""
+        with self._connect() as db:
+            return db.execute(
+                """
+                SELECT COUNT(*) FROM jobs WHERE worker = ? AND status = ? AND id != ?
+                    AND (priority > ? OR (priority = ? AND created_at < ?))
+                """,
+                (job.worker, QUEUED, job.id, job.priority, job.priority, job.created_at)
+            ).fetchone()[0]
+
+    def stats(self):
+        """所有 worker 的任务统计"""
+        with self._connect() as db:
+            counts = {
+                row["status"]: row["count"]
+                for row in db.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")
+            }
+            workers = db.execute(
+                "SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (time.time() - self.heartbeat_timeout,)
+            ).fetchone()[0]
+        return {"workers": workers, **counts}
+
+
+class _RemoteFeed:
+    """本进程对其他 worker 上一个任务的轮询
+
+    读到的事件按原编号发布到事件通道，任务结束且事件取完后关闭通道。
+    有新事件时按最短间隔轮询，任务排队或长时间没有进度时间隔逐步加倍。
+    """
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        # 最近读到的任务行
+        self.row = None
+        self.events = EventChannel(store.max_events)
+        self.finished = asyncio.Event()
+        self.watchers = 0
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        interval = POLL_INTERVAL
+        try:
+            while True:
+                events = []
+                try:
+                    row, events = await asyncio.to_thread(self.store._poll, self.job_id, self.events.last_id)
+                except Exception as e:
+                    logger.warning(f"读取任务 {self.job_id} 的进度失败: {e}")
+                else:
+                    if row is None:
+                        # 任务记录已被清理
+                        return
+                    self.row = row
+                    for event_id, event in events:
+                        self.events.publish(event, event_id)
+                    if len(events) >= POLL_BATCH:
+                        continue
+                    if row["status"] in FINISHED_STATES:
+                        return
+                interval = POLL_INTERVAL if events else min(interval * 2, POLL_MAX_INTERVAL)
+                await asyncio.sleep(interval)
+        finally:
+            self.events.close()
+            self.finished.set()
+
+    def stop(self):
+        self._task.cancel()
+
+
+class StoredJob:
+    """其他 worker 上的任务，从共享存储读取，接口与 Job 的查询部分相同"""
+
+    def __init__(self, store, row):
+        self.store = store
+        self.id = row["id"]
+        self.worker = row["worker"]
+        self.kind = row["kind"]
+        self.description = row["description"]
+        self.user = row["user"]
+        self.priority = row["priority"]
+        self.status = row["status"]
+        self.created_at = row["created_at"]
+        self.started_at = row["started_at"]
+        self.finished_at = row["finished_at"]
+        self.result = json.loads(row["result"]) if row["result"] is not None else None
+        self.error = row["error"]
+        self.last_event_id = row["last_event_id"]
+
+    @property
+    def done(self):
+        return self.status in FINISHED_STATES
+
+    async def subscribe(self, last_event_id=0):
+        """
+        订阅进度事件：先重放已保存的事件，再接收新事件，任务结束且事件取完后停止
+
+        Yields:
+            tuple: (编号, 事件)
+        """
+        async with self.store.watch(self.id) as feed:
+            async for event_id, event in feed.events.subscribe(last_event_id):
+                yield event_id, event
+            if feed.row is not None:
+                self.__init__(self.store, feed.row)
+
+    async def wait(self):
+        """
+        等待任务结束
+
+        Returns:
+            任务结果；任务失败时抛出 RuntimeError，被取消时抛出 JobCancelledError
+        """
+        if not self.done:
+            async with self.store.watch(self.id) as feed:
+                await feed.finished.wait()
+            if feed.row is not None:
+                self.__init__(self.store, feed.row)
+            if not self.done:
+                raise RuntimeError(f"任务 {self.id} 的记录已被清理")
+        if self.status == FAILED:
+            raise RuntimeError(self.error or "任务失败")
+        if self.status == CANCELLED:
+            raise JobCancelledError(f"任务 {self.id} 已取消")
+        return self.result
+
+    def to_dict(self):
+        """任务状态的 JSON 表示"""
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "user": self.user,
+            "priority": self.priority,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "last_event_id": self.last_event_id,
+        }
@@ -0,0 +1,296 @@
+# llm_scheduler.py - LLM 请求的并发限制、速率限制、超时、重试和对冲
+import asyncio
+import collections
+import logging
+import random
+import time
+
+import httpx
+from openai import APIConnectionError, APIStatusError
+
+logger = logging.getLogger(__name__)
+
+# 用于计算对冲延迟的首个分块延迟样本数
+LATENCY_WINDOW = 200
+# 样本数达到该值后才启用对冲
+HEDGE_MIN_SAMPLES = 20
+
+_EMPTY = object()
+
+
+class LLMTimeoutError(TimeoutError):
+    """LLM 请求超过截止时间"""
+
+
+def _retryable(error):
+    """429、408 和 5xx 响应以及连接错误可以重试"""
+    status = getattr(error, "status_code", None)
+    if isinstance(error, APIStatusError) and status is not None:
+        return status in (408, 429) or status >= 500
+    return isinstance(error, (APIConnectionError, httpx.TransportError))
+
+
+def _retry_after(error):
+    """响应头 Retry-After 中的等待秒数"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def _close(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception as e:
+            logger.debug(f"关闭 LLM 流失败: {e}")
+
+
+class _TokenBucket:
+    """令牌桶：平均每秒 rate 个请求，允许 burst 个突发"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, deadline):
+        while not self.try_acquire():
+            wait = (1 - self.tokens) / self.rate
+            if time.monotonic() + wait > deadline:
+                raise LLMTimeoutError("等待 LLM 速率限制超时")
+            await asyncio.sleep(wait)
+
+
+class LLMScheduler:
+    """客户端的 LLM 请求调度
+
+    所有流式补全都经过这里：同时进行的请求数受信号量限制，可选的令牌桶限制请求速率；
+    每个请求有截止时间，超过即中止。收到第一个分块之前遇到 429/5xx 或连接错误时，
+    按指数退避加随机抖动重试（优先使用 Retry-After）；已经开始输出后不再重试，避免重复内容。
+    开启对冲后，首个分块的等待时间超过历史延迟的指定分位数时再发出一个相同的请求，
+    采用先返回的一个并取消另一个。
+    """
+
+    def __init__(self, max_concurrent=4, rate=0.0, burst=None, timeout=120.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, hedge_percentile=0.0):
+        """
+        初始化调度器
+
+        Args:
+            max_concurrent: 同时进行的 LLM 请求数上限
+            rate: 每秒请求数上限，0 为不限制
+            burst: 令牌桶容量，默认等于 max_concurrent
+            timeout: 单次补全（含排队和重试）的截止时间（秒）
+            max_retries: 最多重试次数
+            backoff_base: 退避的基础时间（秒）
+            backoff_max: 单次退避的最长时间（秒）
+            hedge_percentile: 首个分块延迟超过该分位数（如 95）时发出对冲请求，0 为关闭
+        """
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._bucket = _TokenBucket(rate, burst or max_concurrent) if rate > 0 else None
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def _percentile(self, p):
+        samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def stats(self):
+        """调度器状态和首个分块延迟"""
+        p50, p95 = self._percentile(50), self._percentile(95)
+        return {
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "first_chunk_p50": round(p50, 3) if p50 is not None else None,
+            "first_chunk_p95": round(p95, 3) if p95 is not None else None,
+        }
+
+    async def _acquire(self, deadline):
+        """占用一个并发名额并取得速率令牌"""
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise LLMTimeoutError("等待 LLM 并发名额超时") from None
+        finally:
+            self.waiting -= 1
+        try:
+            if self._bucket is not None:
+                await self._bucket.acquire(deadline)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    async def _try_acquire(self):
+        """对冲请求只使用空闲的名额和令牌，不排队"""
+        if self._slots.locked():
+            return False
+        if self._bucket is not None and not self._bucket.try_acquire():
+            return False
+        # 名额空闲时 acquire 立即返回
+        await self._slots.acquire()
+        self.in_flight += 1
+        return True
+
+    @staticmethod
+    async def _open(create):
+        """发起请求并等待第一个分块"""
+        stream = await create()
+        iterator = stream.__aiter__()
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            first = _EMPTY
+        except BaseException:
+            await _close(stream)
+            raise
+        return stream, iterator, first
+
+    async def _first_chunk(self, create, deadline):
+        """
+        发起请求（必要时对冲）并返回最先得到第一个分块的结果
+
+        调用前已占用一个名额；返回或抛出异常时仍然只占用一个名额。
+        """
+        started = time.monotonic()
+        primary = asyncio.create_task(self._open(create))
+        tasks = {primary}
+        hedge = None
+        try:
+            hedge_after = None
+            if self.hedge_percentile and len(self._latencies) >= HEDGE_MIN_SAMPLES:
+                hedge_after = self._percentile(self.hedge_percentile)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LLMTimeoutError("等待 LLM 首个分块超时")
+                timeout = remaining
+                if hedge is None and hedge_after is not None:
+                    timeout = min(remaining, max(0.0, started + hedge_after - time.monotonic()))
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        self._latencies.append(time.monotonic() - started)
+                        return task.result()
+                    if not tasks:
+                        raise task.exception()
+                    # 另一个请求仍在进行，等待它的结果
+                if not done and hedge is None and hedge_after is not None:
+                    hedge_after = None
+                    if await self._try_acquire():
+                        self.hedges += 1
+                        logger.info(f"LLM 首个分块超过 {self.hedge_percentile} 分位延迟，发出对冲请求")
+                        hedge = asyncio.create_task(self._open(create))
+                        tasks.add(hedge)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await _close(result[0])
+            if hedge is not None:
+                # 两个请求各占一个名额，结束后只保留一个
+                self._release()
+
+    async def stream(self, create, timeout=None):
+        """
+        经过调度执行一次流式补全，逐个产出分块
+
+        Args:
+            create: 发起请求的协程函数，返回可异步迭代的流（如 AsyncStream）
+            timeout: 截止时间（秒），默认使用调度器的设置
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        self.requests += 1
+        attempt = 0
+        while True:
+            await self._acquire(deadline)
+            try:
+                try:
+                    stream, iterator, first = await self._first_chunk(create, deadline)
+                except LLMTimeoutError:
+                    self.timeouts += 1
+                    raise
+                except Exception as e:
+                    delay = self._backoff(attempt, e)
+                    if not _retryable(e) or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                        self.failures += 1
+                        raise
+                    attempt += 1
+                    self.retries += 1
+                    logger.warning(f"LLM 请求失败，{delay:.1f} 秒后第 {attempt} 次重试: {e}")
+                else:
+                    try:
+                        if first is not _EMPTY:
+                            yield first
+                        while True:
+                            remaining = deadline - time.monotonic()
+                            try:
+                                if remaining <= 0:
+                                    raise asyncio.TimeoutError
+                                chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                            except StopAsyncIteration:
+                                return
+                            except asyncio.TimeoutError:
+                                self.timeouts += 1
+                                raise LLMTimeoutError("LLM 输出超过截止时间") from None
+                            yield chunk
+                    finally:
+                        await _close(stream)
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, error):
+        """指数退避加随机抖动，服务端给出 Retry-After 时以其为准"""
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max * 4)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
@@ -0,0 +1,416 @@
+# media_index.py - 用户文件的元数据索引
+import base64
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sqlite3
+import subprocess
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 目录 mtime 未变化时，至少间隔多久做一次完整的 stat 扫描（秒），用于发现原地修改的文件
+FULL_RESCAN_INTERVAL = 60.0
+
+# ffprobe 的超时时间（秒）
+PROBE_TIMEOUT = 30
+
+# 允许排序的字段及对应的排序表达式（均有索引，未知时长排在最前）
+SORT_FIELDS = {
+    "name": "name",
+    "size": "size",
+    "mtime": "mtime_ns",
+    "duration": "coalesce(duration, -1)",
+}
+
+_VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".wmv", ".flv", ".webm", ".m4v", ".ts"}
+_AUDIO_EXTENSIONS = {".mp3", ".wav", ".aac", ".flac", ".ogg", ".m4a", ".opus"}
+_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+
+
+def media_kind(name):
+    """根据扩展名判断文件类别：video / audio / image / other"""
+    ext = os.path.splitext(name)[1].lower()
+    if ext in _VIDEO_EXTENSIONS:
+        return "video"
+    if ext in _AUDIO_EXTENSIONS:
+        return "audio"
+    if ext in _IMAGE_EXTENSIONS:
+        return "image"
+    guessed, _ = mimetypes.guess_type(name)
+    if guessed and guessed.split("/")[0] in ("video", "audio", "image"):
+        return guessed.split("/")[0]
+    return "other"
+
+
+def probe(path, ffprobe="ffprobe"):
+    """
+    用 ffprobe 读取媒体信息
+
+    Returns:
+        dict: duration、width、height、video_codec、audio_codec、format；失败时返回 None
+    """
+    try:
+        completed = subprocess.run(
+            [ffprobe, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+            capture_output=True, timeout=PROBE_TIMEOUT, check=True
+        )
+        info = json.loads(completed.stdout or b"{}")
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logger.warning(f"读取媒体信息失败 {path}: {e}")
+        return None
+    fmt = info.get("format", {})
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), {})
+    try:
+        duration = float(fmt.get("duration") or video.get("duration") or audio.get("duration") or 0) or None
+    except ValueError:
+        duration = None
+    return {
+        "duration": duration,
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "video_codec": video.get("codec_name"),
+        "audio_codec": audio.get("codec_name"),
+        "format": fmt.get("format_name"),
+    }
+
+
+class InvalidCursorError(ValueError):
+    """分页游标无效或与查询参数不匹配"""
+
+
+class MediaIndex:
+    """uploads/ 和 outputs/ 中文件的元数据索引
+
+    大小、mtime、内容哈希、时长、分辨率、编码和缩略图保存在 SQLite 中，文件列表直接按索引分页查询。
+    索引在上传和生成输出时即时更新，另外按目录 mtime 增量重扫：目录未变化时跳过扫描，
+    扫描时只对大小或 mtime 变化的文件重新读取元数据。ffprobe 和缩略图在后台补齐。
+    """
+
+    def __init__(self, db_path, roots, blob_store=None, thumbnails=None):
+        """
+        初始化元数据索引
+
+        Args:
+            db_path: 索引数据库路径
+            roots: 文件类型 -> 目录，如 {"upload": "uploads", "output": "outputs"}
+            blob_store: 用于查询内容哈希的 BlobStore
+            thumbnails: 生成封面图和雪碧图的 ThumbnailCache，为空时不生成
+        """
+        self.db_path = db_path
+        self.roots = roots
+        self.blob_store = blob_store
+        self.thumbnails = thumbnails
+        self.ffprobe = shutil.which("ffprobe")
+        # 文件类型 -> (目录 mtime_ns, 上次完整扫描时间)
+        self._scanned = {}
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS media (
+                    path TEXT PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT,
+                    duration REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    video_codec TEXT,
+                    audio_codec TEXT,
+                    format TEXT,
+                    thumbnail TEXT,
+                    probed INTEGER NOT NULL DEFAULT 0,
+                    indexed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS media_name ON media (type, name);
+                CREATE INDEX IF NOT EXISTS media_mtime_key ON media (type, mtime_ns, name);
+                CREATE INDEX IF NOT EXISTS media_size_key ON media (type, size, name);
+                CREATE INDEX IF NOT EXISTS media_duration_key ON media (type, coalesce(duration, -1), name);
+                CREATE INDEX IF NOT EXISTS media_pending ON media (probed);
+                CREATE INDEX IF NOT EXISTS media_thumbnail ON media (thumbnail);
+
+                -- 索引每次变化时递增版本号，用于生成 ETag
+                CREATE TABLE IF NOT EXISTS state (version INTEGER NOT NULL);
+                INSERT INTO state SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM state);
+                CREATE TRIGGER IF NOT EXISTS media_insert AFTER INSERT ON media
+                    BEGIN UPDATE state SET version = version + 1; END;
+                CREATE TRIGGER IF NOT EXISTS media_update AFTER UPDATE ON media
+                    BEGIN UPDATE state SET version = version + 1; END;
+                CREATE TRIGGER IF NOT EXISTS media_delete AFTER DELETE ON media
+                    BEGIN UPDATE state SET version = version + 1; END;
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _type_of(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        for file_type, root in self.roots.items():
+            if os.path.abspath(root) == directory:
+                return file_type
+        return None
+
+    def refresh(self, path, sha256=None):
+        """
+        立即更新单个文件的索引（上传完成、生成输出后调用）
+
+        Args:
+            path: 文件路径
+            sha256: 已知的内容哈希
+        """
+        file_type = self._type_of(path)
+        if file_type is None:
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.remove(path)
+            return
+        if sha256 is None and self.blob_store is not None:
+            sha256 = self.blob_store.digest_of(path)
+        self._upsert(file_type, os.path.abspath(path), st.st_size, st.st_mtime_ns, sha256)
+
+    def _upsert(self, file_type, path, size, mtime_ns, sha256):
+        name = os.path.basename(path)
+        with self._connect() as db:
+            # 内容变化时清空旧的媒体信息，等待重新探测
+            db.execute(
+                """
+                INSERT INTO media (path, type, name, kind, size, mtime_ns, sha256, indexed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size, mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256,
+                    duration = NULL, width = NULL, height = NULL, video_codec = NULL,
+                    audio_codec = NULL, format = NULL, thumbnail = NULL, probed = 0,
+                    indexed_at = excluded.indexed_at
+                WHERE media.size != excluded.size OR media.mtime_ns != excluded.mtime_ns
+                    OR media.sha256 IS NOT excluded.sha256
+                """,
+                (path, file_type, name, media_kind(name), size, mtime_ns, sha256, time.time())
+            )
+
+    def remove(self, path):
+        """从索引中删除文件"""
+        with self._connect() as db:
+            db.execute("DELETE FROM media WHERE path = ?", (os.path.abspath(path),))
+
+    def rescan(self, force=False):
+        """
+        增量重扫所有目录：目录 mtime 未变且距上次完整扫描不久时跳过
+
+        Returns:
+            int: 新增、变化或删除的文件数
+        """
+        changed = 0
+        for file_type, root in self.roots.items():
+            try:
+                dir_mtime = os.stat(root).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            last = self._scanned.get(file_type)
+            now = time.monotonic()
+            if (not force and last and last[0] == dir_mtime
+                    and now - last[1] < FULL_RESCAN_INTERVAL):
+                continue
+            changed += self._scan_dir(file_type, root)
+            self._scanned[file_type] = (dir_mtime, now)
+        return changed
+
+    def _scan_dir(self, file_type, root):
+        with self._connect() as db:
+            known = {
+                row["path"]: (row["size"], row["mtime_ns"], row["sha256"])
+                for row in db.execute(
+                    "SELECT path, size, mtime_ns, sha256 FROM media WHERE type = ?", (file_type,)
+                )
+            }
+        digests = self.blob_store.digests_in(root) if self.blob_store is not None else {}
+        changed = 0
+        seen = set()
+        for entry in os.scandir(root):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            path = os.path.abspath(entry.path)
+            seen.add(path)
+            st = entry.stat()
+            digest = digests.get(entry.name)
+            sha256 = digest[0] if digest and digest[1:] == (st.st_size, st.st_mtime_ns) else None
+            if known.get(path) != (st.st_size, st.st_mtime_ns, sha256):
+                self._upsert(file_type, path, st.st_size, st.st_mtime_ns, sha256)
+                changed += 1
+        vanished = [path for path in known if path not in seen]
+        if vanished:
+            with self._connect() as db:
+                db.executemany("DELETE FROM media WHERE path = ?", [(p,) for p in vanished])
+            changed += len(vanished)
+        if changed:
+            logger.info(f"媒体索引已更新 {root}: {changed} 个文件")
+        return changed
+
+    def probe_pending(self, limit=20):
+        """
+        为尚未探测的文件读取媒体信息，并为视频和图片生成封面图和雪碧图
+
+        Returns:
+            int: 本次处理的文件数
+        """
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT path, kind, sha256, size, mtime_ns FROM media WHERE probed = 0 LIMIT ?", (limit,)
+            ).fetchall()
+        for row in rows:
+            info = {}
+            if row["kind"] in ("video", "audio") and self.ffprobe:
+                info = probe(row["path"], self.ffprobe) or {}
+            if row["kind"] in ("video", "image") and self.thumbnails is not None and row["sha256"]:
+                if self.thumbnails.generate(row["path"], row["sha256"], row["kind"], info.get("duration"),
+                                            info.get("width"), info.get("height")):
+                    info["thumbnail"] = row["sha256"]
+            with self._connect() as db:
+                # 探测期间文件被修改时放弃本次结果
+                db.execute(
+                    """
+                    UPDATE media SET duration = ?, width = ?, height = ?, video_codec = ?,
+                        audio_codec = ?, format = ?, thumbnail = ?, probed = 1
+                    WHERE path = ? AND size = ? AND mtime_ns = ?
+                    """,
+                    (info.get("duration"), info.get("width"), info.get("height"),
+                     info.get("video_codec"), info.get("audio_codec"), info.get("format"),
+                     info.get("thumbnail"), row["path"], row["size"], row["mtime_ns"])
+                )
+        return len(rows)
+
+    def regenerate_thumbnail(self, key):
+        """
+        缩略图缓存中的内容被淘汰后，把对应文件重新加入后台探测队列
+
+        Returns:
+            int: 受影响的文件数
+        """
+        with self._connect() as db:
+            return db.execute(
+                "UPDATE media SET probed = 0 WHERE thumbnail = ? AND probed = 1", (key,)
+            ).rowcount
+
+    def get(self, path):
+        """查询单个文件的索引记录"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM media WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def version(self):
+        """索引的版本号，任何文件新增、变化或删除后都会改变"""
+        with self._connect() as db:
+            return db.execute("SELECT version FROM state").fetchone()["version"]
+
+    @staticmethod
+    def _encode_cursor(file_type, sort, order, value, name):
+        payload = json.dumps([file_type, sort, order, value, name], ensure_ascii=False)
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor, file_type, sort, order):
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            cursor_type, cursor_sort, cursor_order, value, name = json.loads(
+                base64.urlsafe_b64decode(padded.encode("ascii"))
+            )
+        except (ValueError, TypeError) as e:
+            raise InvalidCursorError("无效的分页游标") from e
+        if (cursor_type, cursor_sort, cursor_order) != (file_type, sort, order):
+            raise InvalidCursorError("分页游标与查询参数不匹配")
+        return value, name
+
+    def page(self, file_type, limit=100, sort="name", order="asc", query=None, kind=None,
+             since=None, until=None, cursor=None):
+        """
+        按游标分页查询文件列表
+
+        使用 (排序字段, 文件名) 作为键集分页，排序字段都有对应的复合索引，
+        每页的查询代价只与页大小有关，翻页期间有文件增删也不会重复或遗漏。
+
+        Args:
+            file_type: 文件类型（roots 中的键）
+            limit: 每页数量
+            sort: 排序字段 name / size / mtime / duration
+            order: asc 或 desc
+            query: 文件名包含的文本
+            kind: 文件类别 video / audio / image / other
+            since: 只返回修改时间不早于该时间（Unix 秒）的文件
+            until: 只返回修改时间早于该时间（Unix 秒）的文件
+            cursor: 上一页返回的游标
+
+        Returns:
+            tuple: (文件列表, 下一页游标；没有更多时为 None)
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"不支持的排序字段: {sort}")
+        expr = SORT_FIELDS[sort]
+        direction = "DESC" if order == "desc" else "ASC"
+        where = ["type = ?"]
+        params = [file_type]
+        if query:
+            where.append("instr(lower(name), ?) > 0")
+            params.append(query.lower())
+        if kind:
+            where.append("kind = ?")
+            params.append(kind)
+        if since is not None:
+            where.append("mtime_ns >= ?")
+            params.append(int(since * 1e9))
+        if until is not None:
+            where.append("mtime_ns < ?")
+            params.append(int(until * 1e9))
+        if cursor:
+            value, name = self._decode_cursor(cursor, file_type, sort, order)
+            where.append(f"({expr}, name) {'<' if order == 'desc' else '>'} (?, ?)")
+            params.extend([value, name])
+        sql = (
+            f"SELECT *, {expr} AS sort_key FROM media WHERE {' AND '.join(where)} "
+            f"ORDER BY {expr} {direction}, name {direction} LIMIT ?"
+        )
+        with self._connect() as db:
+            rows = db.execute(sql, (*params, limit + 1)).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = self._encode_cursor(file_type, sort, order, last["sort_key"], last["name"])
+        return [self._to_dict(row) for row in rows[:limit]], next_cursor
+
+    @staticmethod
+    def _to_dict(row):
+        return {
+            "name": row["name"],
+            "path": row["path"],
+            "size": row["size"],
+            "mtime": row["mtime_ns"] / 1e9,
+            "sha256": row["sha256"],
+            "kind": row["kind"],
+            "duration": row["duration"],
+            "width": row["width"],
+            "height": row["height"],
+            "video_codec": row["video_codec"],
+            "audio_codec": row["audio_codec"],
+            "format": row["format"],
+            "thumbnail": f"/api/thumbnails/{row['thumbnail']}/poster.jpg" if row["thumbnail"] else None,
+            # 有时长和画面的视频才有进度条预览
+            "sprite": (f"/api/thumbnails/{row['thumbnail']}/sprite.vtt"
+                       if row["thumbnail"] and row["duration"] and row["width"] else None),
+        }
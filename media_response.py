@@ -0,0 +1,355 @@
+# media_response.py - 支持 Range / 条件请求的媒体文件响应
+import asyncio
+import logging
+import mimetypes
+import os
+import stat
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
+
+from starlette.responses import Response
+
+logger = logging.getLogger(__name__)
+
+# 无零拷贝发送时每次读取的块大小
+CHUNK_SIZE = 512 * 1024
+# 合并后仍超过该数量的多段请求直接返回完整文件，避免被大量小区间放大开销
+MAX_RANGES = 16
+
+# mimetypes 无法识别时使用的类型
+_FALLBACK_TYPES = {
+    ".mp4": "video/mp4", ".m4v": "video/mp4", ".mov": "video/quicktime",
+    ".mkv": "video/x-matroska", ".webm": "video/webm", ".avi": "video/x-msvideo",
+    ".wmv": "video/x-ms-wmv", ".flv": "video/x-flv", ".ts": "video/mp2t",
+    ".mp3": "audio/mpeg", ".wav": "audio/wav", ".aac": "audio/aac",
+    ".flac": "audio/flac", ".ogg": "audio/ogg", ".m4a": "audio/mp4",
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png",
+    ".gif": "image/gif", ".webp": "image/webp", ".svg": "image/svg+xml",
+    ".bmp": "image/bmp", ".tiff": "image/tiff", ".ico": "image/x-icon",
+}
+
+
+class RangeNotSatisfiableError(Exception):
+    """请求的区间都不在文件范围内"""
+
+
+@lru_cache(maxsize=256)
+def _type_for_extension(ext):
+    media_type = mimetypes.types_map.get(ext) or _FALLBACK_TYPES.get(ext)
+    return media_type or "application/octet-stream"
+
+
+def guess_media_type(filename):
+    """根据扩展名确定 MIME 类型，结果按扩展名缓存"""
+    return _type_for_extension(os.path.splitext(filename)[1].lower())
+
+
+@dataclass(frozen=True)
+class FileInfo:
+    """提供文件时需要的元数据"""
+    path: str
+    size: int
+    mtime: float
+    etag: str
+    last_modified: str
+    media_type: str
+
+
+class FileInfoCache:
+    """按路径缓存 stat 结果和 MIME 类型
+
+    播放器拖动进度条时会对同一文件连续发出大量 Range 请求，短时间内复用同一份元数据；
+    文件在缓存期内被替换时由调用方 invalidate，或在 ttl 后自然过期。
+    """
+
+    def __init__(self, ttl=2.0, max_entries=1024):
+        """
+        Args:
+            ttl: 缓存有效期（秒）
+            max_entries: 缓存条目上限
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, path):
+        """
+        获取文件元数据
+
+        Returns:
+            FileInfo: 文件元数据，文件不存在或不是普通文件时抛出 FileNotFoundError
+        """
+        now = time.monotonic()
+        entry = self._entries.get(path)
+        if entry is not None and now - entry[0] < self.ttl:
+            self._entries.move_to_end(path)
+            return entry[1]
+
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        info = FileInfo(
+            path=path,
+            size=st.st_size,
+            mtime=st.st_mtime,
+            etag=f'"{st.st_size:x}-{st.st_mtime_ns:x}"',
+            last_modified=formatdate(st.st_mtime, usegmt=True),
+            media_type=guess_media_type(path),
+        )
+        self._entries[path] = (now, info)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return info
+
+    def invalidate(self, path):
+        """文件被修改或删除后丢弃缓存"""
+        self._entries.pop(path, None)
+
+
+def parse_range(header, size):
+    """
+    解析 Range 请求头
+
+    Args:
+        header: Range 请求头，例如 "bytes=0-499, 1000-"
+        size: 文件大小
+
+    Returns:
+        list: 合并后的 [(起始, 结束)] 闭区间；请求头无效或区间过多时返回 None，表示忽略 Range
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition("-")
+        start, end = start.strip(), end.strip()
+        if not sep or not (start.isdigit() or start == "") or not (end.isdigit() or end == ""):
+            return None
+        if start == "":
+            # 后缀区间：最后 N 个字节
+            if end == "":
+                return None
+            length = int(end)
+            if length == 0 or size == 0:
+                # 空文件没有可满足的区间
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(start)
+        if end and int(end) < first:
+            return None
+        if first >= size:
+            continue
+        last = int(end) if end else size - 1
+        ranges.append((first, min(last, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiableError(header)
+
+    # 合并重叠和相邻的区间
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        prev_first, prev_last = merged[-1]
+        if first <= prev_last + 1:
+            merged[-1] = (prev_first, max(prev_last, last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def _http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _etag_in(header, etag, weak=True):
+    # If-None-Match 使用弱比较，If-Range 必须强比较
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def not_modified(headers, info):
+    """根据 If-None-Match / If-Modified-Since 判断是否可以返回 304"""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_in(if_none_match, info.etag)
+    if_modified_since = _http_date(headers.get("if-modified-since"))
+    return if_modified_since is not None and int(info.mtime) <= if_modified_since
+
+
+def range_applies(headers, info):
+    """If-Range 与当前文件不匹配时应忽略 Range，返回完整文件"""
+    if_range = headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return _etag_in(if_range, info.etag, weak=False)
+    return if_range == info.last_modified
+
+
+class MediaFileResponse(Response):
+    """按请求头返回完整文件、单区间或 multipart/byteranges 多区间响应
+
+    默认在线程池中按块 pread，不会把整个区间读入内存；客户端断开后立即停止读取。
+    只有服务器声明了 ASGI 的 http.response.zerocopysend 扩展时才交给服务器通过 sendfile 发送，
+    uvicorn 不提供该扩展，在 uvicorn 下始终按块读取。
+    """
+
+    def __init__(self, info, request_headers, method="GET", headers=None):
+        """
+        Args:
+            info: 文件元数据
+            request_headers: 请求头
+            method: 请求方法，HEAD 时不发送响应体
+            headers: 额外的响应头
+        """
+        self.info = info
+        self.send_body = method != "HEAD"
+        self.ranges = None
+        self.boundary = None
+        self.background = None
+        self.raw_headers = []
+
+        base_headers = {
+            "accept-ranges": "bytes",
+            "etag": info.etag,
+            "last-modified": info.last_modified,
+            **{k.lower(): v for k, v in (headers or {}).items()},
+        }
+
+        if not_modified(request_headers, info):
+            self.status_code = 304
+            self._set_headers(base_headers)
+            return
+
+        range_header = request_headers.get("range")
+        if range_header and range_applies(request_headers, info):
+            try:
+                self.ranges = parse_range(range_header, info.size)
+            except RangeNotSatisfiableError:
+                self.status_code = 416
+                base_headers["content-range"] = f"bytes */{info.size}"
+                base_headers["content-length"] = "0"
+                self._set_headers(base_headers)
+                return
+
+        if not self.ranges:
+            self.status_code = 200
+            self.ranges = [(0, info.size - 1)] if info.size else []
+            base_headers["content-type"] = info.media_type
+            base_headers["content-length"] = str(info.size)
+        elif len(self.ranges) == 1:
+            first, last = self.ranges[0]
+            self.status_code = 206
+            base_headers["content-type"] = info.media_type
+            base_headers["content-range"] = f"bytes {first}-{last}/{info.size}"
+            base_headers["content-length"] = str(last - first + 1)
+        else:
+            self.status_code = 206
+            self.boundary = uuid.uuid4().hex
+            base_headers["content-type"] = f"multipart/byteranges; boundary={self.boundary}"
+            base_headers["content-length"] = str(self._multipart_length())
+        self._set_headers(base_headers)
+
+    def _set_headers(self, headers):
+        self.raw_headers = [(k.encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]
+
+    def _part_header(self, first, last):
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Type: {self.info.media_type}\r\n"
+            f"Content-Range: bytes {first}-{last}/{self.info.size}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _closing_boundary(self):
+        return f"--{self.boundary}--\r\n".encode("latin-1")
+
+    def _multipart_length(self):
+        length = len(self._closing_boundary())
+        for first, last in self.ranges:
+            length += len(self._part_header(first, last)) + (last - first + 1) + 2
+        return length
+
+    async def __call__(self, scope, receive, send):
+        if self.status_code in (304, 416) or not self.send_body:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        try:
+            f = open(self.info.path, "rb")
+        except FileNotFoundError:
+            # 文件在缓存的元数据有效期内被删除
+            await Response("文件不存在", status_code=404)(scope, receive, send)
+            return
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(self._watch_disconnect(receive, disconnected))
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            for first, last in self.ranges:
+                if disconnected.is_set():
+                    return
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": self._part_header(first, last), "more_body": True})
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": first,
+                        "count": last - first + 1,
+                        "more_body": True,
+                    })
+                else:
+                    await self._send_chunks(f, first, last, send, disconnected)
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+            tail = self._closing_boundary() if self.boundary else b""
+            await send({"type": "http.response.body", "body": tail, "more_body": False})
+        except OSError as e:
+            logger.info(f"媒体传输中断 {self.info.path}: {e}")
+        finally:
+            watcher.cancel()
+            f.close()
+
+    async def _send_chunks(self, f, first, last, send, disconnected):
+        fd = f.fileno()
+        offset = first
+        while offset <= last and not disconnected.is_set():
+            data = await asyncio.to_thread(os.pread, fd, min(CHUNK_SIZE, last - offset + 1), offset)
+            if not data:
+                # 文件在发送过程中被截断
+                raise OSError(f"文件在 {offset} 处提前结束")
+            offset += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+
+    @staticmethod
+    async def _watch_disconnect(receive, disconnected):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
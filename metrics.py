@@ -0,0 +1,231 @@
+# metrics.py - 请求 ID、分阶段耗时和 Prometheus 指标
+import contextlib
+import logging
+import os
+import time
+import uuid
+from contextvars import ContextVar
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# METRICS_ENABLED=0 时不记录任何指标，span 等调用退化为空操作
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+# 多 worker 部署（serve.py）时各进程把指标写到这个目录，抓取时汇总
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir")
+
+# 当前请求的 ID，随 asyncio 任务的上下文传递到任务队列和日志中
+request_id = ContextVar("request_id", default="-")
+
+REGISTRY = CollectorRegistry(auto_describe=True)
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HTTP_DURATION = Histogram(
+    "mcp_http_request_duration_seconds", "HTTP 请求处理耗时（到响应头发出为止）",
+    ["method", "route", "status"], buckets=_LATENCY_BUCKETS, registry=REGISTRY
+)
+PHASE_DURATION = Histogram(
+    "mcp_phase_duration_seconds", "请求各阶段的耗时",
+    ["phase"], buckets=_LATENCY_BUCKETS, registry=REGISTRY
+)
+FFMPEG_ACTIVE = Gauge(
+    "mcp_ffmpeg_active", "正在运行的 FFmpeg 处理（工具调用、流水线、预览切片、缩略图）",
+    ["source"], registry=REGISTRY, multiprocess_mode="livesum"
+)
+HTTP_RECEIVED = Counter(
+    "mcp_http_received_bytes", "请求体的字节数（上传）", ["route"], registry=REGISTRY
+)
+HTTP_SENT = Counter(
+    "mcp_http_sent_bytes", "响应体的字节数（下载、媒体流和预览切片）", ["route"], registry=REGISTRY
+)
+
+_NOOP = contextlib.nullcontext()
+# register_sources 注册的抓取时指标
+_COLLECTORS = []
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class _Span:
+    __slots__ = ("phase", "started")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        PHASE_DURATION.labels(self.phase).observe(elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            status = "失败" if exc_type is not None else "完成"
+            logger.debug(f"阶段 {self.phase} {status}，耗时 {elapsed * 1000:.1f} ms")
+        return False
+
+
+def span(phase):
+    """
+    记录一个阶段的耗时，用法: with span("llm_completion"): ...
+
+    Args:
+        phase: 阶段名称，作为 mcp_phase_duration_seconds 的 phase 标签
+    """
+    return _Span(phase) if ENABLED else _NOOP
+
+
+def observe(phase, seconds):
+    """直接记录一个阶段的耗时（起止时间不在同一个代码块中时使用）"""
+    if ENABLED:
+        PHASE_DURATION.labels(phase).observe(seconds)
+
+
+def ffmpeg_running(source):
+    """标记一个正在运行的 FFmpeg 处理，用法: with ffmpeg_running("pipeline"): ..."""
+    return FFMPEG_ACTIVE.labels(source).track_inprogress() if ENABLED else _NOOP
+
+
+class _StatsCollector:
+    """抓取时从各组件已有的统计中读取指标，热路径上没有额外开销"""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def collect(self):
+        for collect in self.sources:
+            try:
+                yield from collect()
+            except Exception as e:
+                logger.warning(f"读取指标失败: {e}")
+
+
+def register_sources(*sources):
+    """
+    注册抓取时调用的指标来源
+
+    Args:
+        sources: 无参函数，返回 (名称, 说明, 类型 counter/gauge, {标签元组: 值}, 标签名列表) 的列表
+    """
+    if not ENABLED:
+        return
+
+    def wrap(source):
+        def collect():
+            for name, documentation, kind, values, labels in source():
+                family_type = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+                family = family_type(name, documentation, labels=labels)
+                for label_values, value in values.items():
+                    family.add_metric(list(label_values), value)
+                yield family
+        return collect
+
+    collector = _StatsCollector([wrap(source) for source in sources])
+    _COLLECTORS.append(collector)
+    REGISTRY.register(collector)
+
+
+def render():
+    """
+    Prometheus 文本格式的全部指标
+
+    多 worker 部署时请求和阶段指标汇总所有 worker 的数据；抓取时读取的组件统计
+    （任务队列之外的缓存、LLM 调度、会话池）只反映处理本次抓取的 worker。
+
+    Returns:
+        tuple: (内容, Content-Type)
+    """
+    if not MULTIPROC_DIR:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in _COLLECTORS:
+        registry.register(collector)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid=None):
+    """worker 进程退出时清理它的 livesum 指标文件"""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid(), MULTIPROC_DIR)
+
+
+class RequestIdFilter(logging.Filter):
+    """给日志记录加上 request_id 字段"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+def install_log_context(fmt="%(levelname)s:%(name)s:[%(request_id)s] %(message)s"):
+    """在根日志处理器上加入请求 ID，之后的每条日志都带有 [请求 ID]"""
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=logging.INFO)
+    for handler in root.handlers:
+        if not any(isinstance(f, RequestIdFilter) for f in handler.filters):
+            handler.addFilter(RequestIdFilter())
+            handler.setFormatter(logging.Formatter(fmt))
+
+
+def _route(scope):
+    # 路由匹配后 scope 中有路由模板，按模板而不是实际路径统计，避免标签数量膨胀
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """ASGI 中间件：为每个请求分配请求 ID，统计耗时和收发字节数
+
+    请求 ID 取自请求头 X-Request-ID（没有时生成），写入上下文和响应头。
+    直接实现 ASGI 接口而不是用 BaseHTTPMiddleware，不会缓冲流式响应，也保留零拷贝发送扩展。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rid = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                rid = value.decode("latin-1")[:64]
+                break
+        rid = rid or new_request_id()
+        token = request_id.set(rid)
+        started = time.perf_counter()
+
+        async def receive_counted():
+            message = await receive()
+            if message["type"] == "http.request" and message.get("body"):
+                HTTP_RECEIVED.labels(_route(scope)).inc(len(message["body"]))
+            return message
+
+        async def send_counted(message):
+            kind = message["type"]
+            if kind == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", rid.encode("latin-1"))]
+                if ENABLED:
+                    HTTP_DURATION.labels(scope["method"], _route(scope), str(message["status"])).observe(
+                        time.perf_counter() - started
+                    )
+            elif ENABLED and kind == "http.response.body" and message.get("body"):
+                HTTP_SENT.labels(_route(scope)).inc(len(message["body"]))
+            elif ENABLED and kind == "http.response.zerocopysend":
+                HTTP_SENT.labels(_route(scope)).inc(message.get("count") or 0)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_counted if ENABLED else receive, send_counted)
+        finally:
+            request_id.reset(token)
@@ -0,0 +1,518 @@
+# pipeline.py - 把多步视频操作（DAG）编译为一次 FFmpeg 调用
+import asyncio
+import logging
+import math
+import os
+import shutil
+import uuid
+from dataclasses import dataclass, field
+
+from ffmpeg_progress import ProgressParser, parse_time
+
+logger = logging.getLogger(__name__)
+
+# 支持的操作及其输入数量（None 表示至少两个）
+OPERATIONS = {
+    "clip_video": 1,
+    "scale_video": 1,
+    "overlay_video": 2,
+    "concat_videos": None,
+    "extract_audio_from_video": 1,
+    "extract_frames_from_video": 1,
+}
+
+# 叠加位置：名称或 1~9 宫格编号 -> overlay 的 x, y 表达式
+_OVERLAY_POSITIONS = {
+    "top-left": ("0", "0"),
+    "top": ("(W-w)/2", "0"),
+    "top-right": ("W-w", "0"),
+    "left": ("0", "(H-h)/2"),
+    "center": ("(W-w)/2", "(H-h)/2"),
+    "right": ("W-w", "(H-h)/2"),
+    "bottom-left": ("0", "H-h"),
+    "bottom": ("(W-w)/2", "H-h"),
+    "bottom-right": ("W-w", "H-h"),
+}
+_OVERLAY_GRID = list(_OVERLAY_POSITIONS)
+
+# 按输出扩展名选择编码器
+_VIDEO_CODECS = {
+    ".mp4": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-pix_fmt", "yuv420p",
+             "-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart"],
+    ".mov": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-pix_fmt", "yuv420p",
+             "-c:a", "aac", "-b:a", "192k"],
+    ".mkv": ["-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-c:a", "aac", "-b:a", "192k"],
+    ".webm": ["-c:v", "libvpx-vp9", "-crf", "32", "-b:v", "0", "-c:a", "libopus"],
+}
+# 提取帧时允许的图片格式
+_IMAGE_FORMATS = ("jpg", "jpeg", "png", "bmp", "webp", "tiff")
+
+_AUDIO_CODECS = {
+    ".mp3": ["-c:a", "libmp3lame", "-q:a", "2"],
+    ".wav": ["-c:a", "pcm_s16le"],
+    ".flac": ["-c:a", "flac"],
+    ".aac": ["-c:a", "aac", "-b:a", "192k"],
+    ".m4a": ["-c:a", "aac", "-b:a", "192k"],
+    ".ogg": ["-c:a", "libvorbis", "-q:a", "5"],
+    ".opus": ["-c:a", "libopus"],
+}
+
+
+class PipelineError(ValueError):
+    """流水线定义无效"""
+
+
+@dataclass
+class _Node:
+    id: str
+    op: str
+    inputs: list
+    params: dict
+    video: object = None
+    audio: object = None
+    duration: float = None
+
+
+@dataclass
+class _Pad:
+    """一路音频或视频流：输入文件中的流，或滤镜图中某个滤镜的输出"""
+    label: str
+    source: bool = False
+    uses: int = 0
+    _labels: list = field(default_factory=list)
+
+    def take(self):
+        """返回给下一个使用者的标签：输入文件的流可以直接多次引用，滤镜输出多次使用时先 split"""
+        if self.source or len(self._labels) == 0:
+            return self.label
+        return self._labels.pop(0)
+
+    def ref(self):
+        label = self.take()
+        return f"[{label}]"
+
+    def map_arg(self):
+        label = self.take()
+        return label if self.source else f"[{label}]"
+
+
+@dataclass
+class PipelinePlan:
+    """编译结果"""
+    command: list
+    # 节点 ID -> (临时路径, 最终路径)
+    outputs: dict
+    duration: float = None
+    # 输出为目录（提取的帧）的节点 ID
+    directories: set = field(default_factory=set)
+
+
+def _topological_order(steps, sources):
+    order = []
+    done = set(sources)
+    pending = dict(steps)
+    while pending:
+        ready = [sid for sid, node in pending.items() if all(i in done for i in node.inputs)]
+        if not ready:
+            raise PipelineError(f"流水线存在环或引用了不存在的节点: {', '.join(sorted(pending))}")
+        for sid in ready:
+            order.append(pending.pop(sid))
+            done.add(sid)
+    return order
+
+
+def _needed(steps, outputs):
+    """从输出反向找出实际需要执行的节点，未被任何输出使用的步骤不执行"""
+    needed = set()
+    stack = list(outputs)
+    while stack:
+        sid = stack.pop()
+        if sid in needed or sid not in steps:
+            continue
+        needed.add(sid)
+        stack.extend(steps[sid].inputs)
+    return needed
+
+
+def compile_pipeline(spec, sources, output_dir="outputs", ffmpeg="ffmpeg"):
+    """
+    把流水线定义编译为一条 FFmpeg 命令
+
+    所有步骤融合进同一个 filter_complex，中间结果只在滤镜图中以帧的形式流动，不写中间文件，
+    输入只解码一次；只有 outputs 中列出的节点会被编码写出。直接作用于输入文件的剪切
+    转换为输入端的 -ss/-t，跳过不需要的部分。
+
+    Args:
+        spec: {"inputs": {名称: 路径}, "steps": [{"id", "op", "inputs", "params"}], "outputs": {节点: 文件名}}
+        sources: 输入名称 -> 媒体信息（has_video、has_audio、duration）
+        output_dir: 输出目录
+        ffmpeg: ffmpeg 可执行文件
+
+    Returns:
+        PipelinePlan: 编译后的命令和输出路径
+    """
+    inputs = spec.get("inputs") or {}
+    outputs = spec.get("outputs") or {}
+    if not inputs:
+        raise PipelineError("流水线至少需要一个输入")
+    if not outputs:
+        raise PipelineError("流水线至少需要一个输出")
+
+    steps = {}
+    for raw in spec.get("steps") or []:
+        sid, op = raw.get("id"), raw.get("op")
+        if not sid or sid in steps or sid in inputs:
+            raise PipelineError(f"步骤 ID 为空或重复: {sid!r}")
+        if op not in OPERATIONS:
+            raise PipelineError(f"不支持的操作: {op}，可用: {', '.join(OPERATIONS)}")
+        node_inputs = list(raw.get("inputs") or [])
+        arity = OPERATIONS[op]
+        if (arity is None and len(node_inputs) < 2) or (arity is not None and len(node_inputs) != arity):
+            raise PipelineError(f"步骤 {sid} ({op}) 的输入数量不正确")
+        steps[sid] = _Node(sid, op, node_inputs, dict(raw.get("params") or {}))
+    for sid in outputs:
+        if sid not in steps:
+            raise PipelineError(f"输出引用了不存在的步骤: {sid}")
+
+    needed = _needed(steps, outputs)
+    order = [node for node in _topological_order(steps, inputs) if node.id in needed]
+
+    # 使用次数：决定输入能否用 -ss/-t 剪切，以及滤镜输出是否需要 split
+    consumers = {}
+    for node in order:
+        for name in node.inputs:
+            consumers[name] = consumers.get(name, 0) + 1
+
+    source_names = [name for name in inputs if consumers.get(name)]
+    input_args = []
+    nodes = {}
+    for index, name in enumerate(source_names):
+        info = sources[name]
+        nodes[name] = _Node(
+            name, "input", [], {},
+            video=_Pad(f"{index}:v:0", source=True) if info.get("has_video") else None,
+            audio=_Pad(f"{index}:a:0", source=True) if info.get("has_audio") else None,
+            duration=info.get("duration"),
+        )
+        seek = []
+        fused = next((n for n in order if n.op == "clip_video" and n.inputs == [name]), None)
+        if fused is not None and consumers[name] == 1:
+            start, end = _clip_range(fused.params, info.get("duration"))
+            if start:
+                seek += ["-ss", f"{start:.3f}"]
+            if end is not None:
+                seek += ["-t", f"{end - start:.3f}"]
+            fused.params["_fused"] = True
+        input_args += [*seek, "-i", inputs[name]]
+
+    filters = []
+    counter = [0]
+
+    def new_pad():
+        counter[0] += 1
+        return _Pad(f"p{counter[0]}")
+
+    def require(node, name, kind):
+        pad = getattr(nodes[name], kind)
+        if pad is None:
+            raise PipelineError(f"步骤 {node.id} 需要 {name} 含有{'视频' if kind == 'video' else '音频'}流")
+        return pad
+
+    # 第一遍：确定每个节点的输出流
+    for node in order:
+        upstream = [nodes[name] for name in node.inputs]
+        first = upstream[0]
+        node.duration = first.duration
+        if node.op == "clip_video":
+            start, end = _clip_range(node.params, first.duration)
+            node.duration = (end - start) if end is not None else (
+                first.duration - start if first.duration else None)
+            if node.params.get("_fused"):
+                # 已在输入端完成剪切，直接沿用输入流
+                node.video, node.audio = first.video, first.audio
+            else:
+                node.video = new_pad() if first.video else None
+                node.audio = new_pad() if first.audio else None
+        elif node.op == "scale_video":
+            require(node, node.inputs[0], "video")
+            node.video, node.audio = new_pad(), first.audio
+        elif node.op == "overlay_video":
+            require(node, node.inputs[0], "video")
+            require(node, node.inputs[1], "video")
+            node.video, node.audio = new_pad(), first.audio
+        elif node.op == "concat_videos":
+            has_video = all(n.video for n in upstream)
+            has_audio = all(n.audio for n in upstream)
+            if not has_video and not has_audio:
+                raise PipelineError(f"步骤 {node.id} 的输入没有共同的音视频流")
+            node.video = new_pad() if has_video else None
+            node.audio = new_pad() if has_audio else None
+            durations = [n.duration for n in upstream]
+            node.duration = sum(durations) if all(durations) else None
+        elif node.op == "extract_audio_from_video":
+            node.video, node.audio = None, require(node, node.inputs[0], "audio")
+        elif node.op == "extract_frames_from_video":
+            require(node, node.inputs[0], "video")
+            node.video, node.audio = new_pad(), None
+        nodes[node.id] = node
+
+    # 从输出反向统计每路流被使用的次数：没有使用者的流不生成滤镜，否则 FFmpeg 会报滤镜输出未连接
+    for sid in outputs:
+        node = nodes[sid]
+        for pad in (node.video, node.audio):
+            if pad is not None:
+                pad.uses += 1
+    for node in reversed(order):
+        upstream = [nodes[name] for name in node.inputs]
+        if node.op == "clip_video" and not node.params.get("_fused"):
+            for kind in ("video", "audio"):
+                pad = getattr(node, kind)
+                if pad is not None and pad.uses:
+                    getattr(upstream[0], kind).uses += 1
+        elif node.op in ("scale_video", "extract_frames_from_video"):
+            if node.video.uses:
+                upstream[0].video.uses += 1
+        elif node.op == "overlay_video":
+            if node.video.uses:
+                upstream[0].video.uses += 1
+                upstream[1].video.uses += 1
+        elif node.op == "concat_videos":
+            # 只拼接被使用的流
+            if node.video is not None and not node.video.uses:
+                node.video = None
+            if node.audio is not None and not node.audio.uses:
+                node.audio = None
+            for n in upstream:
+                if node.video:
+                    n.video.uses += 1
+                if node.audio:
+                    n.audio.uses += 1
+
+    def produce(pad, chain, split="split"):
+        """写出一段滤镜链，输出没有使用者时跳过，被多次使用时追加 split/asplit"""
+        if not pad.uses:
+            return
+        filters.append(f"{chain}[{pad.label}]")
+        _split(filters, pad, split)
+
+    # 第二遍：生成滤镜图
+    for node in order:
+        upstream = [nodes[name] for name in node.inputs]
+        p = node.params
+        if node.op == "clip_video" and not p.get("_fused"):
+            start, end = _clip_range(p, upstream[0].duration)
+            bounds = f"start={start:.3f}" + (f":end={end:.3f}" if end is not None else "")
+            if node.video:
+                produce(node.video, f"{upstream[0].video.ref()}trim={bounds},setpts=PTS-STARTPTS")
+            if node.audio:
+                produce(node.audio, f"{upstream[0].audio.ref()}atrim={bounds},asetpts=PTS-STARTPTS", "asplit")
+        elif node.op == "scale_video":
+            width, height = _dimension(node, "width"), _dimension(node, "height")
+            produce(node.video, f"{upstream[0].video.ref()}scale={width}:{height}")
+        elif node.op == "overlay_video":
+            x, y = _overlay_xy(p)
+            produce(node.video, f"{upstream[0].video.ref()}{upstream[1].video.ref()}overlay=x={x}:y={y}")
+        elif node.op == "concat_videos":
+            refs = "".join(
+                (n.video.ref() if node.video else "") + (n.audio.ref() if node.audio else "") for n in upstream
+            )
+            v, a = int(bool(node.video)), int(bool(node.audio))
+            labels = [pad for pad in (node.video, node.audio) if pad]
+            if not labels:
+                continue
+            filters.append(f"{refs}concat=n={len(upstream)}:v={v}:a={a}" + "".join(f"[{pad.label}]" for pad in labels))
+            for pad in labels:
+                _split(filters, pad, "split" if pad is node.video else "asplit")
+        elif node.op == "extract_frames_from_video":
+            fps = _fps(node)
+            chain = f"fps={fps}" if fps else "null"
+            produce(node.video, f"{upstream[0].video.ref()}{chain}")
+
+    # 输出
+    token = uuid.uuid4().hex[:8]
+    output_args = []
+    planned = {}
+    directories = set()
+    durations = []
+    for sid, filename in outputs.items():
+        node = nodes[sid]
+        name = os.path.basename(str(filename or ""))
+        if not name or name.startswith("."):
+            raise PipelineError(f"无效的输出文件名: {filename!r}")
+        final_path = os.path.abspath(os.path.join(output_dir, name))
+        if node.op == "extract_frames_from_video":
+            image_format = str(node.params.get("format") or "jpg").lstrip(".").lower()
+            if image_format not in _IMAGE_FORMATS:
+                raise PipelineError(f"步骤 {sid} 不支持的图片格式: {image_format}，可用: {', '.join(_IMAGE_FORMATS)}")
+            tmp_path = os.path.abspath(os.path.join(output_dir, f".pipeline-{token}-{name}"))
+            output_args += ["-map", node.video.map_arg(), "-f", "image2",
+                            os.path.join(tmp_path, f"frame_%04d.{image_format}")]
+            directories.add(sid)
+        else:
+            ext = os.path.splitext(name)[1].lower()
+            if not ext:
+                ext = "." + str(node.params.get("audio_format") or ("mp3" if node.video is None else "mp4")).lstrip(".").lower()
+                if ext not in (_AUDIO_CODECS if node.video is None else _VIDEO_CODECS):
+                    raise PipelineError(f"步骤 {sid} 不支持的输出格式: {ext}")
+                final_path += ext
+                name += ext
+            tmp_path = os.path.abspath(os.path.join(output_dir, f".pipeline-{token}-{name}"))
+            maps = []
+            if node.video is not None:
+                maps += ["-map", node.video.map_arg()]
+            if node.audio is not None:
+                maps += ["-map", node.audio.map_arg()]
+            codecs = _AUDIO_CODECS.get(ext, []) if node.video is None else _VIDEO_CODECS.get(ext, [])
+            output_args += [*maps, *codecs, tmp_path]
+        if final_path in [final for _, final in planned.values()]:
+            raise PipelineError(f"多个输出使用了同一个文件名: {name}")
+        planned[sid] = (tmp_path, final_path)
+        if node.duration:
+            durations.append(node.duration)
+
+    command = [ffmpeg, "-hide_banner", "-nostdin", "-y", "-loglevel", "error",
+               "-progress", "pipe:1", "-nostats", *input_args]
+    if filters:
+        command += ["-filter_complex", ";".join(filters)]
+    command += output_args
+    return PipelinePlan(command=command, outputs=planned, duration=max(durations) if durations else None,
+                        directories=directories)
+
+
+def _split(filters, pad, kind):
+    if pad.uses > 1:
+        labels = [f"{pad.label}s{i}" for i in range(pad.uses)]
+        filters.append(f"[{pad.label}]{kind}={pad.uses}" + "".join(f"[{label}]" for label in labels))
+        pad._labels = labels
+
+
+def _time_param(params, name):
+    value = params.get(name)
+    if value is None or value == "":
+        return None
+    seconds = parse_time(value)
+    if seconds is None or not math.isfinite(seconds):
+        raise PipelineError(f"无效的时间参数 {name}: {value!r}")
+    return seconds
+
+
+def _clip_range(params, duration=None):
+    """剪切参数 -> (起点, 终点)，终点未知时为 None"""
+    start = _time_param(params, "start") or 0.0
+    length = _time_param(params, "duration")
+    end = _time_param(params, "end")
+    if length:
+        end = start + length
+    if end is not None and end <= start:
+        raise PipelineError(f"剪切区间无效: start={params.get('start')} end={params.get('end')}")
+    if duration and end is not None:
+        end = min(end, duration)
+    return start, end
+
+
+def _overlay_xy(params):
+    position = params.get("position") or "top-left"
+    if str(position).isdigit() and 1 <= int(position) <= 9:
+        position = _OVERLAY_GRID[int(position) - 1]
+    if position not in _OVERLAY_POSITIONS:
+        raise PipelineError(f"无效的叠加位置: {position}")
+    x, y = _OVERLAY_POSITIONS[position]
+    dx, dy = _int_param(params, "dx"), _int_param(params, "dy")
+    return (f"{x}+{dx}" if dx else x), (f"{y}+{dy}" if dy else y)
+
+
+def _int_param(params, name):
+    """整数参数，参数值会拼进滤镜表达式，只接受整数"""
+    value = params.get(name)
+    if value is None or value == "":
+        return 0
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise PipelineError(f"参数 {name} 必须是整数: {value!r}") from None
+
+
+def _dimension(node, name):
+    """缩放尺寸：正整数，或 -1/-2 表示按比例计算"""
+    value = node.params.get(name)
+    if value is None or value == "":
+        return -2
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        number = 0
+    if number > 0 or number in (-1, -2):
+        return number
+    raise PipelineError(f"步骤 {node.id} 的 {name} 无效: {value!r}")
+
+
+def _fps(node):
+    """提取帧的帧率：正数，未指定时为 None"""
+    value = node.params.get("fps")
+    if value is None or value == "":
+        return None
+    try:
+        fps = float(str(value).strip())
+    except ValueError:
+        fps = 0.0
+    if not math.isfinite(fps) or fps <= 0:
+        raise PipelineError(f"步骤 {node.id} 的 fps 必须是正数: {value!r}")
+    return fps
+
+
+async def run_pipeline(plan, on_progress=None):
+    """
+    执行编译后的流水线，输出先写入临时文件，全部成功后再替换到最终位置
+
+    Args:
+        plan: compile_pipeline 的结果
+        on_progress: 进度回调 on_progress(event)
+
+    Returns:
+        list: 输出文件的最终路径
+    """
+    for sid in plan.directories:
+        os.makedirs(plan.outputs[sid][0], exist_ok=True)
+
+    logger.info(f"执行流水线: {' '.join(plan.command)}")
+    parser = ProgressParser(plan.duration)
+    process = await asyncio.create_subprocess_exec(
+        *plan.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        while True:
+            data = await process.stdout.read(4096)
+            if not data:
+                break
+            for update in parser.feed(data.decode("utf-8", errors="replace")):
+                if on_progress:
+                    on_progress({"type": "ffmpeg_progress", "tool": "pipeline", **update})
+        stderr = await stderr_task
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        _remove_outputs(plan)
+        raise
+
+    if process.returncode != 0:
+        _remove_outputs(plan)
+        message = stderr.decode("utf-8", errors="replace").strip()[-500:]
+        raise RuntimeError(f"FFmpeg 执行失败: {message or process.returncode}")
+
+    results = []
+    for tmp_path, final_path in plan.outputs.values():
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(final_path, ignore_errors=True)
+        os.replace(tmp_path, final_path)
+        results.append(final_path)
+    return results
+
+
+def _remove_outputs(plan):
+    for tmp_path, _ in plan.outputs.values():
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
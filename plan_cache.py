@@ -0,0 +1,313 @@
+# plan_cache.py - 相同请求的工具调用计划缓存
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import string
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from tool_cache import CACHEABLE_TOOLS
+
+logger = logging.getLogger(__name__)
+
+# 结果依赖外部状态或有副作用，不能按计划重放的工具
+UNCACHEABLE_TOOLS = {"find_video_path", "play_video"}
+
+_MEDIA_EXTENSIONS = (
+    "mp4|avi|mov|mkv|wmv|flv|webm|m4v|ts|mp3|wav|aac|flac|ogg|m4a|opus|jpg|jpeg|png|gif|webp|bmp"
+)
+# 前端附加的选中文件信息
+_SELECTED_RE = re.compile(r"^[ \t]*文件路径[:：][ \t]*(.+?)[ \t]*[(（]文件名[:：][ \t]*(.+?)[)）][ \t]*$", re.M)
+# 消息中直接提到的文件名或路径
+_FILE_RE = re.compile(rf"[^\s,，、:：;；\"'“”‘’()（）<>]+\.(?:{_MEDIA_EXTENSIONS})(?![\w.])", re.I)
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+@dataclass
+class PlanRequest:
+    """规范化后的请求"""
+    key: str
+    template: str
+    # 消息中提到的文件（绝对路径），按出现顺序对应 ${file0}、${file1}...
+    files: list
+
+
+def _placeholders(files):
+    """文件的占位符映射，用于把计划中的路径替换为本次请求的文件"""
+    mapping = {}
+    for i, path in enumerate(files):
+        name = os.path.basename(path)
+        mapping[f"file{i}"] = path
+        mapping[f"file{i}_name"] = name
+        mapping[f"file{i}_stem"] = os.path.splitext(name)[0]
+    return mapping
+
+
+def _abstract(value, files):
+    """把参数中的文件路径和文件名替换为占位符；以输入文件名开头的输出文件名替换其主干"""
+    if isinstance(value, list):
+        return [_abstract(v, files) for v in value]
+    if isinstance(value, dict):
+        return {k: _abstract(v, files) for k, v in value.items()}
+    if not isinstance(value, str) or not files:
+        return value.replace("$", "$$") if isinstance(value, str) else value
+    mapping = _placeholders(files)
+    replacements = {}
+    for name, text in mapping.items():
+        if not name.endswith("_stem"):
+            replacements.setdefault(text, name)
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(replacements, key=len, reverse=True)))
+    parts = []
+    last = 0
+    for match in pattern.finditer(value):
+        parts.append(value[last:match.start()].replace("$", "$$"))
+        parts.append(f"${{{replacements[match.group(0)]}}}")
+        last = match.end()
+    if parts:
+        parts.append(value[last:].replace("$", "$$"))
+        return "".join(parts)
+
+    # 输出文件名常以输入文件名为前缀，如 outputs/<stem>_clip.mp4
+    head, tail = os.path.split(value)
+    if head:
+        stems = sorted(((mapping[f"file{i}_stem"], i) for i in range(len(files))), key=lambda s: -len(s[0]))
+        for stem, i in stems:
+            if stem and tail.startswith(stem):
+                rest = tail[len(stem):].replace("$", "$$")
+                return os.path.join(head.replace("$", "$$"), f"${{file{i}_stem}}{rest}")
+    return value.replace("$", "$$")
+
+
+def _concretize(value, mapping):
+    """把计划参数中的占位符替换为本次请求的文件"""
+    if isinstance(value, list):
+        return [_concretize(v, mapping) for v in value]
+    if isinstance(value, dict):
+        return {k: _concretize(v, mapping) for k, v in value.items()}
+    if isinstance(value, str):
+        return string.Template(value).safe_substitute(mapping)
+    return value
+
+
+def _numbers(value):
+    """参数中出现的数字"""
+    if isinstance(value, list):
+        return {n for v in value for n in _numbers(v)}
+    if isinstance(value, dict):
+        return {n for v in value.values() for n in _numbers(v)}
+    if isinstance(value, bool):
+        return set()
+    if isinstance(value, (int, float)):
+        return {f"{value:g}"}
+    if isinstance(value, str) and "/" not in value and "\\" not in value:
+        value = re.sub(r"\$\{file\d+(?:_name|_stem)?\}", "", value)
+        return {f"{float(n):g}" for n in _NUMBER_RE.findall(value)}
+    return set()
+
+
+class PlanCache:
+    """相同请求的工具调用计划缓存
+
+    用户消息中的文件路径替换为占位符后规范化（合并空白、忽略大小写）作为缓存键，
+    LLM 成功执行的工具调用序列同样把路径替换为占位符后保存。再次收到相同的请求时
+    直接把计划中的占位符换成新的文件并依次调用工具，不再请求 LLM。
+    条目超过 TTL 后失效，按最近使用时间淘汰。
+    """
+
+    def __init__(self, db_path, roots=("uploads", "outputs"), ttl=24 * 3600, max_entries=1000):
+        """
+        初始化计划缓存
+
+        Args:
+            db_path: 缓存数据库路径
+            roots: 查找消息中文件名所在的目录
+            ttl: 条目有效期（秒）
+            max_entries: 条目数上限
+        """
+        self.db_path = db_path
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS plans (
+                    key TEXT PRIMARY KEY,
+                    template TEXT NOT NULL,
+                    plan TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS plans_lru ON plans (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def stats(self):
+        """缓存命中统计"""
+        with self._connect() as db:
+            entries = db.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "invalidations": self.invalidations,
+            "entries": entries,
+        }
+
+    def _resolve(self, path):
+        if os.path.isabs(path):
+            return os.path.abspath(path) if os.path.isfile(path) else None
+        for root in self.roots:
+            candidate = os.path.join(root, os.path.basename(path))
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def prepare(self, message, model=""):
+        """
+        规范化请求并计算缓存键
+
+        Args:
+            message: 用户消息（可能带有前端附加的选中文件信息）
+            model: 模型名称，不同模型的计划分开缓存
+
+        Returns:
+            PlanRequest: 规范化结果；消息中有无法定位的文件时返回 None（不使用缓存）
+        """
+        files = []
+        by_name = {}
+
+        def placeholder(path):
+            resolved = self._resolve(path.strip())
+            if resolved is None:
+                raise LookupError(path)
+            if resolved not in files:
+                files.append(resolved)
+                by_name.setdefault(os.path.basename(resolved), resolved)
+            return f"<file{files.index(resolved)}>"
+
+        def mention(match):
+            name = os.path.basename(match.group(0))
+            if not os.path.isabs(match.group(0)) and name in by_name:
+                return f"<file{files.index(by_name[name])}>"
+            return placeholder(match.group(0))
+
+        try:
+            text = _SELECTED_RE.sub(lambda m: f"文件路径: {placeholder(m.group(1))}", message)
+            text = _FILE_RE.sub(mention, text)
+        except LookupError as e:
+            logger.debug(f"消息中的文件无法定位，不使用计划缓存: {e}")
+            return None
+        template = " ".join(text.split()).casefold()
+        payload = json.dumps([model, template], ensure_ascii=False)
+        return PlanRequest(hashlib.sha256(payload.encode("utf-8")).hexdigest(), template, files)
+
+    def get(self, request):
+        """
+        查找请求对应的计划
+
+        Returns:
+            list: [{"tool", "arguments"}]，路径已替换为本次请求的文件；未命中时返回 None
+        """
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute("SELECT plan, created_at FROM plans WHERE key = ?", (request.key,)).fetchone()
+            if row is not None and now - row["created_at"] > self.ttl:
+                db.execute("DELETE FROM plans WHERE key = ?", (request.key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            db.execute("UPDATE plans SET hits = hits + 1, last_used = ? WHERE key = ?", (now, request.key))
+        self.hits += 1
+        mapping = _placeholders(request.files)
+        return [
+            {"tool": step["tool"], "arguments": _concretize(step["arguments"], mapping)}
+            for step in json.loads(row["plan"])
+        ]
+
+    def store(self, request, calls):
+        """
+        保存一次成功执行的工具调用序列
+
+        Args:
+            request: prepare 返回的规范化请求
+            calls: [{"tool", "arguments", "success"}]
+
+        Returns:
+            bool: 是否保存（计划不可重放时不保存）
+        """
+        plan = self._abstract_plan(request, calls)
+        if plan is None:
+            return False
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, 0, ?, ?)",
+                (request.key, request.template, json.dumps(plan, ensure_ascii=False), now, now)
+            )
+            count = db.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+            if count > self.max_entries:
+                db.execute(
+                    "DELETE FROM plans WHERE key IN (SELECT key FROM plans ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+        self.stores += 1
+        logger.info(f"保存工具调用计划: {request.key[:12]} ({len(plan)} 步)")
+        return True
+
+    def _abstract_plan(self, request, calls):
+        if not calls or not all(call["success"] for call in calls):
+            return None
+        text = re.sub(r"<file\d+>", "", request.template)
+        # 0、1 常作为起点或保持比例（-1）出现，不视为推算出的参数
+        message_numbers = {"0", "1"} | {f"{float(n):g}" for n in _NUMBER_RE.findall(text)}
+        probed = False
+        plan = []
+        for call in calls:
+            tool, arguments = call["tool"], call["arguments"]
+            if tool in UNCACHEABLE_TOOLS or not isinstance(arguments, dict):
+                return None
+            abstract = _abstract(arguments, request.files)
+            spec = CACHEABLE_TOOLS.get(tool)
+            for name in spec["inputs"] if spec else []:
+                values = abstract.get(name)
+                values = values if isinstance(values, list) else [values]
+                if not all(isinstance(v, str) and re.fullmatch(r"\$\{file\d+\}", v) for v in values):
+                    # 输入既不是消息中提到的文件，也不是前面步骤的输出，换一组文件后无法复用
+                    if not any(isinstance(v, str) and any(v == s.get("output") for s in plan) for v in values):
+                        return None
+            if probed and not _numbers(abstract) <= message_numbers:
+                # 参数由 get_video_info 的结果推算而来，换一个文件后不再成立
+                return None
+            probed = probed or tool == "get_video_info"
+            output = abstract.get(spec["output"]) if spec and spec["output"] else None
+            plan.append({"tool": tool, "arguments": abstract, "output": output})
+        return [{"tool": step["tool"], "arguments": step["arguments"]} for step in plan]
+
+    def invalidate(self, key):
+        """删除重放失败的计划"""
+        with self._connect() as db:
+            db.execute("DELETE FROM plans WHERE key = ?", (key,))
+        self.invalidations += 1
+        logger.info(f"计划重放失败，已删除: {key[:12]}")
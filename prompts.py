@@ -0,0 +1,183 @@
+# prompts.py - 系统提示词、工具定义的精简和 token 用量统计
+import copy
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROMPT_VARIANTS = ("full", "compact")
+
+
+def build_system_prompt(uploads_dir, outputs_dir, variant="full"):
+    """
+    生成系统提示词
+
+    提示词只依赖部署相关的目录，同一进程内每次请求都完全相同（不含时间、请求 ID 等变化内容），
+    作为请求的固定前缀，可以命中服务端的前缀缓存。
+
+    Args:
+        uploads_dir: 上传目录的绝对路径
+        outputs_dir: 输出目录的绝对路径
+        variant: full 为完整版本，compact 为精简版本
+
+    Returns:
+        str: 系统提示词
+    """
+    if variant == "compact":
+        return (
+            "你是视频处理助手，使用 FFmpeg 工具完成用户的视频编辑请求。\n"
+            "规则：\n"
+            "- 工具名必须与工具定义完全一致（如 extract_frames_from_video，不要简写）\n"
+            "- 处理视频前先调用 get_video_info\n"
+            "- 消息中有'当前选中的文件:'时使用其中的路径\n"
+            "- 一律使用绝对路径\n"
+            f"- 上传目录: {uploads_dir}\n"
+            f"- 输出目录: {outputs_dir}，输出文件保存到这里\n"
+            "回复：简要说明调用的工具、参数、执行结果和生成的文件路径。\n"
+        )
+    if variant != "full":
+        raise ValueError(f"未知的提示词版本: {variant}，可用: {', '.join(PROMPT_VARIANTS)}")
+    return (
+        "你是一个专业的视频处理助手，可以使用FFmpeg工具来帮助用户进行视频编辑、"
+        "剪切、合并、格式转换等操作。\n\n"
+        "可用的工具及其完整名称（请务必使用完整的工具名称）：\n"
+        "1. find_video_path - 查找视频文件路径\n"
+        "2. get_video_info - 获取视频信息\n"
+        "3. clip_video - 剪切视频片段\n"
+        "4. concat_videos - 合并多个视频\n"
+        "5. play_video - 播放视频\n"
+        "6. overlay_video - 视频叠加效果\n"
+        "7. scale_video - 视频缩放\n"
+        "8. extract_frames_from_video - 提取视频帧为图片（注意：必须使用完整名称）\n"
+        "9. extract_audio_from_video - 提取视频中的音频（注意：必须使用完整名称）\n\n"
+        "重要：调用工具时必须使用上述完整的工具名称，不要使用简化名称！\n\n"
+        "请根据用户的需求选择合适的工具并执行相应操作,在你对视频进行操作之前请获取视频信息再进行。\n"
+        f"上传文件的绝对路径在: {uploads_dir}\n"
+        f"输出文件的绝对路径在: {outputs_dir}\n"
+        "重要提示：\n"
+        "- 当用户消息中包含'当前选中的文件:'信息时，请优先使用这些具体的文件路径\n"
+        "- 如果用户提到'input.mp4'等通用文件名，请替换为实际选中的文件路径\n"
+        "- 始终使用完整的绝对路径来访问文件\n"
+        "- 输出文件应保存到outputs目录中\n"
+        "- 调用工具时必须使用完整的工具名称，例如使用'extract_frames_from_video'而不是'extract_frames'\n"
+        "响应格式要求：\n"
+        "- 请详细说明你调用了哪些工具\n"
+        "- 说明每个工具的具体参数\n"
+        "- 报告执行结果和生成的文件路径\n"
+        "- 如果有FFmpeg命令执行，请说明具体的命令内容\n"
+    )
+
+
+def _first_sentence(text):
+    text = " ".join((text or "").split())
+    for mark in ("。", ". ", "\n"):
+        pos = text.find(mark)
+        if pos > 0:
+            return text[:pos + len(mark)].strip()
+    return text
+
+
+def _compact_schema(schema):
+    """去掉参数说明中的示例、标题等冗余字段，描述只保留第一句"""
+    if isinstance(schema, list):
+        return [_compact_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    compact = {}
+    for key, value in schema.items():
+        if key in ("title", "examples", "example", "$schema"):
+            continue
+        if key == "description":
+            value = _first_sentence(value)
+        elif key == "properties" and isinstance(value, dict):
+            value = {name: _compact_schema(prop) for name, prop in value.items()}
+        else:
+            value = _compact_schema(value)
+        compact[key] = value
+    return compact
+
+
+class ToolSchemas:
+    """发送给 LLM 的工具定义
+
+    桥接会话从 MCP 服务器取得的工具定义顺序和内容在不同会话之间可能不完全一致，
+    这里按名称排序并固定下来，保证请求前缀逐字节相同；compact 版本同时精简描述。
+    """
+
+    def __init__(self, variant="full"):
+        self.variant = variant
+        self._lock = threading.Lock()
+        # (原始定义的规范化 JSON, 发送的定义)
+        self._cached = (None, None)
+
+    def get(self, tools):
+        """
+        返回规范化后的工具定义，原始定义不变时返回同一个对象
+
+        Args:
+            tools: 桥接会话中的 OpenAI 格式工具定义
+
+        Returns:
+            list: 发送给 LLM 的工具定义
+        """
+        if not tools:
+            return tools
+        source = json.dumps(tools, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            if self._cached[0] == source:
+                return self._cached[1]
+        result = sorted(copy.deepcopy(tools), key=lambda tool: tool.get("function", {}).get("name", ""))
+        if self.variant == "compact":
+            result = [_compact_schema(tool) for tool in result]
+        with self._lock:
+            self._cached = (source, result)
+        return result
+
+
+class UsageStats:
+    """LLM token 用量的累计统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.completions = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, usage):
+        """累计一个请求的用量：completions、prompt_tokens、completion_tokens、cached_tokens"""
+        with self._lock:
+            self.requests += 1
+            self.completions += usage["completions"]
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+            self.cached_tokens += usage["cached_tokens"]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "completions": self.completions,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cached_ratio": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            }
+
+
+def usage_of(usage):
+    """
+    从补全结果的 usage 中取出 token 数
+
+    Returns:
+        dict: prompt_tokens、completion_tokens、cached_tokens（命中前缀缓存的输入 token）
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "cached_tokens": cached or 0,
+    }
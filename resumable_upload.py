@@ -0,0 +1,433 @@
+# resumable_upload.py - 可断点续传的分块并行上传
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+from upload_storage import StoredUpload
+
+logger = logging.getLogger(__name__)
+
+# 默认分块大小和允许的范围
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+# 未完成的上传会话保留时间（秒）
+SESSION_TTL = 24 * 3600
+
+# 从 .part 文件读取数据计算整体哈希时的块大小
+_HASH_READ_SIZE = 1024 * 1024
+
+
+class ResumableUploadError(Exception):
+    """断点续传上传错误，携带对应的 HTTP 状态码"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _preallocate(path, size):
+    with open(path, "wb") as f:
+        if size <= 0:
+            return
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _hash_range(path, hasher, start, end):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset < end:
+            data = os.pread(fd, min(_HASH_READ_SIZE, end - offset), offset)
+            if not data:
+                raise ResumableUploadError("上传数据不完整", status_code=409)
+            hasher.update(data)
+            offset += len(data)
+    finally:
+        os.close(fd)
+
+
+class ResumableUploadManager:
+    """断点续传上传会话管理
+
+    每个会话对应一个预分配大小的 .part 文件，各分块通过 os.pwrite 直接写到最终偏移处，
+    分块可以乱序、并行、重复上传；会话和已接收分块记录在 SQLite 中，服务重启后仍可续传。
+    整体哈希按已连续到达的前缀增量计算，完成时只需补算剩余部分，不需要拼接文件。
+    增量哈希保存在计算它的进程中，并记下计入的每个分块的写入标记；多 worker 部署时分块可能
+    在其他进程中被重写，标记随之改变，使用前发现不一致就从头计算。
+    """
+
+    def __init__(self, base_dir):
+        """
+        初始化上传会话管理器
+
+        Args:
+            base_dir: 存放 .part 文件和会话数据库的目录
+        """
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+        self.db_path = os.path.join(base_dir, "sessions.sqlite3")
+        # upload_id -> (hasher, 已计入哈希的各分块的写入标记)
+        self._hashers = {}
+        self._locks = {}
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    upload_id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    total_size INTEGER NOT NULL,
+                    chunk_size INTEGER NOT NULL,
+                    sha256 TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finalizing INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS chunks (
+                    upload_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    -- 每次写入生成新的标记，用于判断增量哈希是否仍然有效
+                    token TEXT NOT NULL,
+                    PRIMARY KEY (upload_id, idx)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.base_dir, f"{upload_id}.part")
+
+    def _lock(self, upload_id):
+        return self._locks.setdefault(upload_id, asyncio.Lock())
+
+    def _get_session(self, upload_id):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT * FROM sessions WHERE upload_id = ?", (upload_id,)
+            ).fetchone()
+        if row is None:
+            raise ResumableUploadError("上传会话不存在或已过期", status_code=404)
+        return dict(row)
+
+    @staticmethod
+    def _chunk_count(session):
+        return math.ceil(session["total_size"] / session["chunk_size"])
+
+    async def create(self, filename, total_size, chunk_size=None, sha256=None):
+        """
+        创建上传会话并预分配文件
+
+        Args:
+            filename: 最终文件名
+            total_size: 文件总字节数
+            chunk_size: 分块大小，为空时使用默认值
+            sha256: 整个文件的期望哈希（可选），完成时校验
+
+        Returns:
+            dict: 会话状态
+        """
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise ResumableUploadError(
+                f"分块大小必须在 {MIN_CHUNK_SIZE} 到 {MAX_CHUNK_SIZE} 字节之间"
+            )
+        if total_size < 0:
+            raise ResumableUploadError("文件大小无效")
+
+        await self.cleanup_expired()
+
+        upload_id = uuid.uuid4().hex
+        await asyncio.to_thread(_preallocate, self._part_path(upload_id), total_size)
+        await asyncio.to_thread(
+            self._insert_session, upload_id, filename, total_size, chunk_size,
+            sha256.lower() if sha256 else None
+        )
+        logger.info(f"创建上传会话 {upload_id}: {filename} ({total_size} 字节)")
+        return await asyncio.to_thread(self.status, upload_id)
+
+    def _insert_session(self, upload_id, filename, total_size, chunk_size, sha256):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                """
+                INSERT INTO sessions (upload_id, filename, total_size, chunk_size, sha256, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (upload_id, filename, total_size, chunk_size, sha256, now, now)
+            )
+
+    async def write_chunk(self, upload_id, index, stream, checksum=None, offset=None):
+        """
+        将一个分块的数据流写入预分配文件的对应位置
+
+        Args:
+            upload_id: 会话 ID
+            index: 分块序号（从 0 开始）
+            stream: 分块数据的异步字节流
+            checksum: 分块的 SHA-256（可选）
+            offset: 客户端声明的字节偏移（可选），必须与序号一致
+
+        Returns:
+            dict: 会话状态
+        """
+        session = await asyncio.to_thread(self._get_session, upload_id)
+        if session["finalizing"]:
+            raise ResumableUploadError("上传正在完成，不能再写入分块", status_code=409)
+        chunk_size = session["chunk_size"]
+        if not 0 <= index < self._chunk_count(session):
+            raise ResumableUploadError(f"分块序号超出范围: {index}")
+        start = index * chunk_size
+        if offset is not None and offset != start:
+            raise ResumableUploadError(
+                f"分块偏移不匹配: 期望 {start}, 实际 {offset}", status_code=409
+            )
+        expected = min(chunk_size, session["total_size"] - start)
+
+        hasher = hashlib.sha256()
+        received = 0
+        fd = os.open(self._part_path(upload_id), os.O_WRONLY)
+        try:
+            async for data in stream:
+                if not data:
+                    continue
+                if received + len(data) > expected:
+                    raise ResumableUploadError(f"分块 {index} 数据超出预期长度 {expected}")
+                await asyncio.to_thread(_pwrite_all, fd, data, start + received)
+                hasher.update(data)
+                received += len(data)
+            if received != expected:
+                raise ResumableUploadError(
+                    f"分块 {index} 长度不正确: 期望 {expected}, 实际 {received}"
+                )
+            digest = hasher.hexdigest()
+            if checksum and checksum.lower() != digest:
+                raise ResumableUploadError(f"分块 {index} 校验失败", status_code=422)
+        except BaseException:
+            # 该分块位置的数据可能已被部分覆盖，需要客户端重新上传
+            if received:
+                await asyncio.to_thread(self._delete_chunk, upload_id, index)
+            raise
+        finally:
+            os.close(fd)
+
+        await asyncio.to_thread(self._record_chunk, upload_id, index, received, digest)
+        await self._advance_hash(upload_id, session)
+        return await asyncio.to_thread(self.status, upload_id)
+
+    def _record_chunk(self, upload_id, index, size, digest):
+        """登记已写入的分块，数据写完之后才更新写入标记"""
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                (upload_id, index, size, digest, uuid.uuid4().hex)
+            )
+            db.execute(
+                "UPDATE sessions SET updated_at = ? WHERE upload_id = ?",
+                (time.time(), upload_id)
+            )
+
+    async def _advance_hash(self, upload_id, session):
+        """把已连续到达的分块计入整体哈希"""
+        async with self._lock(upload_id):
+            tokens = await asyncio.to_thread(self._chunk_tokens, upload_id)
+            hasher, hashed = self._resume_hash(upload_id, tokens)
+            end_index = len(hashed)
+            while end_index in tokens:
+                end_index += 1
+            if end_index > len(hashed):
+                chunk_size = session["chunk_size"]
+                await asyncio.to_thread(
+                    _hash_range, self._part_path(upload_id), hasher,
+                    len(hashed) * chunk_size,
+                    min(end_index * chunk_size, session["total_size"])
+                )
+            self._hashers[upload_id] = (hasher, tuple(tokens[i] for i in range(end_index)))
+
+    def _resume_hash(self, upload_id, tokens):
+        """
+        取出本进程中的增量哈希，需在会话锁内调用
+
+        分块的写入标记在数据写完后才更新，写入失败时登记被删除。计入哈希的分块在读取标记之后
+        被任何 worker 改写过，标记就对不上，此时哈希可能混入了旧数据，从头计算。
+
+        Args:
+            upload_id: 会话 ID
+            tokens: 当前登记的分块序号 -> 写入标记
+
+        Returns:
+            tuple: (hasher, 已计入哈希的各分块的写入标记)
+        """
+        hasher, hashed = self._hashers.pop(upload_id, (None, ()))
+        if hasher is None or any(tokens.get(i) != token for i, token in enumerate(hashed)):
+            return hashlib.sha256(), ()
+        return hasher, hashed
+
+    def _delete_chunk(self, upload_id, index):
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM chunks WHERE upload_id = ? AND idx = ?", (upload_id, index)
+            )
+
+    def _chunk_tokens(self, upload_id):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT idx, token FROM chunks WHERE upload_id = ?", (upload_id,)
+            ).fetchall()
+        return {row["idx"]: row["token"] for row in rows}
+
+    def status(self, upload_id):
+        """查询上传进度"""
+        session = self._get_session(upload_id)
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT idx, size FROM chunks WHERE upload_id = ? ORDER BY idx",
+                (upload_id,)
+            ).fetchall()
+        total_chunks = self._chunk_count(session)
+        received_bytes = sum(row["size"] for row in rows)
+        return {
+            "upload_id": upload_id,
+            "filename": session["filename"],
+            "total_size": session["total_size"],
+            "chunk_size": session["chunk_size"],
+            "total_chunks": total_chunks,
+            "received_chunks": [row["idx"] for row in rows],
+            "received_bytes": received_bytes,
+            "complete": len(rows) == total_chunks,
+        }
+
+    async def finalize(self, upload_id, commit):
+        """
+        校验所有分块并提交完整文件
+
+        Args:
+            upload_id: 会话 ID
+            commit: 提交函数 commit(path, sha256) -> 最终路径，在线程池中执行，
+                    负责把 .part 文件移动到最终位置
+
+        Returns:
+            StoredUpload: 保存结果
+        """
+        session = await asyncio.to_thread(self._get_session, upload_id)
+        state = await asyncio.to_thread(self.status, upload_id)
+        if not state["complete"]:
+            missing = state["total_chunks"] - len(state["received_chunks"])
+            raise ResumableUploadError(f"还有 {missing} 个分块未上传", status_code=409)
+        # 同一会话只允许一个完成请求（包括其他 worker 上的），后到的请求不会去读已被移走的 .part 文件
+        if not await asyncio.to_thread(self._claim, upload_id):
+            raise ResumableUploadError("上传已完成或正在完成", status_code=409)
+
+        try:
+            async with self._lock(upload_id):
+                tokens = await asyncio.to_thread(self._chunk_tokens, upload_id)
+                if len(tokens) != state["total_chunks"]:
+                    raise ResumableUploadError("有分块正在重新上传", status_code=409)
+                hasher, hashed = self._resume_hash(upload_id, tokens)
+                part_path = self._part_path(upload_id)
+                await asyncio.to_thread(
+                    _hash_range, part_path, hasher,
+                    len(hashed) * session["chunk_size"], session["total_size"]
+                )
+                # 完成请求之前开始的写入可能在计算期间结束，此时哈希混入了新旧数据
+                if await asyncio.to_thread(self._chunk_tokens, upload_id) != tokens:
+                    raise ResumableUploadError("完成过程中有分块被重新上传，请重试", status_code=409)
+                digest = hasher.hexdigest()
+                if session["sha256"] and session["sha256"] != digest:
+                    raise ResumableUploadError("文件整体校验失败", status_code=422)
+                dest_path = await asyncio.to_thread(commit, part_path, digest)
+        except BaseException:
+            # 未提交时放弃占用，客户端可以重传分块后再次完成
+            await asyncio.to_thread(self._release_claim, upload_id)
+            raise
+
+        await asyncio.to_thread(self._forget, upload_id)
+        await self._drop_state(upload_id)
+        logger.info(f"上传会话 {upload_id} 已完成: {dest_path}")
+        return StoredUpload(path=dest_path, size=session["total_size"], sha256=digest)
+
+    def _claim(self, upload_id):
+        """标记会话正在完成，已被其他请求标记时返回 False"""
+        with self._connect() as db:
+            return db.execute(
+                "UPDATE sessions SET finalizing = 1 WHERE upload_id = ? AND finalizing = 0", (upload_id,)
+            ).rowcount > 0
+
+    def _release_claim(self, upload_id):
+        with self._connect() as db:
+            db.execute("UPDATE sessions SET finalizing = 0 WHERE upload_id = ?", (upload_id,))
+
+    async def abort(self, upload_id):
+        """取消上传并删除已接收的数据"""
+        session = await asyncio.to_thread(self._get_session, upload_id)
+        if session["finalizing"]:
+            raise ResumableUploadError("上传正在完成，不能取消", status_code=409)
+        await asyncio.to_thread(self._discard, upload_id)
+        await self._drop_state(upload_id)
+
+    async def cleanup_expired(self):
+        """清理超过保留时间未更新的会话"""
+        expired = await asyncio.to_thread(self._cleanup_expired, time.time() - SESSION_TTL)
+        for upload_id in expired:
+            await self._drop_state(upload_id)
+
+    def _cleanup_expired(self, deadline):
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT upload_id FROM sessions WHERE updated_at < ?", (deadline,)
+            ).fetchall()
+        for row in rows:
+            logger.info(f"清理过期上传会话: {row['upload_id']}")
+            self._discard(row["upload_id"])
+        return [row["upload_id"] for row in rows]
+
+    def _discard(self, upload_id):
+        """删除 .part 文件和会话记录"""
+        try:
+            os.remove(self._part_path(upload_id))
+        except FileNotFoundError:
+            pass
+        self._forget(upload_id)
+
+    async def _drop_state(self, upload_id):
+        """丢弃会话在内存中的哈希和锁，在事件循环中与 _advance_hash 互斥执行"""
+        async with self._lock(upload_id):
+            self._hashers.pop(upload_id, None)
+        self._locks.pop(upload_id, None)
+
+    def _forget(self, upload_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM chunks WHERE upload_id = ?", (upload_id,))
+            db.execute("DELETE FROM sessions WHERE upload_id = ?", (upload_id,))
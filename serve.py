@@ -0,0 +1,54 @@
+# serve.py - 生产环境启动：多个 uvicorn worker 进程共享任务状态和指标
+#
+#   uv run python serve.py --workers 4
+#
+# 任务状态和进度事件保存在 storage/jobs.sqlite3，任何一个 worker 都能查询、订阅和取消任务；
+# 媒体索引、工具缓存、blob 存储和断点续传原本就保存在 storage/ 下的 SQLite 中，由所有 worker 共享。
+# 开发时仍然使用 python app.py（单进程、自动重载）。
+import argparse
+import logging
+import os
+import shutil
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def _prepare_metrics_dir(path):
+    """清空上次运行留下的指标文件，并让 worker 进程把指标写到这个目录"""
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以多个 worker 进程启动 FFmpeg MCP 视频处理服务")
+    parser.add_argument("--host", default=os.getenv("WEB_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("WEB_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "0")) or None,
+                        help="worker 进程数，默认等于 CPU 核数")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("JOB_DRAIN_TIMEOUT", "30")),
+                        help="收到退出信号后等待正在处理的请求和任务完成的秒数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not os.getenv("JOB_WORKERS"):
+        # 任务并发是每个 worker 各自的限制，默认把 CPU 核数平分给各个 worker
+        os.environ["JOB_WORKERS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    if os.getenv("JOB_STORE_ENABLED", "1") == "0" and workers > 1:
+        logger.warning("JOB_STORE_ENABLED=0 时任务只能在提交它的 worker 上查询，多 worker 部署请保持开启")
+    if os.getenv("METRICS_ENABLED", "1") != "0":
+        _prepare_metrics_dir(os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.path.join("storage", "prometheus"))
+
+    logger.info(f"启动 {workers} 个 worker: http://{args.host}:{args.port}")
+    uvicorn.run(
+        "app:app", host=args.host, port=args.port, workers=workers, reload=False,
+        # 退出信号后先停止接收新连接，lifespan 中再等待已接收的任务完成
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+
+
+if __name__ == "__main__":
+    main()
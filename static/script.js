@@ -1,6 +1,7 @@
 // 全局变量
 let selectedFiles = new Set();
 let selectedFileNames = new Map(); // 存储路径到文件名的映射
+let fileSprites = new Map(); // 文件类型/文件名到进度条预览索引地址的映射
 let currentTab = 'uploaded';
 
 // 页面加载完成后初始化
@@ -70,20 +71,27 @@ async function uploadFiles(files) {
     
     for (let file of files) {
         try {
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            const response = await fetch('/api/upload', {
-                method: 'POST',
-                body: formData
-            });
-            
-            const result = await response.json();
+            let result;
+            if (file.size >= RESUMABLE_UPLOAD_THRESHOLD) {
+                // 大文件使用断点续传的分块并行上传
+                result = await uploadFileResumable(file);
+            } else {
+                const formData = new FormData();
+                formData.append('file', file);
+                
+                const response = await fetch('/api/upload', {
+                    method: 'POST',
+                    body: formData
+                });
+                
+                result = await response.json();
+            }
             
             if (result.success) {
                 showNotification(`文件 ${file.name} 上传成功`, 'success');
             } else {
-                showNotification(`文件 ${file.name} 上传失败`, 'error');
+                const detail = result.detail ? `: ${result.detail}` : '';
+                showNotification(`文件 ${file.name} 上传失败${detail}`, 'error');
             }
         } catch (error) {
             console.error('上传错误:', error);
@@ -98,6 +106,98 @@ async function uploadFiles(files) {
     document.getElementById('fileInput').value = '';
 }
 
+// 断点续传上传参数
+const RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024;
+const RESUMABLE_PARALLEL = 4;
+const RESUMABLE_RETRIES = 3;
+
+// 计算分块的 SHA-256（仅在安全上下文中可用）
+async function sha256Hex(blob) {
+    if (!window.crypto || !window.crypto.subtle) return null;
+    const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// 断点续传上传：分块并行上传，失败重试，刷新页面后可从已上传的分块继续
+async function uploadFileResumable(file) {
+    const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let state = null;
+    
+    // 尝试恢复之前未完成的上传会话
+    const savedId = localStorage.getItem(resumeKey);
+    if (savedId) {
+        const response = await fetch(`/api/uploads/${savedId}`);
+        if (response.ok) {
+            state = await response.json();
+        } else {
+            localStorage.removeItem(resumeKey);
+        }
+    }
+    
+    if (!state) {
+        const response = await fetch('/api/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                filename: file.name,
+                size: file.size,
+                chunk_size: RESUMABLE_CHUNK_SIZE
+            })
+        });
+        state = await response.json();
+        if (!response.ok) return state;
+        localStorage.setItem(resumeKey, state.upload_id);
+    }
+    
+    const received = new Set(state.received_chunks);
+    const pending = [];
+    for (let i = 0; i < state.total_chunks; i++) {
+        if (!received.has(i)) pending.push(i);
+    }
+    
+    const uploadChunk = async (index) => {
+        const start = index * state.chunk_size;
+        const chunk = file.slice(start, Math.min(start + state.chunk_size, file.size));
+        const headers = { 'Upload-Offset': String(start) };
+        const checksum = await sha256Hex(chunk);
+        if (checksum) headers['X-Chunk-SHA256'] = checksum;
+        
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch(`/api/uploads/${state.upload_id}/chunks/${index}`, {
+                    method: 'PUT',
+                    headers: headers,
+                    body: chunk
+                });
+                if (response.ok) return;
+                if (attempt >= RESUMABLE_RETRIES) {
+                    const error = await response.json();
+                    throw new Error(error.detail || `HTTP ${response.status}`);
+                }
+            } catch (error) {
+                if (attempt >= RESUMABLE_RETRIES) throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+        }
+    };
+    
+    // 固定数量的并行上传通道
+    const workers = Array.from({ length: RESUMABLE_PARALLEL }, async () => {
+        while (pending.length > 0) {
+            await uploadChunk(pending.shift());
+        }
+    });
+    await Promise.all(workers);
+    
+    const response = await fetch(`/api/uploads/${state.upload_id}/complete`, { method: 'POST' });
+    const result = await response.json();
+    if (result.success) {
+        localStorage.removeItem(resumeKey);
+    }
+    return result;
+}
+
 // 加载可用工具
 async function loadTools() {
     try {
@@ -119,14 +219,25 @@ async function loadTools() {
     }
 }
 
+// 文件列表每页数量
+const FILES_PAGE_SIZE = 100;
+
+// 最近一次文件列表响应的 ETag，列表未变化时服务器返回 304，无需重新渲染
+let filesETag = null;
+
 // 刷新文件列表
 async function refreshFiles() {
     try {
-        const response = await fetch('/api/files');
+        const headers = filesETag ? { 'If-None-Match': filesETag } : {};
+        const response = await fetch(`/api/files?limit=${FILES_PAGE_SIZE}`, { headers, cache: 'no-store' });
+        if (response.status === 304) {
+            return;
+        }
         const data = await response.json();
+        filesETag = response.headers.get('ETag');
         
-        updateFileList('uploadedFiles', data.uploaded_files, 'upload');
-        updateFileList('outputFiles', data.output_files, 'output');
+        updateFileList('uploadedFiles', data.uploaded_files, 'upload', data.uploaded_files_next_cursor);
+        updateFileList('outputFiles', data.output_files, 'output', data.output_files_next_cursor);
     } catch (error) {
         console.error('刷新文件列表失败:', error);
         showNotification('刷新文件列表失败', 'error');
@@ -134,7 +245,7 @@ async function refreshFiles() {
 }
 
 // 更新文件列表
-function updateFileList(containerId, files, fileType) {
+function updateFileList(containerId, files, fileType, nextCursor) {
     const container = document.getElementById(containerId);
     container.innerHTML = '';
     
@@ -143,25 +254,37 @@ function updateFileList(containerId, files, fileType) {
         return;
     }
     
+    appendFileItems(container, files, fileType, nextCursor);
+}
+
+// 追加文件条目，还有更多文件时在末尾显示“加载更多”
+function appendFileItems(container, files, fileType, nextCursor) {
     files.forEach(file => {
         const fileItem = document.createElement('div');
         fileItem.className = 'file-item';
+        if (selectedFiles.has(file.path)) {
+            fileItem.classList.add('selected');
+        }
         fileItem.onclick = () => toggleFileSelection(fileItem, file.path, file.name);
         
         // 存储路径到文件名的映射
         selectedFileNames.set(file.path, file.name);
+        if (file.sprite) {
+            fileSprites.set(`${fileType}/${file.name}`, file.sprite);
+        }
         
         // 检查是否是媒体文件
         const isMediaFileCheck = isMediaFile(file.name);
         
         fileItem.innerHTML = `
+            ${file.thumbnail ? `<img class="file-thumb" src="${file.thumbnail}" loading="lazy" alt="" onerror="this.remove()">` : ''}
             <div class="file-info">
                 <div class="file-name">${file.name}</div>
                 <div class="file-size">${formatFileSize(file.size)}</div>
             </div>
             <div class="file-actions">
                 ${isMediaFileCheck ? `
-                    <button class="btn btn-preview" onclick="previewMedia('${fileType}', '${file.name}', '${file.path}'); event.stopPropagation();" title="预览">
+                    <button class="btn btn-preview" onclick="previewMedia('${fileType}', '${file.name}', '${file.path}', ${file.size || 0}); event.stopPropagation();" title="预览">
                         <i class="fas ${isImageFile(file.name) ? 'fa-eye' : 'fa-play'}"></i>
                     </button>
                 ` : ''}
@@ -176,6 +299,34 @@ function updateFileList(containerId, files, fileType) {
         
         container.appendChild(fileItem);
     });
+    
+    if (nextCursor) {
+        const moreButton = document.createElement('button');
+        moreButton.className = 'btn btn-outline load-more';
+        moreButton.textContent = '加载更多';
+        moreButton.onclick = () => loadMoreFiles(container, fileType, nextCursor, moreButton);
+        container.appendChild(moreButton);
+    }
+}
+
+// 加载下一页文件
+async function loadMoreFiles(container, fileType, cursor, button) {
+    button.disabled = true;
+    try {
+        const params = new URLSearchParams({ type: fileType, limit: FILES_PAGE_SIZE, cursor });
+        const response = await fetch(`/api/files?${params}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const data = await response.json();
+        const key = fileType === 'upload' ? 'uploaded_files' : 'output_files';
+        button.remove();
+        appendFileItems(container, data[key], fileType, data[`${key}_next_cursor`]);
+    } catch (error) {
+        console.error('加载更多文件失败:', error);
+        showNotification('加载更多文件失败', 'error');
+        button.disabled = false;
+    }
 }
 
 // 切换文件选择
@@ -233,6 +384,9 @@ async function sendMessage() {
     const tempMessageId = 'temp-' + Date.now();
     addStreamMessage('正在处理...', 'assistant', tempMessageId);
     
+    // 记录任务 ID 和最后收到的事件编号，连接中断时据此续传
+    const stream = { jobId: null, lastEventId: 0, ended: false };
+    
     try {
         const response = await fetch('/api/process-stream', {
             method: 'POST',
@@ -246,102 +400,69 @@ async function sendMessage() {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let buffer = '';
-        
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            
-            buffer += decoder.decode(value, { stream: true });
-            const lines = buffer.split('\n');
-            buffer = lines.pop(); // 保留不完整的行
-            
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    try {
-                        const data = JSON.parse(line.slice(6));
-                        handleStreamMessage(data, tempMessageId);
-                    } catch (e) {
-                        console.error('解析流数据失败:', e);
-                    }
-                }
+        await readEventStream(response, tempMessageId, stream);
+    } catch (error) {
+        console.error('读取消息流失败:', error);
+    }
+    
+    // 连接在任务结束前中断时，从最后收到的事件之后继续接收
+    for (let attempt = 1; !stream.ended && stream.jobId && attempt <= STREAM_RECONNECT_RETRIES; attempt++) {
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+        try {
+            const response = await fetch(`/api/jobs/${stream.jobId}/events`, {
+                headers: { 'Last-Event-ID': String(stream.lastEventId) }
+            });
+            if (response.ok) {
+                await readEventStream(response, tempMessageId, stream);
             }
+        } catch (error) {
+            console.error('重新连接消息流失败:', error);
         }
-    } catch (error) {
-        console.error('发送消息失败:', error);
+    }
+    
+    if (!stream.ended) {
         updateStreamMessage('发送消息失败，请检查网络连接', tempMessageId);
     }
     
     refreshFiles(); // 刷新文件列表，可能有新的输出文件
 }
 
-// 直接发送消息（用于快速操作）
-async function sendMessageDirect(message) {
-    // 构建包含选中文件信息的完整消息
-    let fullMessage = message;
-    
-    // 如果有选中的文件，添加文件信息到消息中
-    if (selectedFiles.size > 0) {
-        const selectedFilePaths = Array.from(selectedFiles);
-        const fileInfo = selectedFilePaths.map(path => {
-            const fileName = selectedFileNames.get(path) || path;
-            return `文件路径: ${path} (文件名: ${fileName})`;
-        }).join('\n');
-        
-        fullMessage = `${message}\n\n当前选中的文件:\n${fileInfo}`;
-    }
-    
-    // 添加用户消息到聊天
-    addMessage(message, 'user');
-    
-    // 创建一个临时的助手消息用于显示流式内容
-    const tempMessageId = 'temp-' + Date.now();
-    addStreamMessage('正在处理...', 'assistant', tempMessageId);
-    
-    try {
-        const response = await fetch('/api/process-stream', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ message: fullMessage })
-        });
-        
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
+// 连接中断后的续传次数
+const STREAM_RECONNECT_RETRIES = 3;
+
+// 读取 SSE 消息流，记录事件编号以便断线续传
+async function readEventStream(response, messageId, stream) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
         
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let buffer = '';
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop(); // 保留不完整的行
         
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-            
-            buffer += decoder.decode(value, { stream: true });
-            const lines = buffer.split('\n');
-            buffer = lines.pop(); // 保留不完整的行
-            
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    try {
-                        const data = JSON.parse(line.slice(6));
-                        handleStreamMessage(data, tempMessageId);
-                    } catch (e) {
-                        console.error('解析流数据失败:', e);
+        for (const line of lines) {
+            if (line.startsWith('id: ')) {
+                stream.lastEventId = parseInt(line.slice(4), 10) || stream.lastEventId;
+            } else if (line.startsWith('data: ')) {
+                try {
+                    const data = JSON.parse(line.slice(6));
+                    if (data.job_id) {
+                        stream.jobId = data.job_id;
+                    }
+                    if (data.type === 'end') {
+                        stream.ended = true;
                     }
+                    handleStreamMessage(data, messageId);
+                } catch (e) {
+                    console.error('解析流数据失败:', e);
                 }
             }
         }
-    } catch (error) {
-        console.error('发送消息失败:', error);
-        updateStreamMessage('发送消息失败，请检查网络连接', tempMessageId);
     }
-    
-    refreshFiles(); // 刷新文件列表，可能有新的输出文件
 }
 
 // 添加消息到聊天
@@ -475,6 +596,21 @@ function handleStreamMessage(data, messageId) {
             // 处理AI的思考过程内容
             updateThinkingContent(data.message, messageId);
             break;
+        case 'thinking_chunk':
+            // 思考过程的增量文本
+            appendThinkingText(data.content, messageId);
+            break;
+        case 'tool_call':
+        case 'tool_result':
+            // 工具调用过程显示在思考过程中
+            removeToolProgress(messageId);
+            appendThinkingText(`\n\n${data.message}\n\n`, messageId);
+            break;
+        case 'ffmpeg_progress':
+        case 'ffmpeg_stalled':
+            // FFmpeg 实时进度
+            updateToolProgress(data, messageId);
+            break;
         case 'thinking_end':
             // 思考过程结束，准备显示结果
             finalizeThinkingProcess(messageId);
@@ -498,12 +634,13 @@ function handleStreamMessage(data, messageId) {
             updateStreamMessage(`❌ ${data.message}`, messageId);
             break;
         case 'end':
-            // 处理结束，可以在这里做一些清理工作
+            // 处理结束，释放已缓存的流式文本
+            streamTexts.delete(messageId);
             break;
     }
 }
 
-// 快速操作
+// 快速操作：参数已确定，直接调用工具接口，不经过 LLM
 async function quickAction(action) {
     if (selectedFiles.size === 0) {
         showNotification('请先选择文件', 'warning');
@@ -513,10 +650,14 @@ async function quickAction(action) {
     const selectedFilePath = Array.from(selectedFiles)[0];
     const selectedFileName = selectedFileNames.get(selectedFilePath) || selectedFilePath;
     let message = '';
+    let endpoint = '';
+    let body = {};
     
     switch (action) {
         case 'info':
-            message = `获取 ${selectedFilePath} 的详细信息`;
+            message = `获取 ${selectedFileName} 的详细信息`;
+            endpoint = '/api/info';
+            body = { video_path: selectedFilePath };
             break;
         case 'clip':
             const start = document.getElementById('clipStart').value;
@@ -525,15 +666,19 @@ async function quickAction(action) {
                 showNotification('请输入开始时间和持续时间', 'warning');
                 return;
             }
-            message = `将 ${selectedFilePath} 从 ${start} 开始剪切 ${duration} 秒`;
+            message = `将 ${selectedFileName} 从 ${start} 开始剪切 ${duration} 秒`;
+            endpoint = '/api/clip';
+            body = { video_path: selectedFilePath, start: start, duration: duration };
             break;
         case 'concat':
             if (selectedFiles.size < 2) {
                 showNotification('请选择至少两个文件进行合并', 'warning');
                 return;
             }
-            const files = Array.from(selectedFiles).join(', ');
-            message = `合并这些视频文件: ${files}`;
+            const files = Array.from(selectedFiles);
+            message = `合并这些视频文件: ${files.map(path => selectedFileNames.get(path) || path).join(', ')}`;
+            endpoint = '/api/concat';
+            body = { input_files: files };
             break;
         case 'scale':
             const width = document.getElementById('scaleWidth').value;
@@ -542,18 +687,59 @@ async function quickAction(action) {
                 showNotification('请输入目标宽度和高度', 'warning');
                 return;
             }
-            message = `将 ${selectedFilePath} 缩放到 ${width}x${height}`;
+            message = `将 ${selectedFileName} 缩放到 ${width}x${height}`;
+            endpoint = '/api/scale';
+            body = { video_path: selectedFilePath, width: width, height: height };
             break;
         case 'extract_audio':
             const audioFormat = document.getElementById('audioFormat').value;
-            message = `从 ${selectedFilePath} 提取音频，格式为 ${audioFormat}`;
+            message = `从 ${selectedFileName} 提取音频，格式为 ${audioFormat}`;
+            endpoint = '/api/extract-audio';
+            body = { video_path: selectedFilePath, audio_format: audioFormat };
             break;
         default:
             return;
     }
     
-    // 直接发送消息，不显示在输入框中
-    sendMessageDirect(message);
+    runDirectTool(message, endpoint, body);
+}
+
+// 直接调用工具接口并在聊天区域显示结果
+async function runDirectTool(message, endpoint, body) {
+    addMessage(message, 'user');
+    
+    const tempMessageId = 'temp-' + Date.now();
+    addStreamMessage('⚡ 正在直接执行 FFmpeg 工具...', 'assistant', tempMessageId);
+    
+    try {
+        const response = await fetch(endpoint, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(body)
+        });
+        const data = await response.json();
+        
+        if (!response.ok) {
+            throw new Error(data.detail || `HTTP error! status: ${response.status}`);
+        }
+        
+        const result = typeof data.result === 'string'
+            ? data.result
+            : '```json\n' + JSON.stringify(data.result, null, 2) + '\n```';
+        updateThinkingProcess(`✅ 已执行工具 ${data.tool}`, tempMessageId);
+        finalizeThinkingProcess(tempMessageId);
+        createResultSection(tempMessageId);
+        appendResultContent(result, tempMessageId);
+        finalizeMessage(tempMessageId);
+    } catch (error) {
+        console.error('执行工具失败:', error);
+        updateThinkingProcess(`❌ 执行失败: ${error.message}`, tempMessageId);
+        finalizeMessage(tempMessageId);
+    }
+    
+    refreshFiles(); // 刷新文件列表，可能有新的输出文件
 }
 
 // 下载文件
@@ -637,12 +823,23 @@ function formatFileSize(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
+// 流式消息已收到的原始文本，每次增量到达时整体重新渲染 markdown
+const streamTexts = new Map();
+
+function getStreamText(messageId) {
+    if (!streamTexts.has(messageId)) {
+        streamTexts.set(messageId, { thinking: '', result: '' });
+    }
+    return streamTexts.get(messageId);
+}
+
 // 更新思考过程
 function updateThinkingProcess(content, messageId) {
     const messageElement = document.getElementById(messageId);
     if (messageElement) {
         const thinkingText = messageElement.querySelector('.thinking-text');
-        if (thinkingText) {
+        // 已开始输出思考内容后不再用进度提示覆盖
+        if (thinkingText && !getStreamText(messageId).thinking) {
             thinkingText.innerHTML = content.replace(/\n/g, '<br>');
         }
         
@@ -653,14 +850,18 @@ function updateThinkingProcess(content, messageId) {
 
 // 更新思考过程内容（AI的实际思考）
 function updateThinkingContent(content, messageId) {
+    appendThinkingText('\n' + content, messageId);
+}
+
+// 追加思考过程文本
+function appendThinkingText(content, messageId) {
     const messageElement = document.getElementById(messageId);
     if (messageElement) {
+        const text = getStreamText(messageId);
+        text.thinking += content;
         const thinkingText = messageElement.querySelector('.thinking-text');
         if (thinkingText) {
-            // 将思考过程内容添加到现有内容中
-            const currentContent = thinkingText.textContent || '';
-            const newContent = currentContent + '\n' + content;
-            thinkingText.innerHTML = renderMarkdown(newContent);
+            thinkingText.innerHTML = renderMarkdown(text.thinking);
         }
         
         const chatMessages = document.getElementById('chatMessages');
@@ -668,6 +869,57 @@ function updateThinkingContent(content, messageId) {
     }
 }
 
+// 格式化秒数为 m:ss
+function formatSeconds(seconds) {
+    const total = Math.round(seconds);
+    return `${Math.floor(total / 60)}:${String(total % 60).padStart(2, '0')}`;
+}
+
+// 更新 FFmpeg 处理进度
+function updateToolProgress(data, messageId) {
+    const messageElement = document.getElementById(messageId);
+    const thinkingContent = messageElement && messageElement.querySelector('.thinking-content');
+    if (!thinkingContent) return;
+    
+    let progressElement = thinkingContent.querySelector('.tool-progress');
+    if (!progressElement) {
+        progressElement = document.createElement('div');
+        progressElement.className = 'tool-progress';
+        progressElement.innerHTML = '<progress max="100"></progress><div class="tool-progress-text"></div>';
+        thinkingContent.appendChild(progressElement);
+    }
+    
+    const bar = progressElement.querySelector('progress');
+    const text = progressElement.querySelector('.tool-progress-text');
+    if (data.type === 'ffmpeg_stalled') {
+        progressElement.classList.add('stalled');
+        text.textContent = data.message;
+        return;
+    }
+    
+    progressElement.classList.remove('stalled');
+    const parts = [`⏳ ${data.tool}`];
+    if (data.percent !== null) {
+        bar.value = data.percent;
+        parts.push(`${data.percent}%`);
+    } else {
+        bar.removeAttribute('value');
+        if (data.out_time !== null) parts.push(formatSeconds(data.out_time));
+    }
+    if (data.speed !== null) parts.push(`${data.speed}x`);
+    if (data.eta !== null) parts.push(`剩余 ${formatSeconds(data.eta)}`);
+    text.textContent = parts.join(' · ');
+}
+
+// 移除 FFmpeg 处理进度
+function removeToolProgress(messageId) {
+    const messageElement = document.getElementById(messageId);
+    const progressElement = messageElement && messageElement.querySelector('.tool-progress');
+    if (progressElement) {
+        progressElement.remove();
+    }
+}
+
 // 完成思考过程
 function finalizeThinkingProcess(messageId) {
     const messageElement = document.getElementById(messageId);
@@ -736,9 +988,9 @@ function appendResultContent(content, messageId) {
             }
             
             // 添加内容并渲染markdown
-            const currentContent = resultContent.textContent || '';
-            const newContent = currentContent + content;
-            resultContent.innerHTML = renderMarkdown(newContent);
+            const text = getStreamText(messageId);
+            text.result += content;
+            resultContent.innerHTML = renderMarkdown(text.result);
         }
         
         const chatMessages = document.getElementById('chatMessages');
@@ -889,6 +1141,139 @@ function isVideoOrAudioFile(filename) {
     return videoExtensions.includes(extension) || audioExtensions.includes(extension);
 }
 
+// 超过该大小的视频通过 HLS 切片预览
+const HLS_PREVIEW_MIN_SIZE = 50 * 1024 * 1024;
+// 浏览器可以直接播放的视频格式
+const NATIVE_VIDEO_EXTENSIONS = ['.mp4', '.webm', '.m4v'];
+const HLS_JS_URL = 'https://cdn.jsdelivr.net/npm/hls.js@1/dist/hls.min.js';
+let hlsLibraryPromise = null;
+
+// 大文件或浏览器无法直接播放的格式使用 HLS 预览
+function shouldUseHlsPreview(filename, fileSize) {
+    const extension = filename.toLowerCase().substring(filename.lastIndexOf('.'));
+    return !NATIVE_VIDEO_EXTENSIONS.includes(extension) || fileSize >= HLS_PREVIEW_MIN_SIZE;
+}
+
+// 按需加载 hls.js（只加载一次）
+function loadHlsLibrary() {
+    if (window.Hls) {
+        return Promise.resolve();
+    }
+    if (!hlsLibraryPromise) {
+        hlsLibraryPromise = new Promise((resolve, reject) => {
+            const script = document.createElement('script');
+            script.src = HLS_JS_URL;
+            script.onload = resolve;
+            script.onerror = () => {
+                hlsLibraryPromise = null;
+                reject(new Error('hls.js 加载失败'));
+            };
+            document.head.appendChild(script);
+        });
+    }
+    return hlsLibraryPromise;
+}
+
+// 为视频元素挂载 HLS 预览，不支持或失败时回退到直接播放原文件
+async function attachHlsPreview(video, fileType, filename, fallbackUrl) {
+    const playlistUrl = `/api/preview/${fileType}/${encodeURIComponent(filename)}/index.m3u8`;
+    
+    if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = playlistUrl;
+        return;
+    }
+    
+    try {
+        await loadHlsLibrary();
+    } catch (error) {
+        console.warn(error.message);
+    }
+    if (!window.Hls || !Hls.isSupported()) {
+        video.src = fallbackUrl;
+        return;
+    }
+    
+    const hls = new Hls();
+    video.hls = hls;
+    hls.on(Hls.Events.ERROR, (event, data) => {
+        if (data.fatal) {
+            console.warn('HLS 预览失败，改为直接播放:', data.details);
+            hls.destroy();
+            video.hls = null;
+            video.src = fallbackUrl;
+        }
+    });
+    hls.loadSource(playlistUrl);
+    hls.attachMedia(video);
+}
+
+// 解析进度条预览的 WebVTT 索引
+async function loadSpriteCues(vttUrl) {
+    const response = await fetch(vttUrl);
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const text = await response.text();
+    const cues = [];
+    const pattern = /([\d:.]+) --> ([\d:.]+)\s+(\S+)#xywh=(\d+),(\d+),(\d+),(\d+)/g;
+    let match;
+    while ((match = pattern.exec(text)) !== null) {
+        cues.push({
+            start: parseVttTime(match[1]),
+            end: parseVttTime(match[2]),
+            url: new URL(match[3], new URL(vttUrl, location.href)).href,
+            x: +match[4], y: +match[5], w: +match[6], h: +match[7]
+        });
+    }
+    return cues;
+}
+
+function parseVttTime(value) {
+    return value.split(':').reduce((total, part) => total * 60 + parseFloat(part), 0);
+}
+
+// 鼠标悬停在视频控制条上时显示对应时间点的雪碧图小图，不需要解码视频
+async function attachSeekPreview(video, vttUrl) {
+    let cues;
+    try {
+        cues = await loadSpriteCues(vttUrl);
+    } catch (error) {
+        console.warn('加载进度条预览失败:', error);
+        return;
+    }
+    if (!cues.length) {
+        return;
+    }
+    
+    const tooltip = document.createElement('div');
+    tooltip.className = 'seek-preview';
+    video.insertAdjacentElement('afterend', tooltip);
+    video.parentElement.classList.add('seek-preview-host');
+    
+    video.addEventListener('mousemove', (event) => {
+        const rect = video.getBoundingClientRect();
+        // 只在底部控制条区域显示
+        if (!video.duration || event.clientY < rect.bottom - 40) {
+            tooltip.style.display = 'none';
+            return;
+        }
+        const ratio = Math.min(Math.max((event.clientX - rect.left) / rect.width, 0), 1);
+        const time = ratio * video.duration;
+        const cue = cues.find(c => time >= c.start && time < c.end) || cues[cues.length - 1];
+        tooltip.style.display = 'block';
+        tooltip.style.width = `${cue.w}px`;
+        tooltip.style.height = `${cue.h}px`;
+        tooltip.style.backgroundImage = `url("${cue.url}")`;
+        tooltip.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+        tooltip.style.left = `${video.offsetLeft + ratio * rect.width - cue.w / 2}px`;
+        tooltip.style.top = `${video.offsetTop + rect.height - 40 - cue.h - 8}px`;
+        tooltip.dataset.time = formatSeconds(time);
+    });
+    video.addEventListener('mouseleave', () => {
+        tooltip.style.display = 'none';
+    });
+}
+
 // 检查是否是视频文件
 function isVideoFile(filename) {
     const videoExtensions = ['.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v', '.3gp'];
@@ -911,10 +1296,10 @@ function isImageFile(filename) {
 }
 
 // 预览媒体文件
-function previewMedia(fileType, filename, filePath) {
+function previewMedia(fileType, filename, filePath, fileSize = 0) {
     try {
         // 直接显示预览模态框，不获取额外信息
-        showMediaPreview(fileType, filename, filePath);
+        showMediaPreview(fileType, filename, filePath, fileSize);
     } catch (error) {
         console.error('预览媒体失败:', error);
         showNotification('预览媒体失败: ' + error.message, 'error');
@@ -922,7 +1307,7 @@ function previewMedia(fileType, filename, filePath) {
 }
 
 // 显示媒体预览模态框
-function showMediaPreview(fileType, filename, filePath) {
+function showMediaPreview(fileType, filename, filePath, fileSize = 0) {
     const modal = document.getElementById('mediaPreviewModal');
     const title = document.getElementById('previewTitle');
     const mediaContainer = document.getElementById('mediaContainer');
@@ -942,12 +1327,21 @@ function showMediaPreview(fileType, filename, filePath) {
     if (isVideoFile(filename)) {
         // 创建视频元素
         const video = document.createElement('video');
-        video.src = mediaUrl;
+        if (shouldUseHlsPreview(filename, fileSize)) {
+            attachHlsPreview(video, fileType, filename, mediaUrl);
+        } else {
+            video.src = mediaUrl;
+        }
         video.controls = true;
         video.preload = 'metadata';
         video.style.maxWidth = '100%';
         video.style.maxHeight = '400px';
         
+        const spriteUrl = fileSprites.get(`${fileType}/${filename}`);
+        if (spriteUrl) {
+            attachSeekPreview(video, spriteUrl);
+        }
+        
         // 添加错误处理
         video.onerror = function() {
             mediaContainer.innerHTML = `
@@ -1101,6 +1495,10 @@ function closeMediaPreview() {
     
     videos.forEach(video => {
         video.pause();
+        if (video.hls) {
+            video.hls.destroy();
+            video.hls = null;
+        }
         video.src = '';
     });
     
@@ -0,0 +1,104 @@
+# test_blob_store.py - blob 存储：内容哈希校验、去重链接和写入前解除共享
+import hashlib
+import os
+
+import pytest
+
+from blob_store import BlobStore, hash_file, is_valid_digest
+
+CONTENT = b"hello blob store\n" * 64
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "storage"))
+
+
+def _ingest(store, dest, content=CONTENT):
+    tmp = os.path.join(store.tmp_dir, "upload.tmp")
+    with open(tmp, "wb") as f:
+        f.write(content)
+    return store.ingest(tmp, hashlib.sha256(content).hexdigest(), str(dest))
+
+
+@pytest.mark.parametrize("digest, valid", [
+    (DIGEST, True),
+    ("0" * 64, True),
+    (DIGEST.upper(), False),
+    (DIGEST[:63], False),
+    (DIGEST + "0", False),
+    ("../../" + DIGEST[6:], False),
+    ("g" * 64, False),
+    (None, False),
+    (12345, False),
+])
+def test_is_valid_digest(digest, valid):
+    assert is_valid_digest(digest) is valid
+
+
+@pytest.mark.parametrize("digest", ["../../etc/passwd", "ab/../../x", "", "A" * 64])
+def test_invalid_digest_never_reaches_the_filesystem(store, tmp_path, digest):
+    assert store.has(digest) is False
+    with pytest.raises(ValueError):
+        store.blob_path(digest)
+    with pytest.raises(ValueError):
+        store.link(digest, str(tmp_path / "dest.bin"))
+    assert not (tmp_path / "dest.bin").exists()
+
+
+def test_ingest_and_link_deduplicate(store, tmp_path):
+    first, second = tmp_path / "a.bin", tmp_path / "b.bin"
+    assert _ingest(store, first) is False
+    assert store.has(DIGEST)
+    blob = store.blob_path(DIGEST)
+    assert blob == os.path.join(store.blobs_dir, DIGEST[:2], DIGEST)
+    assert os.stat(blob).st_mode & 0o777 == 0o444
+
+    assert _ingest(store, second) is True
+    assert store.refcount(DIGEST) == 2
+    assert store.digest_of(str(second)) == DIGEST
+
+    third = tmp_path / "c.bin"
+    store.link(DIGEST, str(third))
+    assert third.read_bytes() == CONTENT
+    assert store.refcount(DIGEST) == 3
+
+    for path in (first, second, third):
+        assert store.release(str(path)) is True
+    assert not store.has(DIGEST)
+
+
+def test_link_missing_blob(store, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        store.link("0" * 64, str(tmp_path / "dest.bin"))
+
+
+def test_detach_breaks_hardlink_and_keeps_blob(store, tmp_path):
+    first, second = tmp_path / "a.bin", tmp_path / "b.bin"
+    _ingest(store, first)
+    _ingest(store, second)
+    if os.stat(first).st_nlink <= 1:
+        assert store.detach(str(first)) is False
+        pytest.skip("文件系统使用 reflink 或复制，用户文件本身就是独立的")
+    mtime_ns = os.stat(first).st_mtime_ns
+
+    assert store.detach(str(first)) is True
+    st = os.stat(first)
+    assert st.st_nlink == 1
+    assert st.st_mtime_ns == mtime_ns
+    assert first.read_bytes() == CONTENT
+    assert store.digest_of(str(first)) is None
+    assert store.refcount(DIGEST) == 1
+
+    # 原地覆盖解除共享后的文件，不影响 blob 和其他用户文件
+    with open(first, "r+b") as f:
+        f.write(b"overwritten")
+    assert hash_file(store.blob_path(DIGEST)) == DIGEST
+    assert second.read_bytes() == CONTENT
+    assert store.detach(str(first)) is False
+
+    # 最后一个引用解除后 blob 被删除
+    store.detach(str(second))
+    assert not store.has(DIGEST)
+    assert second.read_bytes() == CONTENT
@@ -0,0 +1,76 @@
+# test_encode_planner.py - 剪切点选择：开放 GOP 中的非 IDR 关键帧不能作为流复制的起点
+import shutil
+import subprocess
+
+import pytest
+
+from encode_planner import EncodePlanner, keyframes
+
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+pytestmark = pytest.mark.skipif(not FFMPEG or not FFPROBE, reason="需要 ffmpeg 和 ffprobe")
+
+
+def _encode(path, open_gop):
+    # 每 24 帧一个关键帧、固定 3 个 B 帧；开放 GOP 时除第一帧外的关键帧都是带前导帧的非 IDR I 帧
+    params = "keyint=24:min-keyint=24:scenecut=0:bframes=3:b-adapt=0"
+    if open_gop:
+        params += ":open-gop=1"
+    completed = subprocess.run(
+        [FFMPEG, "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=160x120:rate=25:duration=6",
+         "-c:v", "libx264", "-x264-params", params, "-pix_fmt", "yuv420p", str(path)],
+        capture_output=True
+    )
+    if completed.returncode != 0:
+        pytest.skip("ffmpeg 不支持 libx264")
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def open_gop(tmp_path_factory):
+    return _encode(tmp_path_factory.mktemp("media") / "open.mp4", open_gop=True)
+
+
+@pytest.fixture(scope="module")
+def closed_gop(tmp_path_factory):
+    return _encode(tmp_path_factory.mktemp("media") / "closed.mp4", open_gop=False)
+
+
+def _packet_keyframes(path):
+    completed = subprocess.run(
+        [FFPROBE, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+         "-of", "csv=p=0", path],
+        capture_output=True, check=True, text=True
+    )
+    return [float(line.split(",")[0]) for line in completed.stdout.splitlines() if "K" in line.split(",")[1]]
+
+
+def test_open_gop_recovery_points_are_not_cut_points(open_gop):
+    # 数据包层面这些 I 帧都带 K 标记
+    assert len(_packet_keyframes(open_gop)) > 1
+    assert keyframes(open_gop, 0.5, 5.0, FFPROBE) == [0.0]
+
+
+def test_closed_gop_keyframes_are_cut_points(closed_gop):
+    assert keyframes(closed_gop, 0.5, 5.0, FFPROBE) == pytest.approx([0.0, 0.96, 1.92, 2.88, 3.84, 4.8])
+
+
+def test_clip_on_open_gop_is_reencoded(open_gop, tmp_path):
+    planner = EncodePlanner(ffmpeg=FFMPEG, ffprobe=FFPROBE)
+    # 起点正好是一个非 IDR I 帧，不能直接复制，也不能从它开始拼接智能剪切的尾部
+    start = _packet_keyframes(open_gop)[1]
+    plan = planner.plan("clip_video", {
+        "video_path": open_gop, "start": f"{start:.3f}", "duration": "2",
+        "output_path": str(tmp_path / "out.mp4"),
+    })
+    assert plan.strategy == "encode"
+
+
+def test_clip_on_closed_gop_is_copied(closed_gop, tmp_path):
+    planner = EncodePlanner(ffmpeg=FFMPEG, ffprobe=FFPROBE)
+    plan = planner.plan("clip_video", {
+        "video_path": closed_gop, "start": "1.92", "duration": "2",
+        "output_path": str(tmp_path / "out.mp4"),
+    })
+    assert plan.strategy == "copy"
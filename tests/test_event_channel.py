@@ -0,0 +1,75 @@
+# test_event_channel.py - 环形缓冲区写满后的断线重放
+import asyncio
+
+import pytest
+
+from event_channel import EventChannel
+
+
+async def _collect(channel, last_event_id):
+    return [(event_id, event) async for event_id, event in channel.subscribe(last_event_id)]
+
+
+def test_replay_after_buffer_wraps():
+    async def main():
+        channel = EventChannel(max_events=3)
+        for i in range(1, 8):
+            assert channel.publish({"n": i}) == i
+        channel.close()
+        assert channel.last_id == 7
+        # 最早的事件已被覆盖，只能从仍在缓冲区中的第一条开始重放
+        assert [event_id for event_id, _ in await _collect(channel, 0)] == [5, 6, 7]
+        assert [event_id for event_id, _ in await _collect(channel, 2)] == [5, 6, 7]
+        assert await _collect(channel, 5) == [(6, {"n": 6}), (7, {"n": 7})]
+        assert await _collect(channel, 7) == []
+
+    asyncio.run(main())
+
+
+def test_events_after_uses_ids_not_positions():
+    async def main():
+        channel = EventChannel(max_events=4)
+        for i in range(10):
+            channel.publish(i)
+        assert channel.events_after(8) == [(9, 8), (10, 9)]
+        assert channel.events_after(6) == [(7, 6), (8, 7), (9, 8), (10, 9)]
+        assert channel.events_after(10) == []
+
+    asyncio.run(main())
+
+
+def test_subscriber_resumes_live_after_replay():
+    async def main():
+        channel = EventChannel(max_events=2)
+        for i in range(1, 5):
+            channel.publish(i)
+        task = asyncio.create_task(_collect(channel, 1))
+        await asyncio.sleep(0)
+        channel.publish(5)
+        channel.publish(6)
+        channel.publish(7)
+        channel.close()
+        received = [event_id for event_id, _ in await task]
+        # 重放 3、4 后实时接收；订阅者落后超过缓冲区时跳过被覆盖的事件，但编号严格递增
+        assert received[:2] == [3, 4]
+        assert received[-1] == 7
+        assert received == sorted(set(received))
+
+    asyncio.run(main())
+
+
+def test_forwarded_ids_with_gaps():
+    async def main():
+        channel = EventChannel(max_events=10)
+        for event_id in (4, 5, 9, 10):
+            assert channel.publish(event_id, event_id) == event_id
+        assert channel.events_after(0) == [(4, 4), (5, 5), (9, 9), (10, 10)]
+        assert channel.events_after(5) == [(9, 9), (10, 10)]
+        assert channel.events_after(7) == [(9, 9), (10, 10)]
+        assert channel.events_after(9) == [(10, 10)]
+        with pytest.raises(ValueError):
+            channel.publish("stale", 10)
+        channel.close()
+        assert await _collect(channel, 5) == [(9, 9), (10, 10)]
+
+    asyncio.run(main())
@@ -0,0 +1,16 @@
+# test_file_lock.py - worker 进程之间的生成锁
+from file_lock import lock_file, unlock
+
+
+def test_non_blocking_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / "key.lock")
+    held = lock_file(path)
+    try:
+        # flock 按打开的文件描述绑定，同一进程中另一次打开也会冲突
+        assert lock_file(path, blocking=False) is None
+    finally:
+        unlock(held)
+    fd = lock_file(path, blocking=False)
+    assert fd is not None
+    unlock(fd)
+    unlock(None)
@@ -0,0 +1,77 @@
+# test_job_queue.py - 调度顺序：先比较优先级，同优先级时在用户之间轮转
+import asyncio
+
+from job_queue import JobScheduler
+
+
+async def _noop(job):
+    return None
+
+
+def _order(submissions, cancel=()):
+    """按顺序提交 (用户, 优先级)，返回调度器选出任务的顺序（任务描述）"""
+    async def main():
+        scheduler = JobScheduler(workers=1)
+        jobs = {}
+        for i, (user, priority) in enumerate(submissions):
+            jobs[i] = scheduler.submit(_noop, user=user, priority=priority, description=f"{user}{i}")
+        for i in cancel:
+            scheduler.cancel(jobs[i].id)
+        order = []
+        while True:
+            job = scheduler._pop_next()
+            if job is None:
+                return order
+            order.append(job.description)
+
+    return asyncio.run(main())
+
+
+def test_round_robin_between_users():
+    submissions = [("a", 0), ("a", 0), ("a", 0), ("b", 0), ("c", 0), ("b", 0)]
+    assert _order(submissions) == ["a0", "b3", "c4", "a1", "b5", "a2"]
+
+
+def test_priority_before_fairness():
+    submissions = [("a", 0), ("a", 0), ("b", 5), ("b", 0), ("c", 0)]
+    assert _order(submissions) == ["b2", "a0", "c4", "b3", "a1"]
+
+
+def test_fifo_within_user_and_priority():
+    submissions = [("a", 0), ("a", 1), ("a", 0), ("a", 1)]
+    assert _order(submissions) == ["a1", "a3", "a0", "a2"]
+
+
+def test_cancelled_jobs_are_skipped():
+    submissions = [("a", 0), ("a", 0), ("b", 0), ("b", 0)]
+    assert _order(submissions, cancel=(0, 3)) == ["a1", "b2"]
+
+
+def test_user_served_recently_waits_for_others():
+    async def main():
+        scheduler = JobScheduler(workers=1)
+        scheduler.submit(_noop, user="a", description="a0")
+        assert scheduler._pop_next().description == "a0"
+        # a 刚被调度过，新到的 b 先于 a 的下一个任务
+        scheduler.submit(_noop, user="a", description="a1")
+        scheduler.submit(_noop, user="b", description="b0")
+        return [scheduler._pop_next().description, scheduler._pop_next().description]
+
+    assert asyncio.run(main()) == ["b0", "a1"]
+
+
+def test_idle_users_are_forgotten():
+    async def main():
+        scheduler = JobScheduler(workers=2)
+        await scheduler.start()
+        try:
+            jobs = [scheduler.submit(_noop, user=user) for user in ("a", "b", "a")]
+            for job in jobs:
+                await job.wait()
+            # worker 在下一轮取任务时清理已空的队列
+            await asyncio.sleep(0)
+            return dict(scheduler._last_served), dict(scheduler._running), dict(scheduler._pending)
+        finally:
+            await scheduler.close()
+
+    assert asyncio.run(main()) == ({}, {}, {})
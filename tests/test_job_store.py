@@ -0,0 +1,99 @@
+# test_job_store.py - 其他 worker 上任务的订阅：每个任务一个共享轮询
+import asyncio
+
+import pytest
+
+import job_store
+from job_queue import CANCELLED, SUCCEEDED, Job, JobCancelledError
+from job_store import JobStore
+
+
+@pytest.fixture(autouse=True)
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(job_store, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(job_store, "POLL_MAX_INTERVAL", 0.04)
+
+
+def _stores(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite3")
+    return JobStore(db_path, worker_id="owner"), JobStore(db_path, worker_id="reader")
+
+
+def _submit(owner):
+    job = Job(None, "u", 0, "process", "test")
+    job.store = owner
+    owner.track(job)
+    return job
+
+
+async def _collect(stored, last_event_id=0):
+    return [(event_id, event["n"]) async for event_id, event in stored.subscribe(last_event_id)]
+
+
+def test_subscribers_share_one_poll(tmp_path):
+    async def main():
+        owner, reader = _stores(tmp_path)
+        job = _submit(owner)
+        job.publish({"n": 1})
+        await owner.flush()
+
+        polls = []
+        poll = reader._poll
+        reader._poll = lambda *args: polls.append(args) or poll(*args)
+        stored = reader.load(job.id)
+        subscribers = [asyncio.create_task(_collect(reader.load(job.id), last)) for last in (0, 0, 1)]
+        waiter = asyncio.create_task(stored.wait())
+        await asyncio.sleep(0.05)
+        assert list(reader._feeds) == [job.id]
+        assert reader._feeds[job.id].watchers == 4
+
+        for n in (2, 3):
+            job.publish({"n": n})
+        job._finish(SUCCEEDED, {"ok": True})
+        await owner.flush()
+        results = await asyncio.gather(*subscribers)
+        assert results == [[(1, 1), (2, 2), (3, 3)]] * 2 + [[(2, 2), (3, 3)]]
+        assert await waiter == {"ok": True}
+        assert stored.status == SUCCEEDED
+        assert reader._feeds == {}
+        # 所有订阅者共用一个轮询，轮询次数与订阅者数量无关
+        assert len(polls) < 20
+
+    asyncio.run(main())
+
+
+def test_idle_job_backs_off(tmp_path):
+    async def main():
+        owner, reader = _stores(tmp_path)
+        job = _submit(owner)
+        await owner.flush()
+
+        polls = []
+        poll = reader._poll
+        reader._poll = lambda *args: polls.append(args) or poll(*args)
+        task = asyncio.create_task(_collect(reader.load(job.id)))
+        await asyncio.sleep(0.5)
+        # 间隔从 0.01 秒加倍到 0.04 秒封顶，不按最短间隔一直轮询
+        assert 5 <= len(polls) <= 20
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert reader._feeds == {}
+
+    asyncio.run(main())
+
+
+def test_wait_for_cancelled_job(tmp_path):
+    async def main():
+        owner, reader = _stores(tmp_path)
+        job = _submit(owner)
+        await owner.flush()
+        stored = reader.load(job.id)
+        waiter = asyncio.create_task(stored.wait())
+        await asyncio.sleep(0.02)
+        job._finish(CANCELLED)
+        await owner.flush()
+        with pytest.raises(JobCancelledError):
+            await waiter
+
+    asyncio.run(main())
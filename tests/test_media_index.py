@@ -0,0 +1,154 @@
+# test_media_index.py - 增量扫描、ffprobe 输出解析和键集分页游标的往返
+import json
+import os
+import sys
+
+import pytest
+
+from media_index import InvalidCursorError, MediaIndex, media_kind, probe
+
+PROBE_OUTPUT = {
+    "format": {"format_name": "mov,mp4,m4a,3gp,3g2,mj2", "duration": "12.500000"},
+    "streams": [
+        {"codec_type": "audio", "codec_name": "aac"},
+        {"codec_type": "video", "codec_name": "h264", "width": 1280, "height": 720},
+    ],
+}
+
+FILES = {
+    "a.mp4": 300, "B.mov": 100, "c.mp4": 100, "d.mp3": 500,
+    "e.jpg": 50, "f.mp4": 100, "g.txt": 10, "中文.mp4": 200,
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    root = tmp_path / "uploads"
+    root.mkdir()
+    for i, (name, size) in enumerate(FILES.items()):
+        path = root / name
+        path.write_bytes(b"x" * size)
+        # 部分文件的修改时间相同，翻页必须靠文件名区分
+        os.utime(path, ns=(0, (1700000000 + i // 2) * 10 ** 9))
+    index = MediaIndex(str(tmp_path / "media.sqlite3"), {"upload": str(root)})
+    index.ffprobe = None
+    index.rescan(force=True)
+    return index
+
+
+@pytest.fixture
+def fake_ffprobe(tmp_path):
+    script = tmp_path / "ffprobe"
+    script.write_text(f"#!{sys.executable}\nprint({json.dumps(json.dumps(PROBE_OUTPUT))})\n")
+    script.chmod(0o755)
+    return str(script)
+
+
+@pytest.mark.parametrize("name, kind", [
+    ("a.MP4", "video"), ("b.mkv", "video"), ("c.m4a", "audio"), ("d.JPG", "image"),
+    ("e.mpeg", "video"), ("f.txt", "other"), ("noext", "other"),
+])
+def test_media_kind(name, kind):
+    assert media_kind(name) == kind
+
+
+def test_probe_parses_ffprobe_json(fake_ffprobe):
+    assert probe("/media/a.mp4", fake_ffprobe) == {
+        "duration": 12.5, "width": 1280, "height": 720, "video_codec": "h264",
+        "audio_codec": "aac", "format": "mov,mp4,m4a,3gp,3g2,mj2",
+    }
+
+
+def test_probe_failure_returns_none(tmp_path):
+    assert probe("/media/a.mp4", str(tmp_path / "missing-ffprobe")) is None
+
+
+def test_rescan_is_incremental(index, tmp_path):
+    root = tmp_path / "uploads"
+    version = index.version()
+    assert index.rescan() == 0
+    assert index.rescan(force=True) == 0
+    assert index.version() == version
+
+    (root / "new.mp4").write_bytes(b"new")
+    (root / ".hidden.mp4").write_bytes(b"tmp")
+    (root / "a.mp4").write_bytes(b"changed")
+    (root / "g.txt").unlink()
+    assert index.rescan() == 3
+    assert index.get(str(root / "new.mp4"))["size"] == 3
+    assert index.get(str(root / "a.mp4"))["size"] == 7
+    assert index.get(str(root / "g.txt")) is None
+    assert index.get(str(root / ".hidden.mp4")) is None
+    assert index.version() > version
+
+
+def test_probe_pending_fills_metadata(index, tmp_path, fake_ffprobe):
+    index.ffprobe = fake_ffprobe
+    # 视频和音频需要探测，其余文件只标记为已处理
+    assert index.probe_pending(limit=100) == len(FILES)
+    assert index.probe_pending() == 0
+    info = index.get(str(tmp_path / "uploads" / "a.mp4"))
+    assert (info["duration"], info["width"], info["height"]) == (12.5, 1280, 720)
+    assert info["video_codec"] == "h264" and info["audio_codec"] == "aac"
+    assert index.get(str(tmp_path / "uploads" / "g.txt"))["duration"] is None
+
+    # 内容变化后清空旧信息并重新探测
+    (tmp_path / "uploads" / "a.mp4").write_bytes(b"changed")
+    index.rescan(force=True)
+    assert index.get(str(tmp_path / "uploads" / "a.mp4"))["duration"] is None
+    assert index.probe_pending() == 1
+
+
+def _all_pages(index, limit, **kwargs):
+    names, cursor, pages = [], None, 0
+    while True:
+        files, cursor = index.page("upload", limit, cursor=cursor, **kwargs)
+        names.extend(f["name"] for f in files)
+        pages += 1
+        if not cursor:
+            return names, pages
+
+
+@pytest.mark.parametrize("sort", ["name", "size", "mtime", "duration"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+@pytest.mark.parametrize("limit", [1, 3, 100])
+def test_pages_cover_full_listing(index, sort, order, limit):
+    expected = [f["name"] for f in index.page("upload", 1000, sort, order)[0]]
+    assert sorted(expected) == sorted(FILES)
+    names, pages = _all_pages(index, limit, sort=sort, order=order)
+    assert names == expected
+    assert pages == max(1, -(-len(FILES) // limit))
+
+
+def test_size_order_breaks_ties_by_name(index):
+    names, _ = _all_pages(index, 2, sort="size", order="asc")
+    assert names[:5] == ["g.txt", "e.jpg", "B.mov", "c.mp4", "f.mp4"]
+
+
+def test_filters_apply_across_pages(index):
+    names, _ = _all_pages(index, 2, sort="name", kind="video")
+    assert names == ["B.mov", "a.mp4", "c.mp4", "f.mp4", "中文.mp4"]
+    names, _ = _all_pages(index, 1, sort="size", query="MP")
+    assert names == ["c.mp4", "f.mp4", "中文.mp4", "a.mp4", "d.mp3"]
+
+
+def test_files_added_between_pages_are_not_repeated(index, tmp_path):
+    files, cursor = index.page("upload", 3, "name", "asc")
+    (tmp_path / "uploads" / "0.mp4").write_bytes(b"new")
+    index.rescan(force=True)
+    rest = []
+    while cursor:
+        page, cursor = index.page("upload", 3, "name", "asc", cursor=cursor)
+        rest.extend(f["name"] for f in page)
+    seen = [f["name"] for f in files] + rest
+    assert len(seen) == len(set(seen)) == len(FILES)
+
+
+def test_cursor_must_match_query(index):
+    _, cursor = index.page("upload", 2, "size", "asc")
+    with pytest.raises(InvalidCursorError):
+        index.page("upload", 2, "size", "desc", cursor=cursor)
+    with pytest.raises(InvalidCursorError):
+        index.page("upload", 2, "name", "asc", cursor=cursor)
+    with pytest.raises(InvalidCursorError):
+        index.page("upload", 2, "size", "asc", cursor="not-a-cursor")
@@ -0,0 +1,66 @@
+# test_media_response.py - Range 解析和条件请求
+import pytest
+
+from media_response import FileInfo, RangeNotSatisfiableError, not_modified, parse_range, range_applies
+
+INFO = FileInfo(
+    path="/tmp/video.mp4", size=1000, mtime=1700000000.5, etag='"3e8-1"',
+    last_modified="Tue, 14 Nov 2023 22:13:20 GMT", media_type="video/mp4",
+)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=900-", [(900, 999)]),
+    ("bytes=-100", [(900, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=500-5000", [(500, 999)]),
+    ("bytes=0-99, 50-149, 150-199", [(0, 199)]),
+    ("bytes=500-599, 0-99", [(0, 99), (500, 599)]),
+    ("bytes=0-99, 2000-", [(0, 99)]),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["items=0-99", "bytes=", "bytes=abc", "bytes=100-50", "bytes=-"])
+def test_parse_range_ignores_invalid_headers(header):
+    assert parse_range(header, 1000) is None
+
+
+def test_parse_range_ignores_too_many_ranges():
+    header = "bytes=" + ", ".join(f"{i * 10}-{i * 10}" for i in range(20))
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=-0", 1000),
+    ("bytes=0-", 0),
+    ("bytes=-100", 0),
+])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiableError):
+        parse_range(header, size)
+
+
+def test_not_modified():
+    assert not_modified({"if-none-match": '"3e8-1"'}, INFO)
+    assert not_modified({"if-none-match": 'W/"3e8-1"'}, INFO)
+    assert not_modified({"if-none-match": '"other", "3e8-1"'}, INFO)
+    assert not not_modified({"if-none-match": '"other"'}, INFO)
+    assert not_modified({"if-modified-since": INFO.last_modified}, INFO)
+    assert not not_modified({"if-modified-since": "Mon, 13 Nov 2023 00:00:00 GMT"}, INFO)
+    # If-None-Match 优先于 If-Modified-Since
+    assert not not_modified({"if-none-match": '"other"', "if-modified-since": INFO.last_modified}, INFO)
+    assert not not_modified({}, INFO)
+
+
+def test_range_applies():
+    assert range_applies({}, INFO)
+    assert range_applies({"if-range": '"3e8-1"'}, INFO)
+    # If-Range 必须强比较
+    assert not range_applies({"if-range": 'W/"3e8-1"'}, INFO)
+    assert not range_applies({"if-range": '"other"'}, INFO)
+    assert range_applies({"if-range": INFO.last_modified}, INFO)
+    assert not range_applies({"if-range": "Mon, 13 Nov 2023 00:00:00 GMT"}, INFO)
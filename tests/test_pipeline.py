@@ -0,0 +1,162 @@
+# test_pipeline.py - 流水线编译：滤镜输出的 split、输入端剪切的融合和参数校验
+import pytest
+
+from pipeline import PipelineError, compile_pipeline
+
+SOURCES = {
+    "a": {"has_video": True, "has_audio": True, "duration": 60.0},
+    "b": {"has_video": True, "has_audio": True, "duration": 30.0},
+}
+
+
+def _compile(steps, outputs, inputs=("a",)):
+    spec = {"inputs": {name: f"/media/{name}.mp4" for name in inputs}, "steps": steps, "outputs": outputs}
+    return compile_pipeline(spec, SOURCES, "/out")
+
+
+def _filters(plan):
+    command = plan.command
+    return command[command.index("-filter_complex") + 1].split(";") if "-filter_complex" in command else []
+
+
+def _input_args(plan):
+    command = plan.command
+    end = command.index("-filter_complex") if "-filter_complex" in command else command.index("-map")
+    return command[command.index("-nostats") + 1:end]
+
+
+def test_clip_on_input_is_fused_into_seek():
+    plan = _compile(
+        [{"id": "clip", "op": "clip_video", "inputs": ["a"], "params": {"start": "00:00:10", "duration": 5}},
+         {"id": "small", "op": "scale_video", "inputs": ["clip"], "params": {"width": 320}}],
+        {"small": "small.mp4"},
+    )
+    assert _input_args(plan) == ["-ss", "10.000", "-t", "5.000", "-i", "/media/a.mp4"]
+    # 剪切已在输入端完成，滤镜图中没有 trim
+    assert _filters(plan) == ["[0:v:0]scale=320:-2[p1]"]
+    assert plan.duration == pytest.approx(5.0)
+    assert plan.command[-1].startswith("/out/.pipeline-") and plan.command[-1].endswith("-small.mp4")
+    assert plan.outputs["small"][1] == "/out/small.mp4"
+
+
+def test_clip_is_not_fused_when_input_has_other_consumers():
+    plan = _compile(
+        [{"id": "clip", "op": "clip_video", "inputs": ["a"], "params": {"start": 10, "end": 20}},
+         {"id": "audio", "op": "extract_audio_from_video", "inputs": ["a"], "params": {}}],
+        {"clip": "clip.mp4", "audio": "audio.mp3"},
+    )
+    assert _input_args(plan) == ["-i", "/media/a.mp4"]
+    filters = _filters(plan)
+    assert "[0:v:0]trim=start=10.000:end=20.000,setpts=PTS-STARTPTS[p1]" in filters
+    assert "[0:a:0]atrim=start=10.000:end=20.000,asetpts=PTS-STARTPTS[p2]" in filters
+    # 输入文件的流可以直接被多次引用，不需要 split
+    assert not any("split" in f for f in filters)
+    assert plan.duration == pytest.approx(60.0)
+
+
+def test_filter_output_used_twice_is_split():
+    plan = _compile(
+        [{"id": "clip", "op": "clip_video", "inputs": ["a"], "params": {"start": 5, "duration": 10}},
+         {"id": "small", "op": "scale_video", "inputs": ["clip"], "params": {"width": 320, "height": 180}},
+         {"id": "big", "op": "scale_video", "inputs": ["clip"], "params": {"width": 1280, "height": 720}},
+         {"id": "pip", "op": "overlay_video", "inputs": ["big", "small"], "params": {"position": 3, "dx": -10}}],
+        {"pip": "pip.mp4", "small": "small.mp4"},
+    )
+    filters = _filters(plan)
+    # clip 是输入的唯一使用者，融合成输入端剪切；两个缩放直接引用输入流，不需要 split
+    assert _input_args(plan) == ["-ss", "5.000", "-t", "10.000", "-i", "/media/a.mp4"]
+    assert "[0:v:0]scale=320:180[p1]" in filters
+    assert "[0:v:0]scale=1280:720[p2]" in filters
+    # small 是滤镜输出，同时被叠加和输出使用，split 一次
+    assert filters.count("[p1]split=2[p1s0][p1s1]") == 1
+    assert "[p2][p1s0]overlay=x=W-w+-10:y=0[p3]" in filters
+    maps = [plan.command[i + 1] for i, arg in enumerate(plan.command) if arg == "-map"]
+    assert "[p3]" in maps and "[p1s1]" in maps
+    # 音频只有输入流一个来源，直接引用
+    assert "0:a:0" in maps
+
+
+def test_unused_filter_outputs_are_pruned():
+    # 缩放后的画面没有使用者，只留下剪切后的音频，滤镜图中不能有未连接的输出
+    plan = _compile(
+        [{"id": "clip", "op": "clip_video", "inputs": ["a"], "params": {"start": 10, "end": 40}},
+         {"id": "scaled", "op": "scale_video", "inputs": ["clip"], "params": {"width": 1280, "height": 720}},
+         {"id": "x", "op": "extract_audio_from_video", "inputs": ["scaled"], "params": {}}],
+        {"x": "out.mp3"},
+    )
+    assert _input_args(plan) == ["-ss", "10.000", "-t", "30.000", "-i", "/media/a.mp4"]
+    assert "-filter_complex" not in plan.command
+    assert plan.command[plan.command.index("-map") + 1] == "0:a:0"
+    assert plan.outputs["x"][1] == "/out/out.mp3"
+
+
+def test_unused_trim_and_concat_streams_are_pruned():
+    plan = _compile(
+        [{"id": "clip", "op": "clip_video", "inputs": ["a"], "params": {"start": 10, "end": 20}},
+         {"id": "both", "op": "concat_videos", "inputs": ["clip", "b"], "params": {}},
+         {"id": "frames", "op": "extract_frames_from_video", "inputs": ["both"], "params": {"fps": 1}},
+         {"id": "audio", "op": "extract_audio_from_video", "inputs": ["a"], "params": {}}],
+        {"frames": "frames", "audio": "audio.mp3"},
+        inputs=("a", "b"),
+    )
+    # 提取帧只使用拼接后的画面，剪切和拼接都只处理视频
+    assert _filters(plan) == [
+        "[0:v:0]trim=start=10.000:end=20.000,setpts=PTS-STARTPTS[p1]",
+        "[p1][1:v:0]concat=n=2:v=1:a=0[p3]",
+        "[p3]fps=1.0[p5]",
+    ]
+
+
+def test_concat_and_unused_steps():
+    plan = _compile(
+        [{"id": "both", "op": "concat_videos", "inputs": ["a", "b"], "params": {}},
+         {"id": "unused", "op": "scale_video", "inputs": ["a"], "params": {"width": 100}}],
+        {"both": "both"},
+        inputs=("a", "b"),
+    )
+    assert _filters(plan) == ["[0:v:0][0:a:0][1:v:0][1:a:0]concat=n=2:v=1:a=1[p1][p2]"]
+    assert plan.duration == pytest.approx(90.0)
+    assert plan.outputs["both"][1] == "/out/both.mp4"
+
+
+def test_extract_frames_writes_a_directory():
+    plan = _compile(
+        [{"id": "frames", "op": "extract_frames_from_video", "inputs": ["a"], "params": {"fps": "0.5", "format": "png"}}],
+        {"frames": "frames"},
+    )
+    assert _filters(plan) == ["[0:v:0]fps=0.5[p1]"]
+    assert plan.directories == {"frames"}
+    assert plan.command[-1].endswith("/frame_%04d.png")
+
+
+@pytest.mark.parametrize("op, params", [
+    ("scale_video", {"width": "320,drawtext=text=x"}),
+    ("scale_video", {"width": 0}),
+    ("scale_video", {"height": "-3"}),
+    ("extract_frames_from_video", {"fps": "1[x]"}),
+    ("extract_frames_from_video", {"fps": "-1"}),
+    ("extract_frames_from_video", {"fps": "inf"}),
+    ("extract_frames_from_video", {"format": "jpg/../../x"}),
+    ("overlay_video", {"dx": "1:y=0"}),
+    ("overlay_video", {"position": "middle"}),
+    ("clip_video", {"start": "soon"}),
+    ("clip_video", {"start": 20, "end": 10}),
+    ("extract_audio_from_video", {"audio_format": "mp3/../../x"}),
+])
+def test_invalid_params_raise_pipeline_error(op, params):
+    inputs = ["a", "b"] if op == "overlay_video" else ["a"]
+    with pytest.raises(PipelineError):
+        _compile([{"id": "s", "op": op, "inputs": inputs, "params": params}], {"s": "s"}, inputs=("a", "b"))
+
+
+@pytest.mark.parametrize("steps, outputs", [
+    ([], {"missing": "x.mp4"}),
+    ([{"id": "s", "op": "rotate", "inputs": ["a"]}], {"s": "s.mp4"}),
+    ([{"id": "s", "op": "scale_video", "inputs": ["a", "a"]}], {"s": "s.mp4"}),
+    ([{"id": "x", "op": "scale_video", "inputs": ["y"]}, {"id": "y", "op": "scale_video", "inputs": ["x"]}],
+     {"x": "x.mp4"}),
+    ([{"id": "s", "op": "scale_video", "inputs": ["a"]}], {"s": ".hidden.mp4"}),
+])
+def test_invalid_graphs_raise_pipeline_error(steps, outputs):
+    with pytest.raises(PipelineError):
+        _compile(steps, outputs)
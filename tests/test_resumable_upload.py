@@ -0,0 +1,189 @@
+# test_resumable_upload.py - 分块乱序、覆盖和失败后的整体哈希
+import asyncio
+import hashlib
+import os
+import threading
+
+import pytest
+
+import resumable_upload
+from resumable_upload import ResumableUploadError, ResumableUploadManager
+
+CHUNK = 8
+DATA = bytes(range(40)) + b"tail"
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(resumable_upload, "MIN_CHUNK_SIZE", 1)
+
+
+async def _stream(*parts):
+    for part in parts:
+        yield part
+
+
+def _chunk(data, index):
+    return data[index * CHUNK:(index + 1) * CHUNK]
+
+
+async def _upload(manager, upload_id, data, indexes):
+    for index in indexes:
+        await manager.write_chunk(upload_id, index, _stream(_chunk(data, index)))
+
+
+def _committer(tmp_path):
+    def commit(part_path, digest):
+        dest = str(tmp_path / digest)
+        os.replace(part_path, dest)
+        return dest
+    return commit
+
+
+def test_out_of_order_chunks(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        await _upload(manager, session["upload_id"], DATA, [3, 1, 5, 0, 2, 4])
+        stored = await manager.finalize(session["upload_id"], _committer(tmp_path))
+        assert stored.sha256 == hashlib.sha256(DATA).hexdigest()
+        assert open(stored.path, "rb").read() == DATA
+
+    asyncio.run(main())
+
+
+def test_rewritten_chunk_resets_hash(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, DATA, [0, 1, 2])
+        # 已计入整体哈希的分块被不同内容覆盖
+        changed = b"X" * CHUNK + DATA[CHUNK:]
+        await _upload(manager, upload_id, changed, [0, 3, 4, 5])
+        stored = await manager.finalize(upload_id, _committer(tmp_path))
+        assert stored.sha256 == hashlib.sha256(changed).hexdigest()
+
+    asyncio.run(main())
+
+
+def test_failed_rewrite_invalidates_hash(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, DATA, [0, 1, 2])
+        # 写入一半后校验失败，该位置的数据已被部分覆盖
+        with pytest.raises(ResumableUploadError):
+            await manager.write_chunk(upload_id, 1, _stream(b"garbage!"), checksum="0" * 64)
+        assert 1 not in (await asyncio.to_thread(manager.status, upload_id))["received_chunks"]
+        await _upload(manager, upload_id, DATA, [1, 3, 4, 5])
+        stored = await manager.finalize(upload_id, _committer(tmp_path))
+        assert stored.sha256 == hashlib.sha256(DATA).hexdigest()
+
+    asyncio.run(main())
+
+
+def test_rewrite_during_hashing(tmp_path, monkeypatch):
+    hashed_old = threading.Event()
+    release = threading.Event()
+    hash_range = resumable_upload._hash_range
+
+    def slow_hash_range(path, hasher, start, end):
+        hash_range(path, hasher, start, end)
+        if not hashed_old.is_set():
+            # 第一次计算读到的是旧内容，返回前暂停，让覆盖写入在此期间完成
+            hashed_old.set()
+            release.wait(5)
+
+    monkeypatch.setattr(resumable_upload, "_hash_range", slow_hash_range)
+
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, DATA, [1, 2])
+        first = asyncio.create_task(_upload(manager, upload_id, DATA, [0]))
+        await asyncio.to_thread(hashed_old.wait, 5)
+        changed = b"X" * CHUNK + DATA[CHUNK:]
+        rewrite = asyncio.create_task(_upload(manager, upload_id, changed, [0]))
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.gather(first, rewrite)
+        await _upload(manager, upload_id, DATA, [3, 4, 5])
+        stored = await manager.finalize(upload_id, _committer(tmp_path))
+        assert stored.sha256 == hashlib.sha256(changed).hexdigest()
+
+    asyncio.run(main())
+
+
+def test_concurrent_finalize(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, DATA, range(6))
+        results = await asyncio.gather(
+            manager.finalize(upload_id, _committer(tmp_path)),
+            manager.finalize(upload_id, _committer(tmp_path)),
+            return_exceptions=True,
+        )
+        stored = [r for r in results if not isinstance(r, Exception)]
+        errors = [r for r in results if isinstance(r, Exception)]
+        assert len(stored) == 1 and stored[0].sha256 == hashlib.sha256(DATA).hexdigest()
+        assert len(errors) == 1 and isinstance(errors[0], ResumableUploadError)
+        assert errors[0].status_code == 409
+        # 完成后会话已删除
+        with pytest.raises(ResumableUploadError) as e:
+            await manager.finalize(upload_id, _committer(tmp_path))
+        assert e.value.status_code == 404
+
+    asyncio.run(main())
+
+
+def test_failed_finalize_can_be_retried(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        expected = hashlib.sha256(DATA).hexdigest()
+        session = await manager.create("a.mp4", len(DATA), CHUNK, sha256=expected)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, b"Y" * CHUNK + DATA[CHUNK:], range(6))
+        with pytest.raises(ResumableUploadError) as e:
+            await manager.finalize(upload_id, _committer(tmp_path))
+        assert e.value.status_code == 422
+        await _upload(manager, upload_id, DATA, [0])
+        stored = await manager.finalize(upload_id, _committer(tmp_path))
+        assert stored.sha256 == expected
+
+    asyncio.run(main())
+
+
+def test_no_writes_while_finalizing(tmp_path):
+    async def main():
+        manager = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await manager.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(manager, upload_id, DATA, range(6))
+        assert manager._claim(upload_id)
+        for call in (manager.write_chunk(upload_id, 0, _stream(_chunk(DATA, 0))), manager.abort(upload_id)):
+            with pytest.raises(ResumableUploadError) as e:
+                await call
+            assert e.value.status_code == 409
+
+    asyncio.run(main())
+
+
+def test_chunk_rewritten_on_another_worker(tmp_path):
+    async def main():
+        # 两个 worker 进程共享同一个会话目录
+        first = ResumableUploadManager(str(tmp_path / "resumable"))
+        second = ResumableUploadManager(str(tmp_path / "resumable"))
+        session = await first.create("a.mp4", len(DATA), CHUNK)
+        upload_id = session["upload_id"]
+        await _upload(first, upload_id, DATA, [0, 1, 2])
+        changed = DATA[:CHUNK] + b"Z" * CHUNK + DATA[2 * CHUNK:]
+        await _upload(second, upload_id, changed, [1, 3, 4, 5])
+        stored = await first.finalize(upload_id, _committer(tmp_path))
+        assert stored.sha256 == hashlib.sha256(changed).hexdigest()
+
+    asyncio.run(main())
@@ -0,0 +1,50 @@
+# test_think_parser.py - 标签被切断在分块之间时的增量拆分
+import pytest
+
+from think_parser import CLOSE_TAG, ThinkParser
+
+RESPONSE = "前言<think>先分析需求</think>结果一<think>再想想 a<b</think>结果二 <i>ok</i>"
+THINKING = "先分析需求再想想 a<b"
+RESULT = "前言结果一结果二 <i>ok</i>"
+
+
+def _split(chunks):
+    parser = ThinkParser()
+    thinking, result = [], []
+    for event in [e for chunk in chunks for e in parser.feed(chunk)] + parser.flush():
+        assert event["content"]
+        (thinking if event["type"] == "thinking_chunk" else result).append(event["content"])
+        assert len(parser._pending) < len(CLOSE_TAG)
+    return "".join(thinking), "".join(result)
+
+
+def test_whole_response():
+    assert _split([RESPONSE]) == (THINKING, RESULT)
+
+
+def test_single_character_chunks():
+    assert _split(list(RESPONSE)) == (THINKING, RESULT)
+
+
+@pytest.mark.parametrize("cut", range(1, len(RESPONSE)))
+def test_every_two_chunk_split(cut):
+    assert _split([RESPONSE[:cut], RESPONSE[cut:]]) == (THINKING, RESULT)
+
+
+@pytest.mark.parametrize("size", [2, 3, 5, 7])
+def test_fixed_size_chunks(size):
+    chunks = [RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)]
+    assert _split(chunks) == (THINKING, RESULT)
+
+
+def test_unterminated_tag_prefix_is_flushed():
+    parser = ThinkParser()
+    assert parser.feed("答案 <thi") == [{"type": "response_chunk", "content": "答案 "}]
+    assert parser.flush() == [{"type": "response_chunk", "content": "<thi"}]
+
+
+def test_unclosed_think_stays_thinking():
+    parser = ThinkParser()
+    events = parser.feed("<think>还在思考") + parser.flush()
+    assert events == [{"type": "thinking_chunk", "content": "还在思考"}]
+    assert parser.in_think
@@ -0,0 +1,66 @@
+# think_parser.py - 模型输出中思考过程和结果的增量拆分
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+
+class ThinkParser:
+    """按 <think> 标签拆分增量到达的模型输出的状态机
+
+    每个分块只扫描一遍（str.find 从上次的位置继续），不拼接已处理的文本；
+    被切断在两个分块之间的标签前缀最多保留 len("</think>") - 1 个字符，内存占用与响应长度无关。
+    feed 直接返回 thinking_chunk / response_chunk 事件，可以原样作为 SSE 事件发出。
+    """
+
+    __slots__ = ("in_think", "_pending")
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""
+
+    @staticmethod
+    def _event(in_think, text):
+        return {"type": "thinking_chunk" if in_think else "response_chunk", "content": text}
+
+    def feed(self, text):
+        """
+        输入一段新文本
+
+        Args:
+            text: 模型输出的增量文本
+
+        Returns:
+            list: thinking_chunk / response_chunk 事件，被切断的标签留到下一段再处理
+        """
+        if self._pending:
+            text = self._pending + text
+            self._pending = ""
+        elif "<" not in text:
+            # 大多数分块不含标签，整块作为一个事件
+            return [self._event(self.in_think, text)] if text else []
+        events = []
+        start = 0
+        while True:
+            tag = CLOSE_TAG if self.in_think else OPEN_TAG
+            pos = text.find(tag, start)
+            if pos < 0:
+                break
+            if pos > start:
+                events.append(self._event(self.in_think, text[start:pos]))
+            start = pos + len(tag)
+            self.in_think = not self.in_think
+
+        # 末尾可能是标签的前半部分，只需检查最后 len(tag) - 1 个字符中的 "<"
+        end = len(text)
+        lt = text.rfind("<", max(start, end - len(tag) + 1))
+        if lt >= 0 and tag.startswith(text[lt:]):
+            self._pending = text[lt:]
+            end = lt
+        if end > start:
+            events.append(self._event(self.in_think, text[start:end]))
+        return events
+
+    def flush(self):
+        """输出结束时取出剩余的文本"""
+        text, self._pending = self._pending, ""
+        return [self._event(self.in_think, text)] if text else []
+
@@ -0,0 +1,258 @@
+# thumbnails.py - 封面图、进度条预览雪碧图和 WebVTT 索引的生成与缓存
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+import metrics
+from file_lock import lock_file, unlock
+
+logger = logging.getLogger(__name__)
+
+POSTER_NAME = "poster.jpg"
+SPRITE_NAME = "sprite.jpg"
+VTT_NAME = "sprite.vtt"
+
+# 封面图宽度
+POSTER_WIDTH = 320
+# 雪碧图中每个小图的宽度、列数和最多小图数量
+TILE_WIDTH = 160
+TILE_COLUMNS = 10
+MAX_TILES = 100
+# 相邻小图的最小时间间隔（秒）
+MIN_TILE_INTERVAL = 1.0
+# 小图间隔不小于该值（秒）时只解码关键帧
+KEYFRAME_ONLY_INTERVAL = 5.0
+# 单次生成的超时时间（秒）
+GENERATE_TIMEOUT = 300
+
+_KEY_RE = re.compile(r"[0-9a-f]{64}")
+_NAMES = (POSTER_NAME, SPRITE_NAME, VTT_NAME)
+
+
+def _even(value):
+    return max(2, int(round(value / 2)) * 2)
+
+
+def _vtt_time(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def sprite_layout(duration):
+    """
+    根据视频时长确定雪碧图布局
+
+    Returns:
+        tuple: (小图间隔秒数, 小图数量, 行数)
+    """
+    interval = max(MIN_TILE_INTERVAL, duration / MAX_TILES)
+    count = max(1, min(MAX_TILES, math.ceil(duration / interval)))
+    return interval, count, math.ceil(count / TILE_COLUMNS)
+
+
+def build_vtt(duration, interval, count, tile_width, tile_height):
+    """生成进度条预览的 WebVTT 索引，每个时间段指向雪碧图中的一个区域"""
+    lines = ["WEBVTT", ""]
+    for i in range(count):
+        start = i * interval
+        end = min((i + 1) * interval, duration)
+        x = (i % TILE_COLUMNS) * tile_width
+        y = (i // TILE_COLUMNS) * tile_height
+        lines.append(f"{_vtt_time(start)} --> {_vtt_time(end)}")
+        lines.append(f"{SPRITE_NAME}#xywh={x},{y},{tile_width},{tile_height}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+class ThumbnailCache:
+    """按内容哈希缓存的封面图和雪碧图
+
+    视频的封面图（10% 处的一帧）和雪碧图由同一次 FFmpeg 调用生成：解码一遍，
+    用 split 分出两路分别选帧和拼图；时长较长时只解码关键帧。图片只生成封面图。
+    每个文件的产物放在 <内容哈希>/ 目录下，总大小超过预算时淘汰最久未访问的目录。
+    多个 worker 进程共享缓存目录：本进程未记录的条目从磁盘收录，生成时持有 <内容哈希>.lock
+    文件锁，其他进程等待锁释放后直接收录结果，不重复解码。
+    """
+
+    def __init__(self, root, max_bytes=1024 ** 3, ffmpeg=None):
+        """
+        初始化缩略图缓存
+
+        Args:
+            root: 缓存目录
+            max_bytes: 缓存总大小上限
+            ffmpeg: ffmpeg 可执行文件路径，默认从 PATH 查找
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self._lock = threading.Lock()
+        # 内容哈希 -> [最近访问时间, 大小]
+        self._entries = {}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and _KEY_RE.fullmatch(entry.name):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                self._entries[entry.name] = [entry.stat().st_mtime, size]
+            elif entry.name.startswith(".tmp-") and entry.is_dir():
+                # 生成到一半的临时目录（其他 worker 正在生成的除外）
+                fd = lock_file(self._lock_path(entry.name[5:69]), blocking=False)
+                if fd is not None:
+                    try:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    finally:
+                        unlock(fd)
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, f"{key}.lock")
+
+    def _adopt(self, key):
+        """
+        按磁盘上的目录同步条目：收录其他 worker 生成的内容，丢弃已被其他 worker 淘汰的条目
+
+        Returns:
+            bool: 缓存中是否有该内容
+        """
+        out_dir = os.path.join(self.root, key)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and os.path.isdir(out_dir):
+            entry[0] = time.time()
+            return True
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(out_dir) if f.is_file())
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(key, None)
+            return False
+        with self._lock:
+            self._entries[key] = [time.time(), size]
+        return True
+
+    def has(self, key):
+        return bool(key) and _KEY_RE.fullmatch(key) is not None and self._adopt(key)
+
+    def file_path(self, key, name):
+        """
+        缓存文件路径，并记录访问时间
+
+        Returns:
+            str: 文件路径，名称无效或不存在时返回 None
+        """
+        if not _KEY_RE.fullmatch(key) or name not in _NAMES:
+            return None
+        if not self._adopt(key):
+            return None
+        path = os.path.join(self.root, key, name)
+        return path if os.path.exists(path) else None
+
+    def generate(self, path, key, kind, duration=None, width=None, height=None):
+        """
+        生成封面图（视频还包括雪碧图和 WebVTT 索引），已存在时直接返回
+
+        Args:
+            path: 源文件路径
+            key: 内容哈希
+            kind: 文件类别 video / image
+            duration: 视频时长（秒）
+            width: 视频宽度
+            height: 视频高度
+
+        Returns:
+            bool: 是否生成成功
+        """
+        if not self.ffmpeg or not key or not _KEY_RE.fullmatch(key):
+            return False
+        if self.has(key):
+            return True
+        lock = lock_file(self._lock_path(key))
+        try:
+            if self._adopt(key):
+                # 等待锁期间其他 worker 已经生成
+                return True
+            return self._generate_locked(path, key, kind, duration, width, height)
+        finally:
+            unlock(lock)
+
+    def _generate_locked(self, path, key, kind, duration, width, height):
+        tmp_dir = os.path.join(self.root, f".tmp-{key}-{os.getpid()}-{threading.get_ident()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            with metrics.ffmpeg_running("thumbnail"), metrics.span("thumbnail"):
+                if kind == "video" and duration and width and height:
+                    self._generate_video(path, tmp_dir, duration, width, height)
+                elif kind in ("video", "image"):
+                    self._generate_poster(path, tmp_dir)
+                else:
+                    return False
+            final_dir = os.path.join(self.root, key)
+            try:
+                os.rename(tmp_dir, final_dir)
+            except OSError:
+                # 已经存在相同内容
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            size = sum(f.stat().st_size for f in os.scandir(final_dir) if f.is_file())
+            with self._lock:
+                self._entries[key] = [time.time(), size]
+            self._evict()
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"生成缩略图失败 {path}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+
+    def _generate_video(self, path, out_dir, duration, width, height):
+        interval, count, rows = sprite_layout(duration)
+        tile_height = _even(TILE_WIDTH * height / width)
+        poster_height = _even(POSTER_WIDTH * height / width)
+        command = [self.ffmpeg, "-v", "error", "-nostdin", "-y"]
+        if interval >= KEYFRAME_ONLY_INTERVAL:
+            command += ["-skip_frame", "nokey"]
+        command += [
+            "-i", path, "-an", "-sn", "-dn",
+            "-filter_complex",
+            f"[0:v:0]split=2[p][s];"
+            f"[p]select='gte(t,{duration * 0.1:.3f})',scale={POSTER_WIDTH}:{poster_height},setsar=1[poster];"
+            f"[s]fps=1/{interval:.3f},scale={TILE_WIDTH}:{tile_height},setsar=1,"
+            f"tile={TILE_COLUMNS}x{rows}[sprite]",
+            "-map", "[poster]", "-frames:v", "1", "-q:v", "3", os.path.join(out_dir, POSTER_NAME),
+            "-map", "[sprite]", "-frames:v", "1", "-q:v", "5", os.path.join(out_dir, SPRITE_NAME),
+        ]
+        subprocess.run(command, capture_output=True, timeout=GENERATE_TIMEOUT, check=True)
+        if not os.path.exists(os.path.join(out_dir, POSTER_NAME)):
+            # 选帧位置之后没有可解码的帧（如只有一个关键帧的短视频），退化为首帧
+            self._generate_poster(path, out_dir)
+        with open(os.path.join(out_dir, VTT_NAME), "w", encoding="utf-8") as f:
+            f.write(build_vtt(duration, interval, count, TILE_WIDTH, tile_height))
+
+    def _generate_poster(self, path, out_dir):
+        subprocess.run(
+            [self.ffmpeg, "-v", "error", "-nostdin", "-y", "-i", path, "-frames:v", "1",
+             "-vf", f"scale='min({POSTER_WIDTH},iw)':-2", "-q:v", "3", os.path.join(out_dir, POSTER_NAME)],
+            capture_output=True, timeout=GENERATE_TIMEOUT, check=True
+        )
+
+    def _evict(self):
+        """淘汰最久未访问的条目，直到总大小不超过预算"""
+        with self._lock:
+            total = sum(size for _, size in self._entries.values())
+            victims = []
+            for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+                if total <= self.max_bytes:
+                    break
+                del self._entries[key]
+                victims.append(key)
+                total -= size
+        for key in victims:
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        if victims:
+            logger.info(f"淘汰 {len(victims)} 个缩略图缓存")
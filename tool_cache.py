@@ -0,0 +1,322 @@
+# tool_cache.py - 确定性 FFmpeg 工具调用的结果缓存
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mcp.types import CallToolResult, TextContent
+
+from blob_store import hash_file
+
+logger = logging.getLogger(__name__)
+
+# 未收录到 blob 存储的输入文件，内存中最多记住多少个文件的哈希
+DIGEST_MEMO_SIZE = 4096
+
+# 可缓存的工具：输入文件参数和输出参数（输出为文件或目录）
+CACHEABLE_TOOLS = {
+    "get_video_info": {"inputs": ["video_path"], "output": None},
+    "clip_video": {"inputs": ["video_path"], "output": "output_path"},
+    "scale_video": {"inputs": ["video_path"], "output": "output_path"},
+    "concat_videos": {"inputs": ["input_files"], "output": "output_path"},
+    "overlay_video": {"inputs": ["background_video", "overlay_video"], "output": "output_path"},
+    "extract_audio_from_video": {"inputs": ["video_path"], "output": "output_path"},
+    "extract_frames_from_video": {"inputs": ["video_path"], "output": "output_folder"},
+}
+
+
+def result_text(result):
+    """提取 MCP 工具调用结果中的文本内容"""
+    if isinstance(result, str):
+        return result
+    content = getattr(result, "content", None)
+    if isinstance(content, list):
+        return " ".join(item.text for item in content if hasattr(item, "text"))
+    return str(result)
+
+
+def _snapshot(folder):
+    """目录中文件的 (大小, mtime_ns) 快照"""
+    snapshot = {}
+    if os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            if entry.is_file() and not entry.name.startswith("."):
+                st = entry.stat()
+                snapshot[entry.name] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+class ToolResultCache:
+    """确定性 FFmpeg 工具调用的结果缓存
+
+    缓存键由工具名、规范化后的参数和输入文件的内容哈希组成，输入文件改名不影响命中，
+    内容变化则自动失效。产物文件保存在 blob 存储中并由缓存条目持有引用，命中时直接
+    链接到本次请求的输出位置。按产物总大小做 LRU 淘汰。
+    """
+
+    def __init__(self, blob_store, db_path, max_bytes=10 * 1024 ** 3, max_entries=10000):
+        """
+        初始化工具结果缓存
+
+        Args:
+            blob_store: 用于保存产物和查询输入哈希的 BlobStore
+            db_path: 缓存索引数据库路径
+            max_bytes: 缓存产物的总大小上限
+            max_entries: 缓存条目数上限
+        """
+        self.blob_store = blob_store
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # 绝对路径 -> (大小, mtime_ns, 内容哈希)，用于未收录到 blob 存储的输入文件，按 LRU 淘汰
+        self._digest_memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    tool TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    output TEXT,
+                    inputs TEXT NOT NULL,
+                    artifacts TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def stats(self):
+        """缓存命中统计"""
+        with self._connect() as db:
+            row = db.execute("SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS size FROM entries").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": row["n"], "bytes": row["size"]}
+
+    def _input_digest(self, path):
+        digest = self.blob_store.digest_of(path)
+        if digest is not None:
+            return digest
+        st = os.stat(path)
+        abs_path = os.path.abspath(path)
+        with self._memo_lock:
+            memo = self._digest_memo.get(abs_path)
+            if memo is not None and memo[:2] == (st.st_size, st.st_mtime_ns):
+                self._digest_memo.move_to_end(abs_path)
+                return memo[2]
+        digest = hash_file(path)
+        with self._memo_lock:
+            # 同一路径只保留最新内容的哈希，文件被改写后旧记录随之替换
+            self._digest_memo[abs_path] = (st.st_size, st.st_mtime_ns, digest)
+            self._digest_memo.move_to_end(abs_path)
+            while len(self._digest_memo) > DIGEST_MEMO_SIZE:
+                self._digest_memo.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def _input_paths(spec, arguments):
+        """按参数顺序展开的输入文件绝对路径"""
+        paths = []
+        for name in spec["inputs"]:
+            value = arguments.get(name)
+            for p in (value if isinstance(value, list) else [value]):
+                if isinstance(p, str):
+                    paths.append(os.path.abspath(p))
+        return paths
+
+    def _make_key(self, tool, arguments):
+        """
+        计算缓存键，输入文件不存在时返回 None（交给工具本身报错）
+        """
+        spec = CACHEABLE_TOOLS[tool]
+        normalized = {}
+        for name, value in sorted(arguments.items()):
+            if value is None or name == spec["output"]:
+                continue
+            if name in spec["inputs"]:
+                paths = value if isinstance(value, list) else [value]
+                if not all(isinstance(p, str) and os.path.isfile(p) for p in paths):
+                    return None
+                digests = [self._input_digest(p) for p in paths]
+                value = digests if isinstance(value, list) else digests[0]
+            elif isinstance(value, str):
+                value = value.strip()
+            normalized[name] = value
+        payload = json.dumps({"tool": tool, "args": normalized}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def call(self, tool, arguments, call_tool):
+        """
+        带缓存地调用工具
+
+        Args:
+            tool: 工具名
+            arguments: 工具参数
+            call_tool: 实际执行工具调用的协程函数 call_tool(tool, arguments)
+
+        Returns:
+            工具调用结果
+        """
+        spec = CACHEABLE_TOOLS.get(tool)
+        if spec is None or not isinstance(arguments, dict):
+            return await call_tool(tool, arguments)
+        output = arguments.get(spec["output"]) if spec["output"] else None
+        if spec["output"] and not output:
+            # 未指定输出位置时由服务器决定，无法可靠地复用产物
+            return await call_tool(tool, arguments)
+
+        try:
+            key = await asyncio.to_thread(self._make_key, tool, arguments)
+        except OSError as e:
+            logger.warning(f"计算工具缓存键失败: {e}")
+            key = None
+        if key is None:
+            return await call_tool(tool, arguments)
+
+        inputs = self._input_paths(spec, arguments)
+        cached = await asyncio.to_thread(self._lookup, key, output, inputs)
+        if cached is not None:
+            self.hits += 1
+            logger.info(f"工具缓存命中: {tool} {key[:12]}")
+            return CallToolResult(content=[TextContent(type="text", text=cached)], isError=False)
+        self.misses += 1
+
+        before = await asyncio.to_thread(_snapshot, output) if spec["output"] == "output_folder" else {}
+        started = time.time()
+        result = await call_tool(tool, arguments)
+        if getattr(result, "isError", False):
+            return result
+        try:
+            await asyncio.to_thread(
+                self._store, key, tool, result_text(result), spec, output, inputs, before, started
+            )
+        except OSError as e:
+            logger.warning(f"保存工具缓存失败: {e}")
+        return result
+
+    def prepare_output(self, tool, arguments):
+        """
+        工具写入前处理输出位置：已存在的输出文件可能是 blob 的硬链接，FFmpeg 覆盖写入
+        会改动共享内容。输出文件先解除链接，输出目录中的文件替换为独立副本。
+        所有实际执行 FFmpeg 的调用（包括未命中缓存和不可缓存的调用）都要先经过这里。
+        """
+        spec = CACHEABLE_TOOLS.get(tool)
+        if spec is None or not spec["output"] or not isinstance(arguments, dict):
+            return
+        output = arguments.get(spec["output"])
+        if not isinstance(output, str) or not output:
+            return
+        if spec["output"] == "output_folder":
+            if os.path.isdir(output):
+                for entry in os.scandir(output):
+                    if entry.is_file() and not entry.name.startswith("."):
+                        self.blob_store.detach(entry.path)
+        elif os.path.isfile(output) and os.path.abspath(output) not in self._input_paths(spec, arguments):
+            self.blob_store.release(output)
+
+    def _store(self, key, tool, text, spec, output, inputs, before, started):
+        artifacts = []
+        if spec["output"] == "output_path":
+            if not os.path.isfile(output) or os.path.getmtime(output) < started - 1:
+                # 没有生成新的输出文件，视为失败，不缓存
+                return
+            artifacts.append(("", self.blob_store.adopt(output)))
+        elif spec["output"] == "output_folder":
+            after = _snapshot(output)
+            for name, stat in sorted(after.items()):
+                if before.get(name) != stat:
+                    artifacts.append((name, self.blob_store.adopt(os.path.join(output, name))))
+            if not artifacts:
+                return
+        if any(digest is None for _, digest in artifacts):
+            return
+
+        size = sum(os.path.getsize(self.blob_store.blob_path(d)) for _, d in artifacts)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        for i, (_, digest) in enumerate(artifacts):
+            self.blob_store.retain(digest, f"tool-cache:{key}:{i}")
+        now = time.time()
+        with self._connect() as db:
+            previous = db.execute("SELECT artifacts FROM entries WHERE key = ?", (key,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, tool, text, os.path.abspath(output) if output else None,
+                 json.dumps(inputs), json.dumps(artifacts), size, now, now)
+            )
+        if previous is not None:
+            for i in range(len(artifacts), len(json.loads(previous["artifacts"]))):
+                self.blob_store.drop(f"tool-cache:{key}:{i}")
+        self._evict()
+
+    def _lookup(self, key, output, inputs):
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        artifacts = json.loads(row["artifacts"])
+        if not all(self.blob_store.has(digest) for _, digest in artifacts):
+            self._remove(key, len(artifacts))
+            return None
+
+        text = row["result"]
+        # 结果文本中的输入、输出位置替换为本次请求的位置
+        for old_path, new_path in zip(json.loads(row["inputs"]), inputs):
+            if old_path != new_path:
+                text = text.replace(old_path, new_path)
+        if artifacts:
+            if len(artifacts) == 1 and artifacts[0][0] == "":
+                self.blob_store.link(artifacts[0][1], output)
+            else:
+                os.makedirs(output, exist_ok=True)
+                for name, digest in artifacts:
+                    self.blob_store.link(digest, os.path.join(output, name))
+            new_output = os.path.abspath(output)
+            if row["output"] and row["output"] != new_output:
+                text = text.replace(row["output"], new_output)
+        with self._connect() as db:
+            db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return text
+
+    def _remove(self, key, artifact_count):
+        with self._connect() as db:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        for i in range(artifact_count):
+            self.blob_store.drop(f"tool-cache:{key}:{i}")
+
+    def _evict(self):
+        """按最近使用时间淘汰，直到满足大小和条目数限制"""
+        with self._connect() as db:
+            row = db.execute("SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS size FROM entries").fetchone()
+            count, total = row["n"], row["size"]
+            if count <= self.max_entries and total <= self.max_bytes:
+                return
+            rows = db.execute("SELECT key, artifacts, size FROM entries ORDER BY last_used").fetchall()
+        for row in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            self._remove(row["key"], len(json.loads(row["artifacts"])))
+            count -= 1
+            total -= row["size"]
+            logger.info(f"淘汰工具缓存条目: {row['key'][:12]}")
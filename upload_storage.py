@@ -0,0 +1,74 @@
+# upload_storage.py - 上传文件的分块流式落盘
+import asyncio
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+
+# 每次从上传流读取的块大小
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """上传文件超过大小限制"""
+
+    def __init__(self, max_size):
+        super().__init__(f"文件大小超过限制 ({max_size // (1024 * 1024)} MB)")
+        self.max_size = max_size
+
+
+@dataclass
+class StoredUpload:
+    """已落盘的上传文件"""
+    path: str
+    size: int
+    sha256: str
+
+
+def get_max_upload_size():
+    """从环境变量 MAX_FILE_SIZE（MB）读取上传大小限制，0 表示不限制"""
+    return int(os.getenv("MAX_FILE_SIZE", "4096")) * 1024 * 1024
+
+
+def _write_chunk(fileobj, hasher, chunk):
+    # 在线程池中执行：写入和哈希计算都不占用事件循环
+    fileobj.write(chunk)
+    hasher.update(chunk)
+
+
+async def stream_upload_to_temp(upload, tmp_dir, max_size=0, chunk_size=CHUNK_SIZE):
+    """
+    将上传文件分块写入 tmp_dir 中的临时文件，边写边计算 SHA-256
+
+    内存占用只与块大小有关，与文件大小无关；超过大小限制时立即中止并清理临时文件。
+
+    Args:
+        upload: FastAPI 的 UploadFile 对象
+        tmp_dir: 临时文件目录，应与最终位置在同一文件系统以便原子重命名
+        max_size: 最大字节数，0 表示不限制
+        chunk_size: 每次读取的块大小
+
+    Returns:
+        StoredUpload: 临时文件的路径、大小和哈希
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=tmp_dir)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadTooLargeError(max_size)
+                await asyncio.to_thread(_write_chunk, out, hasher, chunk)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return StoredUpload(path=tmp_path, size=size, sha256=hasher.hexdigest())
+